@@ -0,0 +1,671 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочные проверки Mexanick Market на временной базе.
+
+    python bench.py purchase --buyers 500 --stock 100
+    python bench.py purchase --legacy   # старый путь cb_buy: чтение и запись раздельно
+    python bench.py routing             # цена маршрутизации callback: цепочка lambda против словаря
+    python bench.py scaling --processes 1,2,4   # пропускная способность супервизора с N обработчиками
+    python bench.py search --products 100000    # задержка полнотекстового поиска против LIKE
+    python bench.py markup              # цена сборки клавиатур на один callback: с кэшем и без
+    python bench.py cards               # карточка товара: рендер из БД против кэша, доля попаданий
+"""
+import argparse
+import asyncio
+import inspect
+import logging
+import os
+import random
+import re
+import signal
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+from aiogram import Dispatcher
+from aiogram.filters import StateFilter
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import CallbackQuery, Chat, InlineKeyboardMarkup, Message, Update, User
+
+import main
+from fake_telegram import FakeTelegram
+
+BENCH_METRICS_TOKEN = 'bench'  # METRICS_TOKEN of the supervisor started by `scaling`
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def open_temp_db(tmpdir, name="bench.db"):
+    main.db = main.DBPool(os.path.join(tmpdir, name))
+    await main.init_db()
+
+
+async def seed_market(products, stock, price, seller_user_id=1):
+    async with main.db.write() as conn:
+        await conn.execute("INSERT INTO users(user_id,username,balance) VALUES (?,?,0)", (seller_user_id, 'seller'))
+        await conn.execute("INSERT INTO sellers(user_id,username,info) VALUES (?,?,?)", (seller_user_id, 'seller', ''))
+        await conn.execute("INSERT INTO categories(name) VALUES ('bench')")
+        for i in range(products):
+            await conn.execute("""INSERT INTO products(seller_id,title,description,category_id,subcategory_id,price,quantity,content_text,created_at)
+                               VALUES (1,?,?,1,NULL,?,?,?,?)""", (f"item {i}", '', price, stock, 'secret', main.now_iso()))
+
+
+async def legacy_buy(user_id, pid):
+    """Путь cb_buy до PurchaseEngine: проверки на читателе, списание отдельной записью"""
+    async with main.db.read() as conn:
+        async with conn.execute("SELECT price,quantity,seller_id FROM products WHERE id=?", (pid,)) as cur:
+            p = await cur.fetchone()
+        async with conn.execute("SELECT balance FROM users WHERE user_id=?", (user_id,)) as cur:
+            bal = (await cur.fetchone())['balance']
+    if p['quantity'] <= 0:
+        raise main.PurchaseError('sold_out')
+    if bal < p['price']:
+        raise main.PurchaseError('no_funds', bal, p['price'])
+    async with main.db.write() as conn:
+        await conn.execute("UPDATE users SET balance = balance - ? WHERE user_id=?", (p['price'], user_id))
+        await conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = (SELECT user_id FROM sellers WHERE id=?)",
+                           (p['price'], p['seller_id']))
+        await conn.execute("UPDATE products SET quantity = quantity - 1 WHERE id=?", (pid,))
+        await conn.execute("INSERT INTO orders(user_id, product_id, seller_id, price, created_at) VALUES (?, ?, ?, ?, ?)",
+                           (user_id, pid, p['seller_id'], p['price'], main.now_iso()))
+
+
+async def bench_purchase(args):
+    price = 100.0
+    await seed_market(args.products, args.stock, price)
+    buyers = range(1000, 1000 + args.buyers)
+    async with main.db.write() as conn:
+        for uid in buyers:
+            # Every buyer can afford `funds` items, some a bit less than one
+            funds = price * args.funds if random.random() > args.poor else price * 0.5
+            await conn.execute("INSERT INTO users(user_id,username,balance) VALUES (?,?,?)", (uid, f"b{uid}", funds))
+    async with main.db.read() as conn:
+        async with conn.execute("SELECT SUM(balance) AS s FROM users") as cur:
+            money_before = (await cur.fetchone())['s']
+
+    buy = legacy_buy if args.legacy else main.purchases.buy
+    outcomes = {'ok': 0, 'sold_out': 0, 'no_funds': 0, 'not_found': 0, 'error': 0}
+    latencies = []
+
+    async def attempt(uid, pid):
+        started = time.monotonic()
+        try:
+            await buy(uid, pid)
+            outcomes['ok'] += 1
+        except main.PurchaseError as e:
+            outcomes[e.reason] += 1
+        except Exception:
+            outcomes['error'] += 1
+        latencies.append(time.monotonic() - started)
+
+    calls = [attempt(uid, random.randint(1, args.products)) for uid in buyers for _ in range(args.attempts)]
+    random.shuffle(calls)
+    started = time.monotonic()
+    await asyncio.gather(*calls)
+    elapsed = time.monotonic() - started
+
+    async with main.db.read() as conn:
+        async with conn.execute("SELECT SUM(balance) AS s, MIN(balance) AS m FROM users") as cur:
+            money = await cur.fetchone()
+        async with conn.execute("SELECT SUM(quantity) AS q, MIN(quantity) AS m FROM products") as cur:
+            stock = await cur.fetchone()
+        async with conn.execute("SELECT COUNT(*) AS n FROM orders") as cur:
+            orders = (await cur.fetchone())['n']
+    issued = args.products * args.stock
+    checks = {
+        'no negative stock': stock['m'] >= 0,
+        'orders == stock sold': orders == issued - stock['q'],
+        'no overdrawn balance': money['m'] >= 0,
+        'money conserved': abs(money['s'] - money_before) < 1e-6,
+        'no oversell': orders <= issued,
+    }
+    total = len(latencies)
+    print(f"{'legacy' if args.legacy else 'engine'}: {total} attempts by {args.buyers} buyers on "
+          f"{args.products} product(s) x {args.stock} in {elapsed:.3f}s ({total / elapsed:.0f}/s)")
+    print(f"latency p50 {percentile(latencies, 0.5) * 1000:.1f}ms p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    print(f"outcomes {outcomes}; orders {orders}, stock left {stock['q']}, min balance {money['m']:.2f}")
+    if not args.legacy:
+        print(f"engine {main.purchases.stats()}; db {main.db.counters['write_batches']} commits")
+    for name, ok in checks.items():
+        print(f"  {'PASS' if ok else 'FAIL'} {name}")
+    return all(checks.values())
+
+
+def sample_callback_data():
+    """По одному callback_data на каждый маршрут без состояния FSM, с аргументами нужных типов"""
+    samples = []
+    for prefix, routes in main.callbacks.routes.items():
+        for state_name, types, _, _ in routes:
+            if state_name:
+                continue
+            args = []
+            for t in types:
+                args.extend(['2', 'n1a2b3c4d5e6.7f'] if t is main.PAGE else ['cat' if t is str else '123'])
+            samples.append(('|'.join([prefix, *args]), state_name))
+    return samples
+
+
+def legacy_filters():
+    """Фильтры в том виде, в каком они стояли на @dp.callback_query до CallbackRouter"""
+    filters = []
+    for prefix, state_name, has_args in main.callbacks.order:
+        if has_args:
+            filters.append((lambda c, p=prefix + "|": c.data.startswith(p), state_name))
+        else:
+            filters.append((lambda c, p=prefix: c.data == p, state_name))
+    return filters
+
+
+async def noop(callback, *args, state=None):
+    pass
+
+
+def make_update(i, data):
+    user = User(id=1, is_bot=False, first_name='bench')
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=1, type='private'))
+    return Update(update_id=i, callback_query=CallbackQuery(id=str(i), from_user=user, chat_instance='bench',
+                                                            message=message, data=data))
+
+
+async def bench_routing(args):
+    samples = sample_callback_data()
+    filters = legacy_filters()
+    print(f"{len(filters)} routes, {len(main.callbacks.routes)} prefixes, {args.updates} updates")
+
+    # Filter evaluation alone, without aiogram around it
+    class C:
+        __slots__ = ('data',)
+    events = []
+    for i in range(args.updates):
+        c = C()
+        c.data = samples[i % len(samples)][0]
+        events.append(c)
+    started = time.perf_counter()
+    for c in events:
+        for f, _ in filters:
+            if f(c):
+                break
+    legacy_match = (time.perf_counter() - started) / args.updates
+    router = main.callbacks
+    started = time.perf_counter()
+    for c in events:
+        prefix, _, rest = c.data.partition('|')
+        routes = router.routes[prefix]
+        router.parse(routes[-1][1], rest.split('|') if rest else [])
+    router_match = (time.perf_counter() - started) / args.updates
+    print(f"match only:   lambda chain {legacy_match * 1e6:6.2f} us/update, router {router_match * 1e6:6.2f} us/update")
+
+    # Full aiogram dispatch with no-op handlers
+    legacy_dp = Dispatcher(storage=MemoryStorage())
+    for f, state_name in filters:
+        if state_name:
+            legacy_dp.callback_query.register(noop, f, StateFilter(state_name))
+        else:
+            legacy_dp.callback_query.register(noop, f)
+    router_dp = Dispatcher(storage=MemoryStorage())
+    noop_router = main.CallbackRouter()
+    for prefix, routes in router.routes.items():
+        noop_router.routes[prefix] = [(state_name, types, noop, False) for state_name, types, _, _ in routes]
+    router_dp.callback_query.register(noop_router.dispatch)
+    updates = [make_update(i, samples[i % len(samples)][0]) for i in range(args.updates)]
+    results = {}
+    for name, dp in (('lambda chain', legacy_dp), ('router', router_dp)):
+        started = time.perf_counter()
+        for u in updates:
+            await dp.feed_update(main.bot, u)
+        results[name] = (time.perf_counter() - started) / args.updates
+    print(f"feed_update:  lambda chain {results['lambda chain'] * 1e6:6.2f} us/update, "
+          f"router {results['router'] * 1e6:6.2f} us/update")
+    # The latency histogram middleware behind /metrics, measured alone: feed_update varies by more than it costs
+    middleware = main.timed(main.callback_seconds, main.callback_labels)
+
+    async def handler(event, data):
+        pass
+    queries = [u.callback_query for u in updates]
+    started = time.perf_counter()
+    for q in queries:
+        await handler(q, {})
+    plain = time.perf_counter() - started
+    started = time.perf_counter()
+    for q in queries:
+        await middleware(handler, q, {})
+    print(f"metrics middleware: {(time.perf_counter() - started - plain) / args.updates * 1e6:.2f} us/update")
+    # Update-level profiler (spans, slow-update watchdog, PROFILE_SAMPLE_RATE under cProfile)
+    started = time.perf_counter()
+    for u in updates:
+        await main.profiler(handler, u, {})
+    print(f"profiler middleware: {(time.perf_counter() - started - plain) / args.updates * 1e6:.2f} us/update, "
+          f"{main.profiler.counters['profiled']} slow of {main.profiler.counters['updates']}")
+    # The route declared last paid for every filter before it
+    worst = next(data for data, _ in samples if data.split('|')[0] == main.callbacks.order[-1][0])
+    for name, dp in (('lambda chain', legacy_dp), ('router', router_dp)):
+        started = time.perf_counter()
+        for i in range(args.updates // 10):
+            await dp.feed_update(main.bot, make_update(i, worst))
+        print(f"last route '{worst}' via {name}: {(time.perf_counter() - started) / (args.updates // 10) * 1e6:.2f} us/update")
+
+
+def callback_update(i, chat_id, data):
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'bench'}
+    return {'update_id': i, 'callback_query': {
+        'id': str(i), 'from': user, 'chat_instance': 'bench', 'data': data,
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': 'menu'}}}
+
+
+async def wait_until(condition, timeout, what):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError(what)
+        await asyncio.sleep(0.05)
+
+
+async def run_supervisor(args, processes, api_url, port):
+    """Один прогон: свежая база, супервизор с N обработчиками, поток callback-обновлений через вебхук"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await open_temp_db(tmpdir, main.DB_FILE)
+        await seed_market(args.products, 1000, 100.0)
+        await main.db.close()
+        args.fake.webhook = None
+        env = {**os.environ, 'PROCESSES': str(processes), 'UPDATE_MODE': 'webhook', 'PORT': str(port),
+               'WEBHOOK_BASE_URL': f'http://127.0.0.1:{port}', 'TELEGRAM_API_URL': api_url, 'METRICS_TOKEN': BENCH_METRICS_TOKEN}
+        with open(os.path.join(tmpdir, 'bot.log'), 'w') as log:
+            proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(main.__file__), cwd=tmpdir,
+                                                        env=env, stdout=log, stderr=log)
+            try:
+                return await drive_updates(args, port)
+            finally:
+                proc.send_signal(signal.SIGTERM)
+                await proc.wait()
+
+
+async def drive_updates(args, port):
+    fake = args.fake
+    routes = ['menu_products', 'cat|1', 'list_products|cat|1|1'] + [f'view_product|{i}' for i in range(1, args.products + 1)]
+    url = f'http://127.0.0.1:{port}{main.TELEGRAM_WEBHOOK_PATH}'
+    headers = {'X-Telegram-Bot-Api-Secret-Token': main.WEBHOOK_SECRET}
+    await wait_until(lambda: fake.webhook, 30, "supervisor did not set the webhook")
+    counter = iter(range(1, 10 ** 9))
+    totals = {'rejected': 0}
+
+    async def send_all(session, count):
+        sem = asyncio.Semaphore(args.concurrency)
+
+        async def post(i):
+            update = callback_update(i, 10000 + i % args.chats, routes[i % len(routes)])
+            async with sem:
+                while True:
+                    async with session.post(url, json=update, headers=headers) as r:
+                        if r.status == 200:
+                            return
+                        totals['rejected'] += 1  # 503: Telegram would redeliver, and so do we
+                    await asyncio.sleep(0.05)
+        await asyncio.gather(*(post(next(counter)) for _ in range(count)))
+
+    async with aiohttp.ClientSession() as session:
+        # Warm-up: every worker imported, connected and past its first queries
+        base = fake.calls['answerCallbackQuery']
+        await send_all(session, args.chats)
+        await wait_until(lambda: fake.calls['answerCallbackQuery'] >= base + args.chats, 60, "warm-up timed out")
+        base = fake.calls['answerCallbackQuery']
+        started = time.monotonic()
+        await send_all(session, args.updates)
+        await wait_until(lambda: fake.calls['answerCallbackQuery'] >= base + args.updates, 300, "updates not handled")
+        elapsed = time.monotonic() - started
+        # Workers push their metrics to the supervisor on a timer
+        await asyncio.sleep(main.METRICS_PUSH_INTERVAL + 1)
+        async with session.get(f'http://127.0.0.1:{port}{main.METRICS_PATH}',
+                               headers={'Authorization': f'Bearer {BENCH_METRICS_TOKEN}'}) as r:
+            exposition = await r.text()
+    observed = [line.rsplit(' ', 1) for line in exposition.splitlines() if line.startswith('bot_callback_seconds_count')]
+    return {'elapsed': elapsed, 'handled': fake.calls['answerCallbackQuery'] - base, 'rejected': totals['rejected'],
+            'observed': sum(int(value) for _, value in observed),
+            'workers': len({re.sub(r',?prefix="[^"]*"', '', series) for series, _ in observed})}
+
+
+async def bench_scaling(args):
+    fake = args.fake = FakeTelegram()
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.api_port).start()
+    counts = [int(n) for n in args.processes.split(',')]
+    cores = os.cpu_count() or 1
+    print(f"{args.updates} callback updates from {args.chats} chats, {cores} CPU core(s)")
+    results = {}
+    try:
+        for n in counts:
+            results[n] = r = await run_supervisor(args, n, f'http://127.0.0.1:{args.api_port}', args.port)
+            rate = r['handled'] / r['elapsed']
+            speedup = rate / (results[counts[0]]['handled'] / results[counts[0]]['elapsed']) * counts[0]
+            print(f"  {n} process(es): {rate:7.0f} updates/s, speedup x{speedup:.2f}, "
+                  f"efficiency {speedup / n:.0%}{'' if n <= cores else ' (more processes than cores)'}"
+                  f", 503 retries {r['rejected']}")
+    finally:
+        await runner.cleanup()
+    checks = {f'{n} process(es): every update handled exactly once': r['handled'] == args.updates
+              for n, r in results.items()}
+    checks.update({f'{n} process(es): /metrics counts every callback from {n} worker(s)':
+                   r['observed'] == args.updates + args.chats and r['workers'] == n for n, r in results.items()})
+    for name, ok in checks.items():
+        print(f"  {'PASS' if ok else 'FAIL'} {name}")
+    return all(checks.values())
+
+
+SYLLABLES = ['ka', 'ro', 'mi', 'ta', 'ne', 'lo', 'vi', 'su', 'de', 'pra', 'sto', 'gor', 'lin', 'mar', 'tek', 'zor']
+
+
+def make_vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+async def seed_catalog(products, categories, vocabulary, rng):
+    """Товары со случайными названиями (3 слова) и описаниями (12 слов); частоты слов по Ципфу"""
+    weights = [1 / (i + 1) for i in range(len(vocabulary))]
+    async with main.db.write() as conn:
+        await conn.execute("INSERT INTO users(user_id,username,balance) VALUES (1,'seller',0)")
+        await conn.execute("INSERT INTO sellers(user_id,username,info) VALUES (1,'seller','')")
+        await conn.executemany("INSERT INTO categories(name) VALUES (?)", [(f"cat{i}",) for i in range(categories)])
+    batch = 5000
+    for start in range(0, products, batch):
+        rows = []
+        for _ in range(min(batch, products - start)):
+            title = ' '.join(rng.choices(vocabulary, weights, k=3))
+            desc = ' '.join(rng.choices(vocabulary, weights, k=12))
+            rows.append((title, desc, rng.randint(1, categories), rng.randint(1, 1000), main.now_iso()))
+        async with main.db.write() as conn:
+            await conn.executemany("""INSERT INTO products(seller_id,title,description,category_id,subcategory_id,price,quantity,content_text,created_at)
+                                   VALUES (1,?,?,?,NULL,?,1,'secret',?)""", rows)
+
+
+async def like_search(text, limit):
+    """Поиск до FTS: подстрока в названии или описании, без ранжирования"""
+    pattern = f"%{text}%"
+    async with main.db.read() as conn:
+        async with conn.execute("""SELECT id, title, price, quantity, category_id FROM products
+                                WHERE title LIKE ? OR description LIKE ? LIMIT ?""", (pattern, pattern, limit)) as cur:
+            return await cur.fetchall()
+
+
+async def timed(queries, search):
+    latencies = []
+    found = 0
+    for q in queries:
+        started = time.perf_counter()
+        found += len(await search(q))
+        latencies.append(time.perf_counter() - started)
+    return latencies, found / len(queries)
+
+
+async def bench_search(args):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    started = time.monotonic()
+    await seed_catalog(args.products, args.categories, vocabulary, rng)
+    print(f"seeded {args.products} products, {len(vocabulary)} words in {time.monotonic() - started:.1f}s")
+
+    limit = main.PER_PAGE
+    words = [rng.choice(vocabulary) for _ in range(args.queries)]
+    kinds = {
+        'prefix': ([w[:3] for w in words], lambda q: main.search_products(q, limit=limit)),
+        'word': (words, lambda q: main.search_products(q, limit=limit)),
+        'two words': ([f"{w} {rng.choice(vocabulary)[:4]}" for w in words], lambda q: main.search_products(q, limit=limit)),
+        'word + category': (words, lambda q: main.search_products(q, rng.randint(1, args.categories), limit=limit)),
+        'inline page 3': (words, lambda q: main.search_products(q, limit=main.INLINE_PAGE, offset=2 * main.INLINE_PAGE)),
+        'facets': (words, main.search_facets),
+        'LIKE baseline': (words, lambda q: like_search(q, limit)),
+        # No match: LIKE has to read the whole table, FTS does one index lookup
+        'miss': ([f"qq{i}" for i in range(len(words))], lambda q: main.search_products(q, limit=limit)),
+        'LIKE miss': ([f"qq{i}" for i in range(len(words))], lambda q: like_search(q, limit)),
+    }
+    for name, (queries, search) in kinds.items():
+        latencies, avg = await timed(queries, search)
+        print(f"{name:>16}: p50 {percentile(latencies, 0.5) * 1000:7.2f}ms  p99 {percentile(latencies, 0.99) * 1000:7.2f}ms"
+              f"  avg rows {avg:.1f}")
+
+    # Triggers keep the index in sync with products
+    async with main.db.read() as conn:
+        async with conn.execute("SELECT id, title FROM products WHERE id IN (1, 2, 3) ORDER BY id") as cur:
+            updated, deleted, kept = await cur.fetchall()
+    async with main.db.write() as conn:
+        await conn.execute("UPDATE products SET title='zzbenchmarker unique' WHERE id=1")
+        await conn.execute("DELETE FROM products WHERE id=2")
+        # Raises SQLITE_CORRUPT_VTAB if the index and the table disagree
+        await conn.execute("INSERT INTO products_fts(products_fts, rank) VALUES ('integrity-check', 1)")
+    checks = {
+        'updated title found by prefix': [r['id'] for r in await main.search_products("zzbench")] == [1],
+        'old title no longer matches': all(r['id'] != 1 for r in await main.search_products(updated['title'], limit=10 ** 6)),
+        'deleted product not found': all(r['id'] != 2 for r in await main.search_products(deleted['title'], limit=10 ** 6)),
+        'exact title found': any(r['id'] == 3 for r in await main.search_products(kept['title'], limit=10 ** 6)),
+        'syntax characters tolerated': await main.search_products('"* OR (') == [],
+    }
+    for name, ok in checks.items():
+        print(f"  {'PASS' if ok else 'FAIL'} {name}")
+    return all(checks.values())
+
+
+async def seed_categories(categories, subcategories):
+    async with main.db.write() as conn:
+        await conn.executemany("INSERT INTO categories(name) VALUES (?)", [(f"Категория {i:03d}",) for i in range(categories)])
+        await conn.executemany("INSERT INTO subcategories(category_id, name) VALUES (?, ?)",
+                               [(c, f"Подкатегория {c}.{j}") for c in range(1, categories + 1) for j in range(subcategories)])
+
+
+def rebuild(markup):
+    """Сборка клавиатуры заново из тех же кнопок — как до кэша для статических клавиатур"""
+    return InlineKeyboardMarkup.model_validate(markup.model_dump())
+
+
+async def per_call(fn, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        result = fn()
+        if inspect.isawaitable(result):
+            await result
+    return (time.perf_counter() - started) / iterations
+
+
+async def bench_markup(args):
+    await seed_categories(args.categories, args.subcategories)
+    await main.catalog.load()
+    cases = {
+        'main menu': (lambda: main._main_menu_markup(False), lambda: main.main_menu_markup(1)),
+        'cancel': (lambda: main.cancel_markup.__wrapped__("Отмена"), lambda: main.cancel_markup("Отмена")),
+        'back': (lambda: main.back_markup.__wrapped__("admin_cats"), lambda: main.back_markup("admin_cats")),
+        'deposit assets': (lambda: rebuild(main.DEPOSIT_MARKUP), lambda: main.DEPOSIT_MARKUP),
+        'rating': (lambda: main.rating_markup.__wrapped__(7), lambda: main.rating_markup(7)),
+        'admin panel': (lambda: rebuild(main.ADMIN_PANEL_MARKUP), lambda: main.ADMIN_PANEL_MARKUP),
+        'categories': (lambda: main.build_categories_markup.__wrapped__(browse=True),
+                       lambda: main.build_categories_markup(browse=True)),
+        'admin categories': (main.build_admin_categories_markup.__wrapped__, main.build_admin_categories_markup),
+        'category': (lambda: main.build_category_markup.__wrapped__(1), lambda: main.build_category_markup(1)),
+        'admin subcategories': (lambda: main.build_admin_subcategories_markup.__wrapped__(1),
+                                lambda: main.build_admin_subcategories_markup(1)),
+    }
+    print(f"{args.categories} categories x {args.subcategories} subcategories, {args.iterations} calls each")
+    print(f"{'keyboard':>20} {'build':>10} {'cached':>10} {'json':>10}")
+    for name, (build, cached) in cases.items():
+        built = await per_call(build, args.iterations)
+        hit = await per_call(cached, args.iterations)
+        markup = cached()
+        markup = (await markup) if inspect.isawaitable(markup) else markup
+        markup = markup[1] if isinstance(markup, tuple) else markup
+        # aiogram serializes the keyboard on every send; shown for scale
+        dumped = await per_call(lambda: markup.model_dump_json(exclude_none=True), args.iterations)
+        print(f"{name:>20} {built * 1e6:8.1f}us {hit * 1e6:8.1f}us {dumped * 1e6:8.1f}us")
+    print(f"markups {main.markups.stats()}")
+    print(f"catalog {main.catalog.stats()}")
+
+    def has_button(markup, text):
+        return any(b.text == text for row in markup.inline_keyboard for b in row)
+
+    async with main.db.write() as conn:
+        cur = await conn.execute("INSERT INTO categories(name) VALUES ('Новая')")
+        new_id = cur.lastrowid
+    stale = has_button(await main.build_categories_markup(browse=True), "📁 Новая")
+    # Admin flows write through to the tree, which drops the cached keyboards
+    main.catalog.add_category(new_id, 'Новая')
+    fresh = has_button(await main.build_categories_markup(browse=True), "📁 Новая")
+    # Another process's edit: only the trigger-maintained catalog version tells
+    main.MULTIPROCESS = True
+    await main.build_categories_markup(browse=True)
+    async with main.db.write() as conn:
+        await conn.execute("UPDATE categories SET name='Переименованная' WHERE name='Новая'")
+    main.catalog.checked = 0.0
+    renamed = has_button(await main.build_categories_markup(browse=True), "📁 Переименованная")
+    main.MULTIPROCESS = False
+    checks = {
+        'cached until invalidated': not stale,
+        'rebuilt after write-through': fresh,
+        'rebuilt on catalog version change': renamed,
+    }
+    for name, ok in checks.items():
+        print(f"  {'PASS' if ok else 'FAIL'} {name}")
+    return all(checks.values())
+
+
+async def view_card(pid):
+    """Путь show_product_card без отправки в Telegram"""
+    card = await main.product_cards.get(pid)
+    if card is None:
+        generation = main.product_cards.generation
+        card = await main.render_product_card(pid)
+        main.product_cards.set(pid, card, generation)
+    return card
+
+
+async def bench_cards(args):
+    rng = random.Random(args.seed)
+    await seed_market(args.products, stock=10 ** 6, price=1)
+    async with main.db.write() as conn:
+        await conn.execute("INSERT INTO users(user_id,username,balance) VALUES (2,'buyer',?)", (10 ** 9,))
+        await conn.executemany("""INSERT INTO reviews(product_id,user_id,username,rating,text,created_at,seller_id)
+                               VALUES (?,2,'buyer',?,'',?,1)""",
+                               [(rng.randint(1, args.products), rng.randint(1, 5), main.now_iso()) for _ in range(args.products)])
+    # Popularity of listings follows Zipf: a few hot products get most views
+    weights = [1 / (i + 1) for i in range(args.products)]
+    views = rng.choices(range(1, args.products + 1), weights, k=args.views)
+
+    uncached = []
+    for pid in views:
+        started = time.perf_counter()
+        await main.render_product_card(pid)
+        uncached.append(time.perf_counter() - started)
+    cached = []
+    for i, pid in enumerate(views):
+        if args.buy_every and i % args.buy_every == 0:
+            await main.purchases.buy(2, pid)
+        started = time.perf_counter()
+        await view_card(pid)
+        cached.append(time.perf_counter() - started)
+    print(f"{args.products} products, {args.views} views, a purchase every {args.buy_every} views, "
+          f"cache size {main.PRODUCT_CARD_CACHE_SIZE}")
+    for name, latencies in (('uncached', uncached), ('cached', cached)):
+        print(f"{name:>10}: p50 {percentile(latencies, 0.5) * 1e6:8.1f}us  p99 {percentile(latencies, 0.99) * 1e6:8.1f}us"
+              f"  total {sum(latencies):.2f}s")
+    stats = main.product_cards.stats()
+    print(f"cards {stats}")
+
+    def quantity(card):
+        return int(re.search(r"Количество: (\d+)", card[0]).group(1))
+
+    before = quantity(await view_card(1))
+    await main.purchases.buy(2, 1)
+    after_purchase = quantity(await view_card(1))
+    # Another process's edit: only card_changes tells
+    main.MULTIPROCESS = True
+    main.product_cards.checked = 0.0
+    await view_card(1)
+    async with main.db.write() as conn:
+        await conn.execute("UPDATE products SET price=777 WHERE id=1")
+    main.product_cards.checked = 0.0
+    repriced = "777.00 RUB" in (await view_card(1))[0]
+    main.MULTIPROCESS = False
+    checks = {
+        'size bounded': stats['size'] <= main.PRODUCT_CARD_CACHE_SIZE,
+        'stock updated after purchase': after_purchase == before - 1,
+        "other process's edit picked up": repriced,
+    }
+    for name, ok in checks.items():
+        print(f"  {'PASS' if ok else 'FAIL'} {name}")
+    return all(checks.values())
+
+
+async def run(args):
+    if not args.db:
+        return await args.func(args)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await open_temp_db(tmpdir)
+        try:
+            return await args.func(args)
+        finally:
+            await main.db.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочные проверки Mexanick Market")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('purchase', help="параллельные покупки: нет перепродаж и ухода баланса в минус")
+    p.add_argument('--buyers', type=int, default=300)
+    p.add_argument('--attempts', type=int, default=3, help="покупок на покупателя")
+    p.add_argument('--products', type=int, default=1)
+    p.add_argument('--stock', type=int, default=100, help="остаток каждого товара")
+    p.add_argument('--funds', type=int, default=2, help="на сколько покупок хватает баланса")
+    p.add_argument('--poor', type=float, default=0.1, help="доля покупателей без денег на покупку")
+    p.add_argument('--legacy', action='store_true')
+    p.set_defaults(func=bench_purchase, db=True)
+
+    p = sub.add_parser('routing', help="цена маршрутизации callback_query на одно обновление")
+    p.add_argument('--updates', type=int, default=20000)
+    p.set_defaults(func=bench_routing, db=False)
+
+    p = sub.add_parser('scaling', help="супервизор с N процессами: обновления/с через вебхук, Bot API подменён")
+    p.add_argument('--processes', default=','.join(str(n) for n in sorted({1, 2, os.cpu_count() or 1})),
+                   help="список числа обработчиков через запятую")
+    p.add_argument('--updates', type=int, default=3000)
+    p.add_argument('--chats', type=int, default=200)
+    p.add_argument('--products', type=int, default=20)
+    p.add_argument('--concurrency', type=int, default=64, help="одновременных запросов к вебхуку")
+    p.add_argument('--port', type=int, default=18080)
+    p.add_argument('--api-port', type=int, default=18081)
+    p.set_defaults(func=bench_scaling, db=False)
+
+    p = sub.add_parser('search', help="полнотекстовый поиск: задержка запросов на большом каталоге")
+    p.add_argument('--products', type=int, default=100000)
+    p.add_argument('--categories', type=int, default=30)
+    p.add_argument('--vocabulary', type=int, default=5000, help="различных слов в названиях и описаниях")
+    p.add_argument('--queries', type=int, default=300, help="запросов каждого вида")
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=bench_search, db=True)
+
+    p = sub.add_parser('markup', help="цена сборки клавиатур на один callback: с кэшем и без")
+    p.add_argument('--categories', type=int, default=40)
+    p.add_argument('--subcategories', type=int, default=8, help="подкатегорий в каждой категории")
+    p.add_argument('--iterations', type=int, default=2000)
+    p.set_defaults(func=bench_markup, db=True)
+
+    p = sub.add_parser('cards', help="карточка товара: рендер из БД против кэша при популярности по Ципфу")
+    p.add_argument('--products', type=int, default=20000)
+    p.add_argument('--views', type=int, default=50000)
+    p.add_argument('--buy-every', type=int, default=50, help="покупка (сброс карточки) на каждые N просмотров; 0 — без покупок")
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=bench_cards, db=True)
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    ok = asyncio.run(run(args))
+    sys.exit(0 if ok in (None, True) else 1)
+
+
+if __name__ == '__main__':
+    main_cli()
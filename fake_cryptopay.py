@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальная подмена Crypto Pay API для проверки оплаты без сети.
+
+    python fake_cryptopay.py --port 8090 --webhook http://127.0.0.1:8080/cryptopay/webhook
+    CRYPTO_PAY_URL=http://127.0.0.1:8090/api python main.py
+    curl -X POST http://127.0.0.1:8090/fake/pay/1            # оплата + подписанный вебхук
+    curl -X POST 'http://127.0.0.1:8090/fake/pay/2?webhook=0' # оплата без вебхука (проверка сверки)
+"""
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger("fake_cryptopay")
+
+
+def sign(token, body: bytes) -> str:
+    secret = hashlib.sha256(token.encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeCryptoPay:
+    """Счета в памяти; createInvoice/getInvoices в формате Crypto Pay"""
+
+    def __init__(self, token, webhook_url=None):
+        self.token = token
+        self.webhook_url = webhook_url
+        self.invoices = {}
+        self._ids = itertools.count(1)
+        self._updates = itertools.count(1)
+
+    def app(self):
+        app = web.Application(middlewares=[self.auth])
+        app.router.add_route('*', '/api/createInvoice', self.create_invoice)
+        app.router.add_get('/api/getInvoices', self.get_invoices)
+        app.router.add_post('/fake/pay/{invoice_id}', self.pay)
+        return app
+
+    @web.middleware
+    async def auth(self, request, handler):
+        if request.path.startswith('/api/') and request.headers.get('Crypto-Pay-API-Token') != self.token:
+            return web.json_response({'ok': False, 'error': {'code': 401, 'name': 'UNAUTHORIZED'}}, status=401)
+        return await handler(request)
+
+    async def create_invoice(self, request):
+        params = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.json())
+        invoice_id = next(self._ids)
+        inv = {
+            'invoice_id': invoice_id,
+            'hash': f"IV{invoice_id:08d}",
+            'currency_type': 'crypto',
+            'asset': params['asset'],
+            'amount': str(params['amount']),
+            'description': params.get('description', ''),
+            'status': 'active',
+            'created_at': now_iso(),
+            'bot_invoice_url': f"https://t.me/CryptoBot?start=IV{invoice_id:08d}",
+        }
+        self.invoices[invoice_id] = inv
+        return web.json_response({'ok': True, 'result': inv})
+
+    async def get_invoices(self, request):
+        q = request.query
+        items = list(self.invoices.values())
+        if q.get('invoice_ids'):
+            wanted = {int(i) for i in q['invoice_ids'].split(',')}
+            items = [i for i in items if i['invoice_id'] in wanted]
+        if q.get('status'):
+            items = [i for i in items if i['status'] == q['status']]
+        offset = int(q.get('offset', 0))
+        count = min(int(q.get('count', 100)), 1000)
+        return web.json_response({'ok': True, 'result': {'items': items[offset:offset + count]}})
+
+    async def pay(self, request):
+        inv = self.invoices.get(int(request.match_info['invoice_id']))
+        if inv is None:
+            raise web.HTTPNotFound()
+        inv.update(status='paid', paid_at=now_iso(), paid_asset=inv['asset'], paid_amount=inv['amount'])
+        delivered = None
+        if self.webhook_url and request.query.get('webhook') != '0':
+            delivered = await self.send_webhook(inv)
+        return web.json_response({'ok': True, 'result': inv, 'webhook_status': delivered})
+
+    async def send_webhook(self, inv):
+        update = {'update_id': next(self._updates), 'update_type': 'invoice_paid',
+                  'request_date': now_iso(), 'payload': inv}
+        body = json.dumps(update).encode()
+        headers = {'Content-Type': 'application/json', 'crypto-pay-api-signature': sign(self.token, body)}
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(self.webhook_url, data=body, headers=headers) as r:
+                    logger.info("webhook invoice %s -> HTTP %s", inv['invoice_id'], r.status)
+                    return r.status
+        except aiohttp.ClientError as e:
+            logger.warning("webhook invoice %s failed: %s", inv['invoice_id'], e)
+            return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--webhook', help="URL вебхука бота, например http://127.0.0.1:8080/cryptopay/webhook")
+    parser.add_argument('--token', help="токен Crypto Pay (по умолчанию CRYPTO_TOKEN из main.py)")
+    args = parser.parse_args()
+    token = args.token
+    if token is None:
+        from main import CRYPTO_TOKEN
+        token = CRYPTO_TOKEN
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    web.run_app(FakeCryptoPay(token, args.webhook).app(), port=args.port)
+
+
+if __name__ == '__main__':
+    main()
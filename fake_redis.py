@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальная подмена Redis (RESP2/RESP3, команды для FSM-хранилища aiogram) для проверки без сервера.
+
+    python fake_redis.py --port 6390
+    FSM_STORAGE=redis FSM_REDIS_URL=redis://127.0.0.1:6390/0 python main.py
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("fake_redis")
+
+
+class FakeRedis:
+    """Строки с истечением срока в памяти; поддержан минимум команд RedisStorage"""
+
+    def __init__(self):
+        self.data = {}  # key -> (value, expires_at monotonic or None)
+        self.commands = 0
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, name, args):
+        self.commands += 1
+        handler = getattr(self, 'cmd_' + name.lower(), None)
+        if handler is None:
+            return RespError(f"ERR unknown command '{name}'")
+        try:
+            return handler(*args)
+        except (TypeError, ValueError, IndexError):
+            return RespError(f"ERR wrong arguments for '{name}' command")
+
+    def cmd_ping(self, message=None):
+        return message if message is not None else Simple("PONG")
+
+    def cmd_select(self, index):
+        return Simple("OK")
+
+    def cmd_client(self, *args):
+        return Simple("OK")
+
+    def cmd_get(self, key):
+        return self._get(key)
+
+    def cmd_set(self, key, value, *options):
+        expires_at = None
+        opts = [o.upper() if isinstance(o, bytes) else o for o in options]
+        i = 0
+        while i < len(opts):
+            if opts[i] == b'EX':
+                expires_at = time.monotonic() + int(opts[i + 1])
+                i += 2
+            elif opts[i] == b'PX':
+                expires_at = time.monotonic() + int(opts[i + 1]) / 1000
+                i += 2
+            elif opts[i] == b'NX':
+                if self._get(key) is not None:
+                    return None
+                i += 1
+            elif opts[i] == b'XX':
+                if self._get(key) is None:
+                    return None
+                i += 1
+            else:
+                raise ValueError(opts[i])
+        self.data[key] = (value, expires_at)
+        return Simple("OK")
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._get(key) is not None:
+                del self.data[key]
+                removed += 1
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._get(key) is not None)
+
+    def cmd_ttl(self, key):
+        if self._get(key) is None:
+            return -2
+        expires_at = self.data[key][1]
+        return -1 if expires_at is None else int(expires_at - time.monotonic())
+
+    def cmd_dbsize(self):
+        return sum(1 for key in list(self.data) if self._get(key) is not None)
+
+    def cmd_flushdb(self, *args):
+        self.data.clear()
+        return Simple("OK")
+
+    cmd_flushall = cmd_flushdb
+
+    async def handle(self, reader, writer):
+        proto = 2
+        try:
+            while True:
+                command = await read_command(reader)
+                if command is None:
+                    break
+                name = command[0].decode().upper()
+                if name == 'QUIT':
+                    writer.write(b"+OK\r\n")
+                    break
+                if name == 'HELLO':
+                    # Protocol is negotiated per connection; redis-py 6+ asks for RESP3
+                    requested = int(command[1]) if len(command) > 1 else proto
+                    if requested not in (2, 3):
+                        reply = RespError("NOPROTO unsupported protocol version")
+                    else:
+                        proto = requested
+                        reply = {'server': 'redis', 'version': '7.0.0', 'proto': proto, 'mode': 'standalone'}
+                else:
+                    reply = self.execute(name, command[1:])
+                writer.write(encode(reply, proto))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class Simple(str):
+    pass
+
+
+class RespError(str):
+    pass
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # Inline command, e.g. from telnet
+        return line.split()
+    args = []
+    for _ in range(int(line[1:])):
+        size = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(size + 2))[:-2])
+    return args
+
+
+def encode(value, proto=2):
+    if value is None:
+        return b"_\r\n" if proto == 3 else b"$-1\r\n"
+    if isinstance(value, dict):
+        prefix = b"%%%d\r\n" if proto == 3 else b"*%d\r\n"
+        size = len(value) if proto == 3 else 2 * len(value)
+        return prefix % size + b"".join(encode(k, proto) + encode(v, proto) for k, v in value.items())
+    if isinstance(value, RespError):
+        return f"-{value}\r\n".encode()
+    if isinstance(value, Simple):
+        return f"+{value}\r\n".encode()
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, str):
+        value = value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+async def serve(port):
+    server = await asyncio.start_server(FakeRedis().handle, '127.0.0.1', port)
+    logger.info("fake redis on 127.0.0.1:%d", port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(serve(args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальная подмена Telegram Bot API для проверки бота без сети.
+
+    python fake_telegram.py --port 8081
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+    curl -X POST http://127.0.0.1:8081/fake/updates -d '[{"update_id":1,"message":{...}}]'  # для getUpdates
+    curl http://127.0.0.1:8081/fake/stats                                                 # вызовы по методам
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import time
+from collections import Counter
+
+from aiohttp import web
+
+logger = logging.getLogger("fake_telegram")
+
+MESSAGE_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText', 'editMessageCaption',
+                   'editMessageMedia', 'editMessageReplyMarkup'}
+CONTENT_FIELDS = ('text', 'caption', 'media', 'reply_markup')
+
+
+class FakeTelegram:
+    """Отвечает на вызовы Bot API правдоподобными результатами и считает их"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.started = time.monotonic()
+        self.pending = []  # updates for getUpdates
+        self.arrived = asyncio.Event()
+        self.webhook = None
+        self.messages = {}  # (chat_id, message_id) -> content, to refuse no-op edits like Telegram does
+        self._message_ids = itertools.count(1)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.method)
+        app.router.add_post('/fake/updates', self.push_updates)
+        app.router.add_get('/fake/stats', self.stats)
+        return app
+
+    async def method(self, request):
+        name = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[name] += 1
+        if name == 'getUpdates':
+            return await self.get_updates(params)
+        if name == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        elif name in MESSAGE_METHODS:
+            chat_id = params.get('chat_id', 0)
+            message_id = int(params.get('message_id') or next(self._message_ids))
+            content = {k: params[k] for k in CONTENT_FIELDS if k in params}
+            key = (str(chat_id), message_id)
+            if name.startswith('edit'):
+                if {**self.messages.get(key, {}), **content} == self.messages.get(key):
+                    self.calls['not_modified'] += 1
+                    return web.json_response({'ok': False, 'error_code': 400, 'description':
+                                              'Bad Request: message is not modified: specified new message content '
+                                              'and reply markup are exactly the same as a current content and reply '
+                                              'markup of the message'}, status=400)
+                content = {**self.messages.get(key, {}), **content}
+            self.messages[key] = content
+            result = {'message_id': message_id, 'date': int(time.time()),
+                      'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, 'type': 'private'},
+                      'text': params.get('text', '')}
+            if name == 'sendPhoto':
+                result.update(photo=[{'file_id': str(params.get('photo')), 'file_unique_id': 'u', 'width': 1, 'height': 1}],
+                              caption=params.get('caption', ''))
+                del result['text']
+        elif name == 'setWebhook':
+            self.webhook = params.get('url')
+            result = True
+        elif name == 'deleteWebhook':
+            self.webhook = None
+            result = True
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        self.pending = [u for u in self.pending if u['update_id'] >= offset]
+        if not self.pending:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response({'ok': True, 'result': self.pending[:100]})
+
+    async def push_updates(self, request):
+        data = await request.json()
+        self.pending.extend(data if isinstance(data, list) else [data])
+        self.arrived.set()
+        return web.json_response({'ok': True, 'queued': len(self.pending)})
+
+    async def stats(self, request):
+        return web.json_response({'calls': dict(self.calls), 'webhook': self.webhook,
+                                  'uptime': time.monotonic() - self.started})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    web.run_app(FakeTelegram().app(), port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2467 +1,4947 @@
-#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-"""
-Mexanick Market
-"""
-import asyncio
-import logging
-import os
-from datetime import datetime
-import pytz
-import requests
-from aiogram import Bot, Dispatcher, types, executor
-from aiogram.filters import CommandStart
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Message
-import aiosqlite
-import sqlite3
-from aiohttp import web
-
-# ---------------- CONFIG ----------------
-BOT_TOKEN = "8379265766:AAEz5DHkaF3o-edaSR2jJftRpBPADUmo6ds"           
-CRYPTO_TOKEN = "369438:AAEKsbWPZPQ0V3YNV4O0GHcWTvSbzkEar43"       
-ADMIN_ID = 1041720539                       
-ADMIN_USERNAME = "@mexanickq"
-DB_FILE = "mexanick_market.db"
-MARKET_NAME = "💎Mexanick Market💎"
-CRYPTO_PAY_URL = 'https://pay.crypt.bot/api'
-CRYPTO_ASSETS = ['USDT','BTC','ETH','TON','TRX']
-ASSET_MAP = {'USDT':'tether','BTC':'bitcoin','ETH':'ethereum','TON':'the-open-network','TRX':'tron'}
-PORT = 8080  # Порт для веб-сервера
-# ----------------------------------------
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-
-# ---------------- States ----------------
-class DepositState(StatesGroup):
-    asset = State()
-    amount = State()
-
-class SellerCreate(StatesGroup):
-    info = State()
-
-class SellerEditInfo(StatesGroup):
-    info = State()
-
-class AddProduct(StatesGroup):
-    photo = State()
-    title = State()
-    desc = State()
-    price = State()
-    quantity = State()
-    content = State()
-
-class EditProduct(StatesGroup):
-    field = State()
-    value = State()
-
-class AdminNewCategory(StatesGroup):
-    name = State()
-
-class AdminEditCategory(StatesGroup):
-    cat_id = State()
-    name = State()
-
-class AdminNewSub(StatesGroup):
-    name = State()
-
-class AdminEditSub(StatesGroup):
-    sub_id = State()
-    name = State()
-
-class AdminSearchUser(StatesGroup):
-    user_id = State()
-
-class AdminBalanceChange(StatesGroup):
-    amount = State()
-
-class AdminProdSearch(StatesGroup):
-    prod_id = State()
-
-class AdminEditProduct(StatesGroup):
-    name = State()
-    desc = State()
-
-class ReviewState(StatesGroup):
-    rating = State()
-    text = State()
-
-class DisputeState(StatesGroup):
-    description = State()
-
-class AdminCloseDispute(StatesGroup):
-    reason = State()
-
-class SettingsState(StatesGroup):
-    action = State()
-
-# ---------------- Database helpers ----------------
-async def init_db():
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        await conn.executescript("""
-        CREATE TABLE IF NOT EXISTS users(
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            balance REAL DEFAULT 0.0,
-            notify_enabled INTEGER DEFAULT 1
-        );
-        CREATE TABLE IF NOT EXISTS invoices(
-            invoice_id INTEGER PRIMARY KEY,
-            user_id INTEGER,
-            amount REAL,
-            asset TEXT,
-            status TEXT DEFAULT 'unpaid',
-            hash TEXT,
-            created_at TEXT
-        );
-        CREATE TABLE IF NOT EXISTS categories(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE
-        );
-        CREATE TABLE IF NOT EXISTS subcategories(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            category_id INTEGER,
-            name TEXT
-        );
-        CREATE TABLE IF NOT EXISTS sellers(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            username TEXT,
-            info TEXT
-        );
-        CREATE TABLE IF NOT EXISTS products(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            seller_id INTEGER,
-            title TEXT,
-            description TEXT,
-            photo_file_id TEXT,
-            category_id INTEGER,
-            subcategory_id INTEGER,
-            price REAL,
-            quantity INTEGER DEFAULT 1,
-            content_text TEXT,
-            content_file_id TEXT,
-            created_at TEXT
-        );
-        CREATE TABLE IF NOT EXISTS reviews(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER,
-            user_id INTEGER,
-            username TEXT,
-            rating INTEGER,
-            text TEXT,
-            created_at TEXT
-        );
-        CREATE TABLE IF NOT EXISTS disputes(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            order_id INTEGER,
-            user_id INTEGER,
-            description TEXT,
-            status TEXT DEFAULT 'open',
-            created_at TEXT,
-            close_reason TEXT
-        );
-        CREATE TABLE IF NOT EXISTS settings(
-            key TEXT PRIMARY KEY,
-            value TEXT
-        );
-        CREATE TABLE IF NOT EXISTS orders(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            product_id INTEGER,
-            seller_id INTEGER,
-            price REAL,
-            created_at TEXT
-        );
-        INSERT OR IGNORE INTO settings(key,value) VALUES ('maintenance','off');
-        """)
-        await conn.commit()
-
-# ---------------- Utility ----------------
-def now_iso():
-    msk_tz = pytz.timezone('Europe/Moscow')
-    return datetime.now(msk_tz).isoformat()
-
-async def is_maintenance():
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT value FROM settings WHERE key='maintenance'") as cur:
-            r = await cur.fetchone()
-            return r and r['value'] == 'on'
-
-async def maintenance_block(message: types.Message | CallbackQuery):
-    if await is_maintenance():
-        text = "🛠️ Сейчас идут технические работы. Попробуйте позже."
-        if isinstance(message, CallbackQuery):
-            await message.answer(text)
-            await bot.send_message(message.message.chat.id, text)
-        else:
-            await message.answer(text)
-        return True
-    return False
-
-async def ensure_user_record(user: types.User):
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("INSERT OR IGNORE INTO users(user_id,username,balance,notify_enabled) VALUES (?,?,?,?)", 
-                         (user.id, user.username, 0.0, 1))
-        await conn.execute("UPDATE users SET username = ? WHERE user_id = ?", (user.username, user.id))
-        await conn.commit()
-
-async def is_notify_enabled(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT notify_enabled FROM users WHERE user_id=?", (user_id,)) as cur:
-            r = await cur.fetchone()
-            return r['notify_enabled'] == 1 if r else True
-
-def format_money(amount):
-    return f"{amount:.2f} RUB"
-
-# ---------------- MARKUP HELPER ----------------
-def simple_markup(buttons_list):
-    """Создаёт InlineKeyboardMarkup для aiogram 3.20.0"""
-    inline_keyboard = []
-    for row in buttons_list:
-        if isinstance(row, list):
-            inline_keyboard.append(row)
-        else:
-            inline_keyboard.append([row])
-    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
-
-# ---------------- Inline markups ----------------
-def main_menu_markup(user_id: int):
-    buttons = [
-        [
-            InlineKeyboardButton(text="💰 Баланс", callback_data="menu_balance"),
-            InlineKeyboardButton(text= "💸 Пополнить", callback_data="menu_deposit")
-        ],
-        [
-            InlineKeyboardButton(text="🛍 Товары", callback_data="menu_products"),
-            InlineKeyboardButton(text="➕ Продать", callback_data="menu_sell")
-        ],
-        [
-            InlineKeyboardButton(text="📋 Мои покупки", callback_data="menu_my_orders"),
-            InlineKeyboardButton(text="📞 Поддержка", callback_data="menu_support")
-        ],
-        [InlineKeyboardButton(text="⚙️ Настройки", callback_data="menu_settings")]
-    ]
-    if user_id == ADMIN_ID:
-        buttons.append([InlineKeyboardButton(text="🔧 Админ панель", callback_data="menu_admin")])
-    return simple_markup(buttons)
-
-def cancel_markup(text="Отмена"):
-    return simple_markup([InlineKeyboardButton(text="❌ " + text, callback_data="action_cancel")])
-
-async def build_categories_markup(admin_view=False):
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id,name FROM categories ORDER BY name") as cur:
-            cats = await cur.fetchall()
-    
-    buttons = []
-    for c in cats:
-        buttons.append([InlineKeyboardButton(text=f"📁 {c['name']}", callback_data=f"cat|{c['id']}")])
-    
-    if admin_view:
-        buttons.append([InlineKeyboardButton(text="➕ Создать категорию", callback_data="admin_create_category")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")])
-    
-    return simple_markup(buttons)
-
-async def build_admin_categories_markup():
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id,name FROM categories ORDER BY name") as cur:
-            cats = await cur.fetchall()
-    
-    buttons = []
-    for c in cats:
-        buttons.append([
-            InlineKeyboardButton(text=f"📁 {c['name']}", callback_data=f"admin_view_cat|{c['id']}"),
-            InlineKeyboardButton(text="✏️", callback_data=f"admin_edit_cat|{c['id']}"),
-            InlineKeyboardButton(text="🗑", callback_data=f"admin_delete_cat|{c['id']}")
-        ])
-    buttons.append([InlineKeyboardButton(text="➕ Создать категорию", callback_data="admin_create_category")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")])
-    
-    return simple_markup(buttons)
-
-async def build_admin_subcategories_markup(cat_id):
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id,name FROM subcategories WHERE category_id=? ORDER BY name", (cat_id,)) as cur:
-            subs = await cur.fetchall()
-    
-    buttons = []
-    for s in subs:
-        buttons.append([
-            InlineKeyboardButton(text=f"📂 {s['name']}", callback_data=f"list_products|sub|{s['id']}|1"),
-            InlineKeyboardButton(text="✏️", callback_data=f"admin_edit_sub|{s['id']}"),
-            InlineKeyboardButton(text="🗑", callback_data=f"admin_delete_sub|{s['id']}")
-        ])
-    buttons.append([InlineKeyboardButton(text="➕ Создать подкатегорию", callback_data=f"admin_create_sub|{cat_id}")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")])
-    
-    return simple_markup(buttons)
-
-# ---------------- Crypto ----------------
-def crypto_headers():
-    return {'Crypto-Pay-API-Token': CRYPTO_TOKEN, 'Content-Type': 'application/json'}
-
-def get_rate(asset):
-    coin_id = ASSET_MAP.get(asset)
-    if not coin_id:
-        raise ValueError("Unknown asset")
-    try:
-        r = requests.get(f'https://api.coingecko.com/api/v3/simple/price?ids={coin_id}&vs_currencies=rub', timeout=8)
-        r.raise_for_status()
-        data = r.json()
-        return float(data[coin_id]['rub'])
-    except Exception:
-        return 100.0
-
-def create_invoice(asset, amount, description, user_id):
-    payload = {'asset': asset, 'amount': str(amount), 'description': description}
-    try:
-        r = requests.post(f'{CRYPTO_PAY_URL}/createInvoice', json=payload, headers=crypto_headers(), timeout=10)
-        r.raise_for_status()
-        resp = r.json()
-        if resp.get('ok'):
-            inv = resp['result']
-            asyncio.create_task(save_invoice_db(int(inv['invoice_id']), user_id, amount, asset, inv.get('hash')))
-        return resp
-    except Exception as e:
-        logging.error("create_invoice error: %s", e)
-        return {'ok': False, 'error': str(e)}
-
-async def save_invoice_db(invoice_id, user_id, amount, asset, hash_val):
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("INSERT OR IGNORE INTO invoices(invoice_id,user_id,amount,asset,hash,created_at) VALUES (?,?,?,?,?,?)",
-                           (invoice_id, user_id, amount, asset, hash_val, now_iso()))
-        await conn.commit()
-
-def get_invoices(invoice_ids):
-    try:
-        payload = {'invoice_ids': ','.join(map(str, invoice_ids))}
-        r = requests.get(f'{CRYPTO_PAY_URL}/getInvoices', params=payload, headers=crypto_headers(), timeout=10)
-        r.raise_for_status()
-        return r.json()
-    except Exception as e:
-        logging.error("get_invoices error: %s", e)
-        return {'ok': False, 'error': str(e)}
-
-async def background_payment_checker():
-    while True:
-        try:
-            async with aiosqlite.connect(DB_FILE) as conn:
-                conn.row_factory = aiosqlite.Row
-                async with conn.execute("SELECT invoice_id FROM invoices WHERE status='unpaid'") as cur:
-                    rows = await cur.fetchall()
-            if rows:
-                invoice_ids = [r['invoice_id'] for r in rows]
-                resp = get_invoices(invoice_ids)
-                if resp.get('ok'):
-                    items = resp['result'].get('items', [])
-                    for it in items:
-                        if it.get('status') == 'paid':
-                            invoice_id = int(it['invoice_id'])
-                            async with aiosqlite.connect(DB_FILE) as conn:
-                                conn.row_factory = aiosqlite.Row
-                                async with conn.execute("SELECT user_id,amount,asset FROM invoices WHERE invoice_id=?", (invoice_id,)) as cur:
-                                    row = await cur.fetchone()
-                                if row:
-                                    user_id, amount, asset = row['user_id'], row['amount'], row['asset']
-                                    try:
-                                        rate = get_rate(asset)
-                                        rub_amount = float(amount) * float(rate)
-                                    except Exception:
-                                        rub_amount = 0.0
-                                    await conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (rub_amount, user_id))
-                                    await conn.execute("UPDATE invoices SET status='paid' WHERE invoice_id=?", (invoice_id,))
-                                    await conn.commit()
-                                    if await is_notify_enabled(user_id):
-                                        try:
-                                            await bot.send_message(user_id, f"🎉 Платёж подтверждён — баланс пополнен на {rub_amount:.2f} RUB")
-                                        except Exception:
-                                            pass
-        except Exception as e:
-            logging.error("Payment checker loop error: %s", e)
-        await asyncio.sleep(20)
-
-# ---------------- Web Server ----------------
-async def health_check(request):
-    return web.Response(text="Bot is running")
-
-async def run_web_server():
-    app = web.Application()
-    app.router.add_get('/', health_check)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', PORT)
-    await site.start()
-    logger.info(f"Веб-сервер запущен на порту {PORT}")
-
-async def on_startup(_):
-    if not os.path.exists("media"):
-        os.makedirs("media")
-    asyncio.create_task(background_payment_checker())
-    asyncio.create_task(run_web_server())
-    logger.info("Бот запущен и готов к работе")
-
-# ---------------- Handlers ----------------
-@dp.message(CommandStart())
-async def handler_start(message: Message):
-    if await maintenance_block(message): return
-    await ensure_user_record(message.from_user)
-    await message.answer(f"👋 Добро пожаловать в *{MARKET_NAME}*!\nВыберите действие ниже:", 
-                        parse_mode="Markdown", 
-                        reply_markup=main_menu_markup(message.from_user.id))
-
-# --- Balance & deposit ---
-@dp.callback_query(lambda c: c.data == "menu_balance")
-async def cb_balance(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    await ensure_user_record(callback.from_user)
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT balance FROM users WHERE user_id=?", (callback.from_user.id,)) as cur:
-            bal = (await cur.fetchone())['balance']
-    text = f"💰 Ваш баланс: *{format_money(bal)}*"
-    markup = simple_markup([
-        [InlineKeyboardButton(text="💸 Пополнить", callback_data="menu_deposit")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
-    ])
-    await callback.message.answer(text, parse_mode="Markdown", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data == "menu_deposit")
-async def cb_deposit(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    markup = simple_markup([
-        [InlineKeyboardButton(text="USDT", callback_data="deposit_asset|USDT"), 
-         InlineKeyboardButton(text="BTC", callback_data="deposit_asset|BTC")],
-        [InlineKeyboardButton(text="ETH", callback_data="deposit_asset|ETH"), 
-         InlineKeyboardButton(text="TON", callback_data="deposit_asset|TON")],
-        [InlineKeyboardButton(text="TRX", callback_data="deposit_asset|TRX")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
-    ])
-    await callback.message.answer("💸 Выберите валюту для пополнения (через CryptoBot):", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("deposit_asset|"))
-async def cb_deposit_asset(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    asset = callback.data.split("|", 1)[1]
-    await state.set_state(DepositState.amount)
-    await state.set_data({"asset": asset})
-    await callback.message.answer(f"💸 Введите сумму в RUB, которую хотите пополнить через *{asset}*:", 
-                                parse_mode="Markdown", reply_markup=cancel_markup())
-    await callback.answer()
-
-@dp.message(DepositState.amount)
-async def process_deposit_amount(message: Message, state: FSMContext):
-    data = await state.get_data()
-    asset = data.get("asset")
-    if message.text.strip().lower() in ["отмена", "cancel", "❌"]:
-        await message.answer("❌ Пополнение отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    try:
-        rub = float(message.text.strip().replace(',', '.'))
-        if rub <= 0:
-            raise ValueError("<=0")
-    except Exception:
-        await message.answer("❌ Неверная сумма. Введите число (например 1000.50).", reply_markup=cancel_markup())
-        return
-    try:
-        rate = get_rate(asset)
-        crypto_amount = rub / rate
-    except Exception:
-        await message.answer("❌ Не удалось получить курс. Попробуйте позже.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    resp = create_invoice(asset, crypto_amount, f"Пополнение {MARKET_NAME} для {message.from_user.id}", message.from_user.id)
-    if resp.get('ok'):
-        inv = resp['result']
-        pay_url = f"https://t.me/CryptoBot/app?startapp=invoice-{inv.get('hash')}&mode=compact"
-        markup = simple_markup([
-            [InlineKeyboardButton(text="💳 Оплатить", url=pay_url)],
-            [InlineKeyboardButton(text="❌ Отменить", callback_data=f"invoice_cancel|{inv.get('invoice_id')}")]
-        ])
-        await message.answer(f"💳 Счет создан:\nСумма: *{rub:.2f} RUB* (~{crypto_amount:.6f} {asset})\nНажмите кнопку для оплаты (CryptoBot).", 
-                           parse_mode="Markdown", reply_markup=markup)
-    else:
-        await message.answer(f"❌ Ошибка создания счета: {resp.get('error')}", reply_markup=main_menu_markup(message.from_user.id))
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("invoice_cancel|"))
-async def cb_invoice_cancel(callback: CallbackQuery):
-    inv_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT user_id,status FROM invoices WHERE invoice_id=?", (inv_id,)) as cur:
-            r = await cur.fetchone()
-        if not r:
-            await callback.message.answer("Счет не найден.")
-            await callback.answer()
-            return
-        if r['user_id'] != callback.from_user.id:
-            await callback.message.answer("Это не ваш счет.")
-            await callback.answer()
-            return
-        if r['status'] != 'unpaid':
-            await callback.message.answer("Счет уже оплачен или отменён.")
-            await callback.answer()
-            return
-        await conn.execute("DELETE FROM invoices WHERE invoice_id=?", (inv_id,))
-        await conn.commit()
-    await callback.message.answer("❌ Счет отменён.", reply_markup=main_menu_markup(callback.from_user.id))
-    await callback.answer()
-
-# ---------------- Categories & Products ----------------
-@dp.callback_query(lambda c: c.data == "menu_products")
-async def cb_products(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    await ensure_user_record(callback.from_user)
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT COUNT(*) as cnt FROM products") as cur:
-            total = (await cur.fetchone())['cnt']
-    text = f"🛍 Категории товаров (всего товаров: {total})"
-    markup = await build_categories_markup(admin_view=(callback.from_user.id == ADMIN_ID))
-    await callback.message.answer(text, reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("cat|"))
-async def cb_category(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    cat_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT name FROM categories WHERE id=?", (cat_id,)) as cur:
-            cat = await cur.fetchone()
-        async with conn.execute("SELECT id,name FROM subcategories WHERE category_id=? ORDER BY name", (cat_id,)) as cur:
-            subs = await cur.fetchall()
-    if not cat:
-        await callback.message.answer("Категория не найдена.")
-        await callback.answer()
-        return
-    buttons = [[InlineKeyboardButton(text="📦 Все товары в категории", callback_data=f"list_products|cat|{cat_id}|1")]]
-    for s in subs:
-        buttons.append([InlineKeyboardButton(text=f"📂 {s['name']}", callback_data=f"list_products|sub|{s['id']}|1")])
-    if callback.from_user.id == ADMIN_ID:
-        buttons.append([InlineKeyboardButton(text="➕ Создать подкатегорию", callback_data=f"admin_create_sub|{cat_id}")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_products")])
-    markup = simple_markup(buttons)
-    await callback.message.answer(f"📁 *{cat['name']}*\nВыберите подкатегорию или просмотреть все товары:", 
-                                parse_mode="Markdown", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("list_products|"))
-async def cb_list_products(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    parts = callback.data.split("|")
-    mode = parts[1]
-    ident = int(parts[2])
-    page = int(parts[3])
-    per_page = 10
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        if mode == "cat":
-            async with conn.execute("SELECT COUNT(*) as cnt FROM products WHERE category_id=?", (ident,)) as cur:
-                total = (await cur.fetchone())['cnt']
-            async with conn.execute("SELECT id,title FROM products WHERE category_id=? ORDER BY created_at DESC LIMIT ? OFFSET ?", 
-                                    (ident, per_page, (page-1)*per_page)) as cur:
-                prods = await cur.fetchall()
-        else:
-            async with conn.execute("SELECT COUNT(*) as cnt FROM products WHERE subcategory_id=?", (ident,)) as cur:
-                total = (await cur.fetchone())['cnt']
-            async with conn.execute("SELECT id,title FROM products WHERE subcategory_id=? ORDER BY created_at DESC LIMIT ? OFFSET ?", 
-                                    (ident, per_page, (page-1)*per_page)) as cur:
-                prods = await cur.fetchall()
-    if not prods:
-        await callback.message.answer("В этой категории пока нет товаров.", reply_markup=main_menu_markup(callback.from_user.id))
-        await callback.answer("Товары не найдены.")
-        return
-    buttons = []
-    for p in prods:
-        buttons.append([InlineKeyboardButton(text=f"🛒 {p['title']}", callback_data=f"view_product|{p['id']}")])
-    total_pages = (total + per_page - 1) // per_page
-    nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton(text="◀️ Prev", callback_data=f"list_products|{mode}|{ident}|{page-1}
-System: Чтобы предоставить готовый вариант для скачивания, я подготовлю обновлённый файл `bot.py` с добавленной логикой веб-сервера и health check, как в предоставленном примере. Я также учту, что ваш код уже использует `aiogram`, `asyncio`, и другие зависимости, и интегрирую изменения так, чтобы они гармонично вписались в ваш проект.
-
-### Основные изменения:
-1. Добавлены импорты для `aiohttp` и `web` для работы с веб-сервером.
-2. Добавлена функция `health_check` для обработки запросов на проверку состояния.
-3. Добавлена функция `run_web_server` для запуска веб-сервера на указанном порту.
-4. Модифицирована функция `on_startup`, чтобы включить запуск веб-сервера и фоновой проверки платежей.
-5. Обновлён запуск бота с использованием `executor.start_polling` для поддержки функции `on_startup` и корректной обработки обновлений.
-
-### Полный код обновлённого файла `bot.py`:
-
-```python
-#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-"""
-Mexanick Market
-"""
-import asyncio
-import logging
-import os
-from datetime import datetime
-import pytz
-import requests
-from aiogram import Bot, Dispatcher, types, executor
-from aiogram.filters import CommandStart
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Message
-import aiosqlite
-import sqlite3
-from aiohttp import web
-
-# ---------------- CONFIG ----------------
-BOT_TOKEN = "8379265766:AAEz5DHkaF3o-edaSR2jJftRpBPADUmo6ds"           
-CRYPTO_TOKEN = "369438:AAEKsbWPZPQ0V3YNV4O0GHcWTvSbzkEar43"       
-ADMIN_ID = 1041720539                       
-ADMIN_USERNAME = "@mexanickq"
-DB_FILE = "mexanick_market.db"
-MARKET_NAME = "💎Mexanick Market💎"
-CRYPTO_PAY_URL = 'https://pay.crypt.bot/api'
-CRYPTO_ASSETS = ['USDT','BTC','ETH','TON','TRX']
-ASSET_MAP = {'USDT':'tether','BTC':'bitcoin','ETH':'ethereum','TON':'the-open-network','TRX':'tron'}
-PORT = 8080  # Порт для веб-сервера
-# ----------------------------------------
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-
-# ---------------- States ----------------
-class DepositState(StatesGroup):
-    asset = State()
-    amount = State()
-
-class SellerCreate(StatesGroup):
-    info = State()
-
-class SellerEditInfo(StatesGroup):
-    info = State()
-
-class AddProduct(StatesGroup):
-    photo = State()
-    title = State()
-    desc = State()
-    price = State()
-    quantity = State()
-    content = State()
-
-class EditProduct(StatesGroup):
-    field = State()
-    value = State()
-
-class AdminNewCategory(StatesGroup):
-    name = State()
-
-class AdminEditCategory(StatesGroup):
-    cat_id = State()
-    name = State()
-
-class AdminNewSub(StatesGroup):
-    name = State()
-
-class AdminEditSub(StatesGroup):
-    sub_id = State()
-    name = State()
-
-class AdminSearchUser(StatesGroup):
-    user_id = State()
-
-class AdminBalanceChange(StatesGroup):
-    amount = State()
-
-class AdminProdSearch(StatesGroup):
-    prod_id = State()
-
-class AdminEditProduct(StatesGroup):
-    name = State()
-    desc = State()
-
-class ReviewState(StatesGroup):
-    rating = State()
-    text = State()
-
-class DisputeState(StatesGroup):
-    description = State()
-
-class AdminCloseDispute(StatesGroup):
-    reason = State()
-
-class SettingsState(StatesGroup):
-    action = State()
-
-# ---------------- Database helpers ----------------
-async def init_db():
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        await conn.executescript("""
-        CREATE TABLE IF NOT EXISTS users(
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            balance REAL DEFAULT 0.0,
-            notify_enabled INTEGER DEFAULT 1
-        );
-        CREATE TABLE IF NOT EXISTS invoices(
-            invoice_id INTEGER PRIMARY KEY,
-            user_id INTEGER,
-            amount REAL,
-            asset TEXT,
-            status TEXT DEFAULT 'unpaid',
-            hash TEXT,
-            created_at TEXT
-        );
-        CREATE TABLE IF NOT EXISTS categories(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE
-        );
-        CREATE TABLE IF NOT EXISTS subcategories(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            category_id INTEGER,
-            name TEXT
-        );
-        CREATE TABLE IF NOT EXISTS sellers(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            username TEXT,
-            info TEXT
-        );
-        CREATE TABLE IF NOT EXISTS products(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            seller_id INTEGER,
-            title TEXT,
-            description TEXT,
-            photo_file_id TEXT,
-            category_id INTEGER,
-            subcategory_id INTEGER,
-            price REAL,
-            quantity INTEGER DEFAULT 1,
-            content_text TEXT,
-            content_file_id TEXT,
-            created_at TEXT
-        );
-        CREATE TABLE IF NOT EXISTS reviews(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER,
-            user_id INTEGER,
-            username TEXT,
-            rating INTEGER,
-            text TEXT,
-            created_at TEXT
-        );
-        CREATE TABLE IF NOT EXISTS disputes(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            order_id INTEGER,
-            user_id INTEGER,
-            description TEXT,
-            status TEXT DEFAULT 'open',
-            created_at TEXT,
-            close_reason TEXT
-        );
-        CREATE TABLE IF NOT EXISTS settings(
-            key TEXT PRIMARY KEY,
-            value TEXT
-        );
-        CREATE TABLE IF NOT EXISTS orders(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            product_id INTEGER,
-            seller_id INTEGER,
-            price REAL,
-            created_at TEXT
-        );
-        INSERT OR IGNORE INTO settings(key,value) VALUES ('maintenance','off');
-        """)
-        await conn.commit()
-
-# ---------------- Utility ----------------
-def now_iso():
-    msk_tz = pytz.timezone('Europe/Moscow')
-    return datetime.now(msk_tz).isoformat()
-
-async def is_maintenance():
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT value FROM settings WHERE key='maintenance'") as cur:
-            r = await cur.fetchone()
-            return r and r['value'] == 'on'
-
-async def maintenance_block(message: types.Message | CallbackQuery):
-    if await is_maintenance():
-        text = "🛠️ Сейчас идут технические работы. Попробуйте позже."
-        if isinstance(message, CallbackQuery):
-            await message.answer(text)
-            await bot.send_message(message.message.chat.id, text)
-        else:
-            await message.answer(text)
-        return True
-    return False
-
-async def ensure_user_record(user: types.User):
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("INSERT OR IGNORE INTO users(user_id,username,balance,notify_enabled) VALUES (?,?,?,?)", 
-                         (user.id, user.username, 0.0, 1))
-        await conn.execute("UPDATE users SET username = ? WHERE user_id = ?", (user.username, user.id))
-        await conn.commit()
-
-async def is_notify_enabled(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT notify_enabled FROM users WHERE user_id=?", (user_id,)) as cur:
-            r = await cur.fetchone()
-            return r['notify_enabled'] == 1 if r else True
-
-def format_money(amount):
-    return f"{amount:.2f} RUB"
-
-# ---------------- MARKUP HELPER ----------------
-def simple_markup(buttons_list):
-    """Создаёт InlineKeyboardMarkup для aiogram 3.20.0"""
-    inline_keyboard = []
-    for row in buttons_list:
-        if isinstance(row, list):
-            inline_keyboard.append(row)
-        else:
-            inline_keyboard.append([row])
-    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
-
-# ---------------- Inline markups ----------------
-def main_menu_markup(user_id: int):
-    buttons = [
-        [
-            InlineKeyboardButton(text="💰 Баланс", callback_data="menu_balance"),
-            InlineKeyboardButton(text="💸 Пополнить", callback_data="menu_deposit")
-        ],
-        [
-            InlineKeyboardButton(text="🛍 Товары", callback_data="menu_products"),
-            InlineKeyboardButton(text="➕ Продать", callback_data="menu_sell")
-        ],
-        [
-            InlineKeyboardButton(text="📋 Мои покупки", callback_data="menu_my_orders"),
-            InlineKeyboardButton(text="📞 Поддержка", callback_data="menu_support")
-        ],
-        [InlineKeyboardButton(text="⚙️ Настройки", callback_data="menu_settings")]
-    ]
-    if user_id == ADMIN_ID:
-        buttons.append([InlineKeyboardButton(text="🔧 Админ панель", callback_data="menu_admin")])
-    return simple_markup(buttons)
-
-def cancel_markup(text="Отмена"):
-    return simple_markup([InlineKeyboardButton(text="❌ " + text, callback_data="action_cancel")])
-
-async def build_categories_markup(admin_view=False):
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id,name FROM categories ORDER BY name") as cur:
-            cats = await cur.fetchall()
-    
-    buttons = []
-    for c in cats:
-        buttons.append([InlineKeyboardButton(text=f"📁 {c['name']}", callback_data=f"cat|{c['id']}")])
-    
-    if admin_view:
-        buttons.append([InlineKeyboardButton(text="➕ Создать категорию", callback_data="admin_create_category")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")])
-    
-    return simple_markup(buttons)
-
-async def build_admin_categories_markup():
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id,name FROM categories ORDER BY name") as cur:
-            cats = await cur.fetchall()
-    
-    buttons = []
-    for c in cats:
-        buttons.append([
-            InlineKeyboardButton(text=f"📁 {c['name']}", callback_data=f"admin_view_cat|{c['id']}"),
-            InlineKeyboardButton(text="✏️", callback_data=f"admin_edit_cat|{c['id']}"),
-            InlineKeyboardButton(text="🗑", callback_data=f"admin_delete_cat|{c['id']}")
-        ])
-    buttons.append([InlineKeyboardButton(text="➕ Создать категорию", callback_data="admin_create_category")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")])
-    
-    return simple_markup(buttons)
-
-async def build_admin_subcategories_markup(cat_id):
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id,name FROM subcategories WHERE category_id=? ORDER BY name", (cat_id,)) as cur:
-            subs = await cur.fetchall()
-    
-    buttons = []
-    for s in subs:
-        buttons.append([
-            InlineKeyboardButton(text=f"📂 {s['name']}", callback_data=f"list_products|sub|{s['id']}|1"),
-            InlineKeyboardButton(text="✏️", callback_data=f"admin_edit_sub|{s['id']}"),
-            InlineKeyboardButton(text="🗑", callback_data=f"admin_delete_sub|{s['id']}")
-        ])
-    buttons.append([InlineKeyboardButton(text="➕ Создать подкатегорию", callback_data=f"admin_create_sub|{cat_id}")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")])
-    
-    return simple_markup(buttons)
-
-# ---------------- Crypto ----------------
-def crypto_headers():
-    return {'Crypto-Pay-API-Token': CRYPTO_TOKEN, 'Content-Type': 'application/json'}
-
-def get_rate(asset):
-    coin_id = ASSET_MAP.get(asset)
-    if not coin_id:
-        raise ValueError("Unknown asset")
-    try:
-        r = requests.get(f'https://api.coingecko.com/api/v3/simple/price?ids={coin_id}&vs_currencies=rub', timeout=8)
-        r.raise_for_status()
-        data = r.json()
-        return float(data[coin_id]['rub'])
-    except Exception:
-        return 100.0
-
-def create_invoice(asset, amount, description, user_id):
-    payload = {'asset': asset, 'amount': str(amount), 'description': description}
-    try:
-        r = requests.post(f'{CRYPTO_PAY_URL}/createInvoice', json=payload, headers=crypto_headers(), timeout=10)
-        r.raise_for_status()
-        resp = r.json()
-        if resp.get('ok'):
-            inv = resp['result']
-            asyncio.create_task(save_invoice_db(int(inv['invoice_id']), user_id, amount, asset, inv.get('hash')))
-        return resp
-    except Exception as e:
-        logging.error("create_invoice error: %s", e)
-        return {'ok': False, 'error': str(e)}
-
-async def save_invoice_db(invoice_id, user_id, amount, asset, hash_val):
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("INSERT OR IGNORE INTO invoices(invoice_id,user_id,amount,asset,hash,created_at) VALUES (?,?,?,?,?,?)",
-                           (invoice_id, user_id, amount, asset, hash_val, now_iso()))
-        await conn.commit()
-
-def get_invoices(invoice_ids):
-    try:
-        payload = {'invoice_ids': ','.join(map(str, invoice_ids))}
-        r = requests.get(f'{CRYPTO_PAY_URL}/getInvoices', params=payload, headers=crypto_headers(), timeout=10)
-        r.raise_for_status()
-        return r.json()
-    except Exception as e:
-        logging.error("get_invoices error: %s", e)
-        return {'ok': False, 'error': str(e)}
-
-async def background_payment_checker():
-    while True:
-        try:
-            async with aiosqlite.connect(DB_FILE) as conn:
-                conn.row_factory = aiosqlite.Row
-                async with conn.execute("SELECT invoice_id FROM invoices WHERE status='unpaid'") as cur:
-                    rows = await cur.fetchall()
-            if rows:
-                invoice_ids = [r['invoice_id'] for r in rows]
-                resp = get_invoices(invoice_ids)
-                if resp.get('ok'):
-                    items = resp['result'].get('items', [])
-                    for it in items:
-                        if it.get('status') == 'paid':
-                            invoice_id = int(it['invoice_id'])
-                            async with aiosqlite.connect(DB_FILE) as conn:
-                                conn.row_factory = aiosqlite.Row
-                                async with conn.execute("SELECT user_id,amount,asset FROM invoices WHERE invoice_id=?", (invoice_id,)) as cur:
-                                    row = await cur.fetchone()
-                                if row:
-                                    user_id, amount, asset = row['user_id'], row['amount'], row['asset']
-                                    try:
-                                        rate = get_rate(asset)
-                                        rub_amount = float(amount) * float(rate)
-                                    except Exception:
-                                        rub_amount = 0.0
-                                    await conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (rub_amount, user_id))
-                                    await conn.execute("UPDATE invoices SET status='paid' WHERE invoice_id=?", (invoice_id,))
-                                    await conn.commit()
-                                    if await is_notify_enabled(user_id):
-                                        try:
-                                            await bot.send_message(user_id, f"🎉 Платёж подтверждён — баланс пополнен на {rub_amount:.2f} RUB")
-                                        except Exception:
-                                            pass
-        except Exception as e:
-            logging.error("Payment checker loop error: %s", e)
-        await asyncio.sleep(20)
-
-# ---------------- Web Server ----------------
-async def health_check(request):
-    return web.Response(text="Bot is running")
-
-async def run_web_server():
-    app = web.Application()
-    app.router.add_get('/', health_check)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', PORT)
-    await site.start()
-    logger.info(f"Веб-сервер запущен на порту {PORT}")
-
-async def on_startup(_):
-    if not os.path.exists("media"):
-        os.makedirs("media")
-    await bot.delete_webhook(drop_pending_updates=True)
-    asyncio.create_task(background_payment_checker())
-    asyncio.create_task(run_web_server())
-    logger.info("Бот запущен и готов к работе")
-
-# ---------------- Handlers ----------------
-@dp.message(CommandStart())
-async def handler_start(message: Message):
-    if await maintenance_block(message): return
-    await ensure_user_record(message.from_user)
-    await message.answer(f"👋 Добро пожаловать в *{MARKET_NAME}*!\nВыберите действие ниже:", 
-                        parse_mode="Markdown", 
-                        reply_markup=main_menu_markup(message.from_user.id))
-
-# --- Balance & deposit ---
-@dp.callback_query(lambda c: c.data == "menu_balance")
-async def cb_balance(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    await ensure_user_record(callback.from_user)
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT balance FROM users WHERE user_id=?", (callback.from_user.id,)) as cur:
-            bal = (await cur.fetchone())['balance']
-    text = f"💰 Ваш баланс: *{format_money(bal)}*"
-    markup = simple_markup([
-        [InlineKeyboardButton(text="💸 Пополнить", callback_data="menu_deposit")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
-    ])
-    await callback.message.answer(text, parse_mode="Markdown", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data == "menu_deposit")
-async def cb_deposit(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    markup = simple_markup([
-        [InlineKeyboardButton(text="USDT", callback_data="deposit_asset|USDT"), 
-         InlineKeyboardButton(text="BTC", callback_data="deposit_asset|BTC")],
-        [InlineKeyboardButton(text="ETH", callback_data="deposit_asset|ETH"), 
-         InlineKeyboardButton(text="TON", callback_data="deposit_asset|TON")],
-        [InlineKeyboardButton(text="TRX", callback_data="deposit_asset|TRX")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
-    ])
-    await callback.message.answer("💸 Выберите валюту для пополнения (через CryptoBot):", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("deposit_asset|"))
-async def cb_deposit_asset(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    asset = callback.data.split("|", 1)[1]
-    await state.set_state(DepositState.amount)
-    await state.set_data({"asset": asset})
-    await callback.message.answer(f"💸 Введите сумму в RUB, которую хотите пополнить через *{asset}*:", 
-                                parse_mode="Markdown", reply_markup=cancel_markup())
-    await callback.answer()
-
-@dp.message(DepositState.amount)
-async def process_deposit_amount(message: Message, state: FSMContext):
-    data = await state.get_data()
-    asset = data.get("asset")
-    if message.text.strip().lower() in ["отмена", "cancel", "❌"]:
-        await message.answer("❌ Пополнение отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    try:
-        rub = float(message.text.strip().replace(',', '.'))
-        if rub <= 0:
-            raise ValueError("<=0")
-    except Exception:
-        await message.answer("❌ Неверная сумма. Введите число (например 1000.50).", reply_markup=cancel_markup())
-        return
-    try:
-        rate = get_rate(asset)
-        crypto_amount = rub / rate
-    except Exception:
-        await message.answer("❌ Не удалось получить курс. Попробуйте позже.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    resp = create_invoice(asset, crypto_amount, f"Пополнение {MARKET_NAME} для {message.from_user.id}", message.from_user.id)
-    if resp.get('ok'):
-        inv = resp['result']
-        pay_url = f"https://t.me/CryptoBot/app?startapp=invoice-{inv.get('hash')}&mode=compact"
-        markup = simple_markup([
-            [InlineKeyboardButton(text="💳 Оплатить", url=pay_url)],
-            [InlineKeyboardButton(text="❌ Отменить", callback_data=f"invoice_cancel|{inv.get('invoice_id')}")]
-        ])
-        await message.answer(f"💳 Счет создан:\nСумма: *{rub:.2f} RUB* (~{crypto_amount:.6f} {asset})\nНажмите кнопку для оплаты (CryptoBot).", 
-                           parse_mode="Markdown", reply_markup=markup)
-    else:
-        await message.answer(f"❌ Ошибка создания счета: {resp.get('error')}", reply_markup=main_menu_markup(message.from_user.id))
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("invoice_cancel|"))
-async def cb_invoice_cancel(callback: CallbackQuery):
-    inv_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT user_id,status FROM invoices WHERE invoice_id=?", (inv_id,)) as cur:
-            r = await cur.fetchone()
-        if not r:
-            await callback.message.answer("Счет не найден.")
-            await callback.answer()
-            return
-        if r['user_id'] != callback.from_user.id:
-            await callback.message.answer("Это не ваш счет.")
-            await callback.answer()
-            return
-        if r['status'] != 'unpaid':
-            await callback.message.answer("Счет уже оплачен или отменён.")
-            await callback.answer()
-            return
-        await conn.execute("DELETE FROM invoices WHERE invoice_id=?", (inv_id,))
-        await conn.commit()
-    await callback.message.answer("❌ Счет отменён.", reply_markup=main_menu_markup(callback.from_user.id))
-    await callback.answer()
-
-# ---------------- Categories & Products ----------------
-@dp.callback_query(lambda c: c.data == "menu_products")
-async def cb_products(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    await ensure_user_record(callback.from_user)
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT COUNT(*) as cnt FROM products") as cur:
-            total = (await cur.fetchone())['cnt']
-    text = f"🛍 Категории товаров (всего товаров: {total})"
-    markup = await build_categories_markup(admin_view=(callback.from_user.id == ADMIN_ID))
-    await callback.message.answer(text, reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("cat|"))
-async def cb_category(callback: CallbackQuery):
-    if await maintenance智能: if await maintenance_block(callback): return
-    cat_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT name FROM categories WHERE id=?", (cat_id,)) as cur:
-            cat = await cur.fetchone()
-        async with conn.execute("SELECT id,name FROM subcategories WHERE category_id=? ORDER BY name", (cat_id,)) as cur:
-            subs = await cur.fetchall()
-    if not cat:
-        await callback.message.answer("Категория не найдена.")
-        await callback.answer()
-        return
-    buttons = [[InlineKeyboardButton(text="📦 Все товары в категории", callback_data=f"list_products|cat|{cat_id}|1")]]
-    for s in subs:
-        buttons.append([InlineKeyboardButton(text=f"📂 {s['name']}", callback_data=f"list_products|sub|{s['id']}|1")])
-    if callback.from_user.id == ADMIN_ID:
-        buttons.append([InlineKeyboardButton(text="➕ Создать подкатегорию", callback_data=f"admin_create_sub|{cat_id}")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_products")])
-    markup = simple_markup(buttons)
-    await callback.message.answer(f"📁 *{cat['name']}*\nВыберите подкатегорию или просмотреть все товары:", 
-                                parse_mode="Markdown", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("list_products|"))
-async def cb_list_products(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    parts = callback.data.split("|")
-    mode = parts[1]
-    ident = int(parts[2])
-    page = int(parts[3])
-    per_page = 10
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        if mode == "cat":
-            async with conn.execute("SELECT COUNT(*) as cnt FROM products WHERE category_id=?", (ident,)) as cur:
-                total = (await cur.fetchone())['cnt']
-            async with conn.execute("SELECT id,title FROM products WHERE category_id=? ORDER BY created_at DESC LIMIT ? OFFSET ?", 
-                                    (ident, per_page, (page-1)*per_page)) as cur:
-                prods = await cur.fetchall()
-        else:
-            async with conn.execute("SELECT COUNT(*) as cnt FROM products WHERE subcategory_id=?", (ident,)) as cur:
-                total = (await cur.fetchone())['cnt']
-            async with conn.execute("SELECT id,title FROM products WHERE subcategory_id=? ORDER BY created_at DESC LIMIT ? OFFSET ?", 
-                                    (ident, per_page, (page-1)*per_page)) as cur:
-                prods = await cur.fetchall()
-    if not prods:
-        await callback.message.answer("В этой категории пока нет товаров.", reply_markup=main_menu_markup(callback.from_user.id))
-        await callback.answer("Товары не найдены.")
-        return
-    buttons = []
-    for p in prods:
-        buttons.append([InlineKeyboardButton(text=f"🛒 {p['title']}", callback_data=f"view_product|{p['id']}")])
-    total_pages = (total + per_page - 1) // per_page
-    nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton(text="◀️ Prev", callback_data=f"list_products|{mode}|{ident}|{page-1}"))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"list_products|{mode}|{ident}|{page+1}"))
-    if nav_buttons:
-        buttons.append(nav_buttons)
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"cat|{ident}" if mode == "cat" else f"list_products|cat|{ident}|1")])
-    markup = simple_markup(buttons)
-    await callback.message.answer(f"Товары (страница {page}/{total_pages}):", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("view_product|"))
-async def cb_view_product(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    pid = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("""SELECT p.*, s.user_id as seller_user_id, s.username as seller_username
-                                FROM products p LEFT JOIN sellers s ON p.seller_id = s.id WHERE p.id=?""", (pid,)) as cur:
-            p = await cur.fetchone()
-    if not p:
-        await callback.message.answer("Товар не найден.")
-        await callback.answer()
-        return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT AVG(rating) as avg, COUNT(*) as cnt FROM reviews WHERE product_id=?", (pid,)) as cur:
-            stats = await cur.fetchone()
-            avg = stats['avg'] if stats['avg'] else 0.0
-            cnt = stats['cnt']
-    msk_tz = pytz.timezone('Europe/Moscow')
-    created_at_msk = datetime.fromisoformat(p['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
-    text = f"🛒 *{p['title']}* (ID: {p['id']})\n\n{p['description']}\n\n💵 Цена: *{format_money(p['price'])}*\n📦 Количество: {p['quantity']}\n👤 Продавец: @{p['seller_username'] or '-'}\n⭐ Рейтинг товара: *{avg:.1f}* / 5.0 ({cnt} отзывов)\n📅 Создан: {created_at_msk}"
-    markup = simple_markup([
-        [
-            InlineKeyboardButton(text="🛍 Купить", callback_data=f"buy|{pid}"),
-            InlineKeyboardButton(text="📝 Отзыв", callback_data=f"review|{pid}")
-        ],
-        [InlineKeyboardButton(text="👤 Карточка продавца", callback_data=f"seller_card|{p['seller_user_id']}")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_products")]
-    ])
-    if p['photo_file_id']:
-        await bot.send_photo(callback.message.chat.id, p['photo_file_id'], caption=text, parse_mode="Markdown", reply_markup=markup)
-    else:
-        await callback.message.answer(text, parse_mode="Markdown", reply_markup=markup)
-    await callback.answer()
-
-# ---------------- Seller Card ----------------
-@dp.callback_query(lambda c: c.data.startswith("seller_card|"))
-async def cb_seller_card(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    seller_user_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id,username,info,user_id FROM sellers WHERE user_id=?", (seller_user_id,)) as cur:
-            s = await cur.fetchone()
-        if not s:
-            await callback.message.answer("Продавец не найден.")
-            await callback.answer()
-            return
-        async with conn.execute("SELECT COUNT(*) as cnt FROM products WHERE seller_id=?", (s['id'],)) as cur:
-            total_products = (await cur.fetchone())['cnt']
-        async with conn.execute("""SELECT AVG(r.rating) as avg, COUNT(r.id) as cnt FROM reviews r
-                                JOIN products p ON r.product_id = p.id
-                                WHERE p.seller_id = ?""", (s['id'],)) as cur:
-            st = await cur.fetchone()
-            avg = st['avg'] or 0.0
-            cnt = st['cnt'] or 0
-        async with conn.execute("""SELECT r.username, r.rating, r.text, r.created_at
-                                FROM reviews r
-                                JOIN products p ON r.product_id = p.id
-                                WHERE p.seller_id = ?
-                                ORDER BY r.created_at DESC LIMIT 5""", (s['id'],)) as cur:
-            reviews = await cur.fetchall()
-    msk_tz = pytz.timezone('Europe/Moscow')
-    reviews_text = ""
-    for r in reviews:
-        uname = r['username'] or 'анон'
-        created_at_msk = datetime.fromisoformat(r['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
-        reviews_text += f"⭐ {r['rating']}/5 — @{uname} ({created_at_msk}): {r['text'] or 'Без текста'}\n"
-    text = (f"👤 *Продавец:* @{s['username'] or 'анон'}\n"
-            f"📌 О продавце: {s['info'] or '-'}\n\n"
-            f"📦 Товаров: {total_products}\n⭐ Средняя оценка: *{avg:.1f}* / 5.0 ({cnt} отзывов)\n\n"
-            f"📝 Последние отзывы:\n{reviews_text or 'Отзывов пока нет.'}")
-    markup = simple_markup([
-        [InlineKeyboardButton(text="📦 Посмотреть товары продавца", callback_data=f"list_seller_products|{s['id']}|1")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_products")]
-    ])
-    await callback.message.answer(text, parse_mode="Markdown", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("list_seller_products|"))
-async def cb_list_seller_products(callback: CallbackQuery):
-    parts = callback.data.split("|")
-    sid = int(parts[1])
-    page = int(parts[2]) if len(parts) > 2 else 1
-    per_page = 10
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT COUNT(*) as cnt FROM products WHERE seller_id=?", (sid,)) as cur:
-            total = (await cur.fetchone())['cnt']
-        async with conn.execute("SELECT id,title FROM products WHERE seller_id=? ORDER BY created_at DESC LIMIT ? OFFSET ?", 
-                                (sid, per_page, (page-1)*per_page)) as cur:
-            prods = await cur.fetchall()
-    if not prods:
-        await callback.message.answer("У продавца пока нет товаров.", reply_markup=main_menu_markup(callback.from_user.id))
-        await callback.answer("Нет товаров")
-        return
-    buttons = []
-    for p in prods:
-        buttons.append([InlineKeyboardButton(text=f"🛒 {p['title']}", callback_data=f"view_product|{p['id']}")])
-    total_pages = (total + per_page - 1) // per_page
-    nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton(text="◀️ Prev", callback_data=f"list_seller_products|{sid}|{page-1}"))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"list_seller_products|{sid}|{page+1}"))
-    if nav_buttons:
-        buttons.append(nav_buttons)
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_products")])
-    markup = simple_markup(buttons)
-    await callback.message.answer(f"Товары продавца (страница {page}/{total_pages}):", reply_markup=markup)
-    await callback.answer()
-
-# ---------------- Buy & Reviews & Disputes logic ----------------
-@dp.callback_query(lambda c: c.data.startswith("buy|"))
-async def cb_buy(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    pid = int(callback.data.split("|", 1)[1])
-    await ensure_user_record(callback.from_user)
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id,title,price,quantity,content_text,content_file_id,seller_id FROM products WHERE id=?", (pid,)) as cur:
-            p = await cur.fetchone()
-        if not p:
-            await callback.message.answer("Товар не найден.")
-            await callback.answer()
-            return
-        if p['quantity'] <= 0:
-            await callback.message.answer("Товар закончился.")
-            await callback.answer()
-            return
-        async with conn.execute("SELECT balance FROM users WHERE user_id=?", (callback.from_user.id,)) as cur:
-            bal = (await cur.fetchone())['balance']
-    if bal < p['price']:
-        await callback.message.answer(f"❌ На балансе {format_money(bal)}, цена: {format_money(p['price'])}. Пополните баланс.", 
-                                    reply_markup=main_menu_markup(callback.from_user.id))
-        await callback.answer("Недостаточно средств.")
-        return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        await conn.execute("UPDATE users SET balance = balance - ? WHERE user_id=?", (p['price'], callback.from_user.id))
-        await conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = (SELECT user_id FROM sellers WHERE id=?)", 
-                         (p['price'], p['seller_id']))
-        await conn.execute("UPDATE products SET quantity = quantity - 1 WHERE id=?", (pid,))
-        async with conn.execute("INSERT INTO orders(user_id, product_id, seller_id, price, created_at) VALUES (?, ?, ?, ?, ?) RETURNING id", 
-                              (callback.from_user.id, pid, p['seller_id'], p['price'], now_iso())) as cur:
-            row = await cur.fetchone()
-            order_id = row['id'] if row else None
-        await conn.commit()
-    if not order_id:
-        await callback.message.answer("Ошибка при создании заказа.")
-        await callback.answer()
-        return
-    await callback.message.answer(f"✅ Вы купили *{p['title']}* за {format_money(p['price'])}.\nСпасибо за покупку!", 
-                                parse_mode="Markdown")
-    # Send content
-    if p['content_text']:
-        await callback.message.answer(f"Содержимое товара: {p['content_text']}")
-    elif p['content_file_id']:
-        try:
-            await bot.send_document(callback.message.chat.id, p['content_file_id'], caption="Содержимое товара")
-        except:
-            await bot.send_photo(callback.message.chat.id, p['content_file_id'], caption="Содержимое товара")
-    # Post-purchase options
-    markup = simple_markup([
-        [InlineKeyboardButton(text="📝 Оставить отзыв", callback_data=f"review|{pid}"),
-         InlineKeyboardButton(text="⚖️ Открыть спор", callback_data=f"dispute|{order_id}")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
-    ])
-    await callback.message.answer("Что дальше?", reply_markup=markup)
-    # Notify seller
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT user_id FROM sellers WHERE id=?", (p['seller_id'],)) as cur:
-            seller = await cur.fetchone()
-    if seller and await is_notify_enabled(seller['user_id']):
-        try:
-            await bot.send_message(seller['user_id'], 
-                                 f"🎉 Ваш товар *{p['title']}* куплен за {format_money(p['price'])}!\nБаланс пополнен.", 
-                                 parse_mode="Markdown")
-        except Exception:
-            pass
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("review|"))
-async def cb_review(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    pid = int(callback.data.split("|", 1)[1])
-    user_id = callback.from_user.id
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT 1 FROM orders WHERE user_id=? AND product_id=? LIMIT 1", (user_id, pid)) as cur:
-            purchased = await cur.fetchone() is not None
-        async with conn.execute("SELECT 1 FROM reviews WHERE product_id=? AND user_id=? LIMIT 1", (pid, user_id)) as cur:
-            already = await cur.fetchone() is not None
-    if not purchased:
-        await callback.message.answer("Отзыв можно оставить только после покупки этого товара!")
-        await callback.answer()
-        return
-    if already:
-        await callback.message.answer("Вы уже оставляли отзыв на этот товар.")
-        await callback.answer()
-        return
-    markup = simple_markup([
-        [InlineKeyboardButton(text="⭐⭐⭐⭐⭐ 5", callback_data=f"leave_rating|{pid}|5")],
-        [InlineKeyboardButton(text="⭐⭐⭐⭐ 4", callback_data=f"leave_rating|{pid}|4")],
-        [InlineKeyboardButton(text="⭐⭐⭐ 3", callback_data=f"leave_rating|{pid}|3")],
-        [InlineKeyboardButton(text="⭐⭐ 2", callback_data=f"leave_rating|{pid}|2")],
-        [InlineKeyboardButton(text="⭐ 1", callback_data=f"leave_rating|{pid}|1")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"view_product|{pid}")]
-    ])
-    await callback.message.answer("⭐ Выберите оценку (1–5):", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("leave_rating|"))
-async def cb_leave_rating(callback: CallbackQuery, state: FSMContext):
-    parts = callback.data.split("|")
-    pid = int(parts[1])
-    rating = int(parts[2])
-    await state.set_state(ReviewState.text)
-    await state.set_data({"pid": pid, "rating": rating})
-    await callback.message.answer("✍️ Оставьте текст отзыва (или напишите `-` чтобы пропустить):", reply_markup=cancel_markup("Пропустить"))
-    await callback.answer()
-
-@dp.message(ReviewState.text)
-async def process_review_text(message: Message, state: FSMContext):
-    data = await state.get_data()
-    pid = data.get("pid")
-    rating = data.get("rating")
-    text = message.text.strip() if message.text and message.text.strip().lower() not in ["-", "отмена", "cancel", "❌"] else ""
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("INSERT INTO reviews(product_id,user_id,username,rating,text,created_at) VALUES (?,?,?,?,?,?)",
-                           (pid, message.from_user.id, message.from_user.username, rating, text, now_iso()))
-        await conn.commit()
-    await message.answer("✅ Спасибо за отзыв!", reply_markup=main_menu_markup(message.from_user.id))
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("dispute|"))
-async def cb_dispute(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    order_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT 1 FROM disputes WHERE order_id=?", (order_id,)) as cur:
-            exists = await cur.fetchone() is not None
-    if exists:
-        await callback.message.answer("Спор по этой покупке уже открыт.")
-        await callback.answer()
-        return
-    await state.set_state(DisputeState.description)
-    await state.set_data({"order_id": order_id})
-    await callback.message.answer("⚖️ Опишите проблему со сделкой:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(DisputeState.description)
-async def process_dispute_desc(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Отмена.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    desc = message.text.strip()
-    data = await state.get_data()
-    order_id = data.get("order_id")
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("INSERT INTO disputes(order_id, user_id, description, created_at) VALUES (?, ?, ?, ?)",
-                           (order_id, message.from_user.id, desc, now_iso()))
-        await conn.commit()
-    await message.answer("⚖️ Заявка на спор отправлена администраторам.", reply_markup=main_menu_markup(message.from_user.id))
-    await state.clear()
-
-# ---------------- Selling ----------------
-@dp.callback_query(lambda c: c.data == "menu_sell")
-async def cb_menu_sell(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    await ensure_user_record(callback.from_user)
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id FROM sellers WHERE user_id=?", (callback.from_user.id,)) as cur:
-            s = await cur.fetchone()
-    if not s:
-        markup = simple_markup([
-            [InlineKeyboardButton(text="📝 Создать профиль продавца", callback_data="seller_create")],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
-        ])
-        await callback.message.answer("Вы ещё не продавец. Создайте профиль продавца, чтобы выставлять товары.", reply_markup=markup)
-    else:
-        markup = simple_markup([
-            [InlineKeyboardButton(text="➕ Добавить товар", callback_data="add_product")],
-            [InlineKeyboardButton(text="📦 Мои товары", callback_data=f"my_products|{callback.from_user.id}|1")],
-            [InlineKeyboardButton(text="💸 Мои продажи", callback_data=f"my_sales|{s['id']}|1")],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
-        ])
-        await callback.message.answer("🎪 Панель продав
-
-ца", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data == "seller_create")
-async def cb_seller_create(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    await state.set_state(SellerCreate.info)
-    await callback.message.answer("📝 Введите краткую информацию о себе (описание продавца):", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(SellerCreate.info)
-async def process_seller_info(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Создание профиля отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    info = message.text.strip()
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("INSERT OR IGNORE INTO sellers(user_id,username,info) VALUES (?,?,?)", 
-                         (message.from_user.id, message.from_user.username, info))
-        await conn.execute("UPDATE sellers SET info=? WHERE user_id=?", (info, message.from_user.id))
-        await conn.commit()
-    await message.answer("✅ Профиль продавца создан/обновлён.", reply_markup=main_menu_markup(message.from_user.id))
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data == "seller_edit_info")
-async def cb_seller_edit_info(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id FROM sellers WHERE user_id=?", (callback.from_user.id,)) as cur:
-            s = await cur.fetchone()
-        if not s:
-            await callback.message.answer("Профиль продавца не найден.")
-            await callback.answer()
-            return
-    await state.set_state(SellerEditInfo.info)
-    await callback.message.answer("📝 Введите новое описание продавца:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(SellerEditInfo.info)
-async def process_seller_edit_info(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Изменение профиля отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    info = message.text.strip()
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("UPDATE sellers SET info=? WHERE user_id=?", (info, message.from_user.id))
-        await conn.commit()
-    await message.answer("✅ Описание продавца обновлено.", reply_markup=main_menu_markup(message.from_user.id))
-    await state.clear()
-
-# ---------------- Add Product ----------------
-@dp.callback_query(lambda c: c.data == "add_product")
-async def cb_add_product(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id FROM sellers WHERE user_id=?", (callback.from_user.id,)) as cur:
-            seller = await cur.fetchone()
-        if not seller:
-            await callback.message.answer("Вы не зарегистрированы как продавец. Сначала создайте профиль продавца.", 
-                                        reply_markup=main_menu_markup(callback.from_user.id))
-            await callback.answer()
-            return
-        await state.set_state(AddProduct.photo)
-        await state.set_data({"seller_id": seller['id']})
-        await callback.message.answer("📸 Отправьте фото товара (или напишите `-` для пропуска):", reply_markup=cancel_markup("Отмена"))
-        await callback.answer()
-
-@dp.message(AddProduct.photo)
-async def process_product_photo(message: Message, state: FSMContext):
-    if message.text and message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    data = await state.get_data()
-    photo_file_id = None
-    if message.text and message.text.strip().lower() == "-":
-        pass
-    elif message.photo:
-        photo_file_id = message.photo[-1].file_id
-    else:
-        await message.answer("❌ Пожалуйста, отправьте фото или напишите `-` для пропуска.", reply_markup=cancel_markup("Отмена"))
-        return
-    await state.set_state(AddProduct.title)
-    await state.update_data({"photo_file_id": photo_file_id})
-    await message.answer("📝 Введите название товара:", reply_markup=cancel_markup("Отмена"))
-    
-@dp.message(AddProduct.title)
-async def process_product_title(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    title = message.text.strip()
-    if len(title) > 100:
-        await message.answer("❌ Название слишком длинное (макс. 100 символов).", reply_markup=cancel_markup("Отмена"))
-        return
-    await state.set_state(AddProduct.desc)
-    await state.update_data({"title": title})
-    await message.answer("📝 Введите описание товара:", reply_markup=cancel_markup("Отмена"))
-
-@dp.message(AddProduct.desc)
-async def process_product_desc(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    desc = message.text.strip()
-    if len(desc) > 1000:
-        await message.answer("❌ Описание слишком длинное (макс. 1000 символов).", reply_markup=cancel_markup("Отмена"))
-        return
-    await state.set_state(AddProduct.price)
-    await state.update_data({"description": desc})
-    await message.answer("💵 Введите цену товара в RUB (например, 1000.50):", reply_markup=cancel_markup("Отмена"))
-
-@dp.message(AddProduct.price)
-async def process_product_price(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    try:
-        price = float(message.text.strip().replace(',', '.'))
-        if price <= 0:
-            raise ValueError("<=0")
-    except Exception:
-        await message.answer("❌ Неверная цена. Введите число (например, 1000.50).", reply_markup=cancel_markup("Отмена"))
-        return
-    await state.set_state(AddProduct.quantity)
-    await state.update_data({"price": price})
-    await message.answer("📦 Введите количество товара (например, 1):", reply_markup=cancel_markup("Отмена"))
-
-@dp.message(AddProduct.quantity)
-async def process_product_quantity(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    try:
-        quantity = int(message.text.strip())
-        if quantity <= 0:
-            raise ValueError("<=0")
-    except Exception:
-        await message.answer("❌ Неверное количество. Введите целое число (например, 1).", reply_markup=cancel_markup("Отмена"))
-        return
-    await state.set_state(AddProduct.content)
-    await state.update_data({"quantity": quantity})
-    markup = await build_categories_markup()
-    await message.answer("📁 Выберите категорию для товара:", reply_markup=markup)
-
-@dp.callback_query(lambda c: c.data.startswith("cat|"), AddProduct.content)
-async def cb_product_category(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    cat_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id,name FROM subcategories WHERE category_id=? ORDER BY name", (cat_id,)) as cur:
-            subs = await cur.fetchall()
-    buttons = []
-    for s in subs:
-        buttons.append([InlineKeyboardButton(text=f"📂 {s['name']}", callback_data=f"subcat|{s['id']}")])
-    buttons.append([InlineKeyboardButton(text="❌ Отмена", callback_data="action_cancel")])
-    markup = simple_markup(buttons)
-    await state.update_data({"category_id": cat_id})
-    await callback.message.answer("📂 Выберите подкатегорию:", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("subcat|"), AddProduct.content)
-async def cb_product_subcategory(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    subcat_id = int(callback.data.split("|", 1)[1])
-    await state.update_data({"subcategory_id": subcat_id})
-    await callback.message.answer("📝 Отправьте содержимое товара (текст или файл):", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AddProduct.content)
-async def process_product_content(message: Message, state: FSMContext):
-    if message.text and message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
-        await state.clear()
-        return
-    data = await state.get_data()
-    content_text = None
-    content_file_id = None
-    if message.text:
-        content_text = message.text.strip()
-    elif message.document:
-        content_file_id = message.document.file_id
-    elif message.photo:
-        content_file_id = message.photo[-1].file_id
-    else:
-        await message.answer("❌ Отправьте текст или файл для содержимого товара.", reply_markup=cancel_markup("Отмена"))
-        return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("""INSERT INTO products(seller_id, title, description, photo_file_id, category_id, 
-                           subcategory_id, price, quantity, content_text, content_file_id, created_at) 
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                           (data['seller_id'], data['title'], data['description'], data.get('photo_file_id'), 
-                            data['category_id'], data['subcategory_id'], data['price'], data['quantity'], 
-                            content_text, content_file_id, now_iso()))
-        await conn.commit()
-    await message.answer("✅ Товар успешно добавлен!", reply_markup=main_menu_markup(message.from_user.id))
-    await state.clear()
-
-# ---------------- My Products ----------------
-@dp.callback_query(lambda c: c.data.startswith("my_products|"))
-async def cb_my_products(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    parts = callback.data.split("|")
-    user_id = int(parts[1])
-    page = int(parts[2]) if len(parts) > 2 else 1
-    per_page = 10
-    if user_id != callback.from_user.id:
-        await callback.message.answer("❌ Это не ваши товары!")
-        await callback.answer()
-        return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT id FROM sellers WHERE user_id=?", (user_id,)) as cur:
-            seller = await cur.fetchone()
-        if not seller:
-            await callback.message.answer("Вы не зарегистрированы как продавец.", reply_markup=main_menu_markup(user_id))
-            await callback.answer()
-            return
-        async with conn.execute("SELECT COUNT(*) as cnt FROM products WHERE seller_id=?", (seller['id'],)) as cur:
-            total = (await cur.fetchone())['cnt']
-        async with conn.execute("SELECT id,title FROM products WHERE seller_id=? ORDER BY created_at DESC LIMIT ? OFFSET ?", 
-                                (seller['id'], per_page, (page-1)*per_page)) as cur:
-            prods = await cur.fetchall()
-    if not prods:
-        await callback.message.answer("У вас пока нет товаров.", reply_markup=main_menu_markup(user_id))
-        await callback.answer()
-        return
-    buttons = []
-    for p in prods:
-        buttons.append([InlineKeyboardButton(text=f"🛒 {p['title']}", callback_data=f"view_product|{p['id']}")])
-    total_pages = (total + per_page - 1) // per_page
-    nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton(text="◀️ Prev", callback_data=f"my_products|{user_id}|{page-1}"))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"my_products|{user_id}|{page+1}"))
-    if nav_buttons:
-        buttons.append(nav_buttons)
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_sell")])
-    markup = simple_markup(buttons)
-    await callback.message.answer(f"Ваши товары (страница {page}/{total_pages}):", reply_markup=markup)
-    await callback.answer()
-
-# ---------------- My Sales ----------------
-@dp.callback_query(lambda c: c.data.startswith("my_sales|"))
-async def cb_my_sales(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    parts = callback.data.split("|")
-    seller_id = int(parts[1])
-    page = int(parts[2]) if len(parts) > 2 else 1
-    per_page = 10
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT user_id FROM sellers WHERE id=?", (seller_id,)) as cur:
-            seller = await cur.fetchone()
-        if not seller or seller['user_id'] != callback.from_user.id:
-            await callback.message.answer("❌ Это не ваши продажи!")
-            await callback.answer()
-            return
-        async with conn.execute("SELECT COUNT(*) as cnt FROM orders WHERE seller_id=?", (seller_id,)) as cur:
-            total = (await cur.fetchone())['cnt']
-        async with conn.execute("""SELECT o.id, o.price, o.created_at, p.title, u.username
-                                FROM orders o
-                                JOIN products p ON o.product_id = p.id
-                                JOIN users u ON o.user_id = u.user_id
-                                WHERE o.seller_id=?
-                                ORDER BY o.created_at DESC LIMIT ? OFFSET ?""", 
-                                (seller_id, per_page, (page-1)*per_page)) as cur:
-            orders = await cur.fetchall()
-    if not orders:
-        await callback.message.answer("У вас пока нет продаж.", reply_markup=main_menu_markup(callback.from_user.id))
-        await callback.answer()
-        return
-    msk_tz = pytz.timezone('Europe/Moscow')
-    text = f"📊 Ваши продажи (страница {page}/{total_pages}):\n\n"
-    for o in orders:
-        created_at_msk = datetime.fromisoformat(o['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
-        text += f"🛒 {o['title']} — {format_money(o['price'])} (@{o['username'] or 'анон'}, {created_at_msk})\n"
-    total_pages = (total + per_page - 1) // per_page
-    buttons = []
-    if page > 1:
-        buttons.append([InlineKeyboardButton(text="◀️ Prev", callback_data=f"my_sales|{seller_id}|{page-1}")])
-    if page < total_pages:
-        buttons.append([InlineKeyboardButton(text="Next ▶️", callback_data=f"my_sales|{seller_id}|{page+1}")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_sell")])
-    markup = simple_markup(buttons)
-    await callback.message.answer(text, reply_markup=markup)
-    await callback.answer()
-
-# ---------------- Admin Panel ----------------
-@dp.callback_query(lambda c: c.data == "menu_admin")
-async def cb_admin_panel(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    markup = simple_markup([
-        [InlineKeyboardButton(text="📁 Категории", callback_data="admin_cats")],
-        [InlineKeyboardButton(text="🔍 Найти пользователя", callback_data="admin_search_user")],
-        [InlineKeyboardButton(text="🔍 Найти товар", callback_data="admin_search_product")],
-        [InlineKeyboardButton(text="⚖️ Споры", callback_data="admin_disputes")],
-        [InlineKeyboardButton(text="🛠 Технические работы", callback_data="admin_maintenance")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
-    ])
-    await callback.message.answer("🔧 Админ-панель:", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data == "admin_cats")
-async def cb_admin_cats(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    markup = await build_admin_categories_markup()
-    await callback.message.answer("📁 Управление категориями:", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_create_category"))
-async def cb_admin_create_category(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    await state.set_state(AdminNewCategory.name)
-    await callback.message.answer("📝 Введите название новой категории:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminNewCategory.name)
-async def process_admin_new_category(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Создание категории отменено.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")]
-        ]))
-        await state.clear()
-        return
-    name = message.text.strip()
-    try:
-        async with aiosqlite.connect(DB_FILE) as conn:
-            await conn.execute("INSERT INTO categories(name) VALUES (?)", (name,))
-            await conn.commit()
-        await message.answer(f"✅ Категория '{name}' создана.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")]
-        ]))
-    except sqlite3.IntegrityError:
-        await message.answer("❌ Категория с таким названием уже существует.", reply_markup=cancel_markup("Отмена"))
-        return
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_edit_cat|"))
-async def cb_admin_edit_category(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    cat_id = int(callback.data.split("|", 1)[1])
-    await state.set_state(AdminEditCategory.name)
-    await state.set_data({"cat_id": cat_id})
-    await callback.message.answer("📝 Введите новое название категории:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminEditCategory.name)
-async def process_admin_edit_category(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Изменение категории отменено.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")]
-        ]))
-        await state.clear()
-        return
-    name = message.text.strip()
-    data = await state.get_data()
-    cat_id = data.get("cat_id")
-    try:
-        async with aiosqlite.connect(DB_FILE) as conn:
-            await conn.execute("UPDATE categories SET name=? WHERE id=?", (name, cat_id))
-            await conn.commit()
-        await message.answer(f"✅ Категория обновлена: '{name}'.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")]
-        ]))
-    except sqlite3.IntegrityError:
-        await message.answer("❌ Категория с таким названием уже существует.", reply_markup=cancel_markup("Отмена"))
-        return
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_delete_cat|"))
-async def cb_admin_delete_category(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    cat_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT COUNT(*) as cnt FROM products WHERE category_id=?", (cat_id,)) as cur:
-            cnt = (await cur.fetchone())['cnt']
-        if cnt > 0:
-            await callback.message.answer("❌ Нельзя удалить категорию, в которой есть товары.")
-            await callback.answer()
-            return
-        await conn.execute("DELETE FROM categories WHERE id=?", (cat_id,))
-        await conn.execute("DELETE FROM subcategories WHERE category_id=?", (cat_id,))
-        await conn.commit()
-    await callback.message.answer("✅ Категория удалена.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")]
-    ]))
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_view_cat|"))
-async def cb_admin_view_category(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    cat_id = int(callback.data.split("|", 1)[1])
-    markup = await build_admin_subcategories_markup(cat_id)
-    await callback.message.answer(f"📁 Категория ID {cat_id}:", reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_create_sub|"))
-async def cb_admin_create_subcategory(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    cat_id = int(callback.data.split("|", 1)[1])
-    await state.set_state(AdminNewSub.name)
-    await state.set_data({"cat_id": cat_id})
-    await callback.message.answer("📝 Введите название новой подкатегории:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminNewSub.name)
-async def process_admin_new_subcategory(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Создание подкатегории отменено.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")]
-        ]))
-        await state.clear()
-        return
-    name = message.text.strip()
-    data = await state.get_data()
-    cat_id = data.get("cat_id")
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("INSERT INTO subcategories(category_id, name) VALUES (?, ?)", (cat_id, name))
-        await conn.commit()
-    await message.answer(f"✅ Подкатегория '{name}' создана.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_view_cat|{cat_id}")]
-    ]))
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_edit_sub|"))
-async def cb_admin_edit_subcategory(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    sub_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT category_id FROM subcategories WHERE id=?", (sub_id,)) as cur:
-            cat = await cur.fetchone()
-    if not cat:
-        await callback.message.answer("❌ Подкатегория не найдена.")
-        await callback.answer()
-        return
-    await state.set_state(AdminEditSub.name)
-    await state.set_data({"sub_id": sub_id, "cat_id": cat['category_id']})
-    await callback.message.answer("📝 Введите новое название подкатегории:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminEditSub.name)
-async def process_admin_edit_subcategory(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Изменение подкатегории отменено.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")]
-        ]))
-        await state.clear()
-        return
-    name = message.text.strip()
-    data = await state.get_data()
-    sub_id = data.get("sub_id")
-    cat_id = data.get("cat_id")
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("UPDATE subcategories SET name=? WHERE id=?", (name, sub_id))
-        await conn.commit()
-    await message.answer(f"✅ Подкатегория обновлена: '{name}'.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_view_cat|{cat_id}")]
-    ]))
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_delete_sub|"))
-async def cb_admin_delete_subcategory(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    sub_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT category_id FROM subcategories WHERE id=?", (sub_id,)) as cur:
-            cat = await cur.fetchone()
-        if not cat:
-            await callback.message.answer("❌ Подкатегория не найдена.")
-            await callback.answer()
-            return
-        async with conn.execute("SELECT COUNT(*) as cnt FROM products WHERE subcategory_id=?", (sub_id,)) as cur:
-            cnt = (await cur.fetchone())['cnt']
-        if cnt > 0:
-            await callback.message.answer("❌ Нельзя удалить подкатегорию, в которой есть товары.")
-            await callback.answer()
-            return
-        await conn.execute("DELETE FROM subcategories WHERE id=?", (sub_id,))
-        await conn.commit()
-    await callback.message.answer("✅ Подкатегория удалена.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_view_cat|{cat['category_id']}")]
-    ]))
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data == "admin_search_user")
-async def cb_admin_search_user(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    await state.set_state(AdminSearchUser.user_id)
-    await callback.message.answer("🔍 Введите ID пользователя:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminSearchUser.user_id)
-async def process_admin_search_user(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Поиск отменён.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-        ]))
-        await state.clear()
-        return
-    try:
-        user_id = int(message.text.strip())
-    except Exception:
-        await message.answer("❌ Неверный ID. Введите число.", reply_markup=cancel_markup("Отмена"))
-        return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT user_id,username,balance,notify_enabled FROM users WHERE user_id=?", (user_id,)) as cur:
-            user = await cur.fetchone()
-        if not user:
-            await message.answer("❌ Пользователь не найден.", reply_markup=simple_markup([
-                [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-            ]))
-            await state.clear()
-            return
-        text = (f"👤 Пользователь: @{user['username'] or 'анон'}\n"
-                f"🆔 ID: {user['user_id']}\n"
-                f"💰 Баланс: {format_money(user['balance'])}\n"
-                f"🔔 Уведомления: {'вкл' if user['notify_enabled'] else 'выкл'}")
-        markup = simple_markup([
-            [InlineKeyboardButton(text="💸 Изменить баланс", callback_data=f"admin_balance|{user['user_id']}")],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-        ])
-        await message.answer(text, reply_markup=markup)
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_balance|"))
-async def cb_admin_balance(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    user_id = int(callback.data.split("|", 1)[1])
-    await state.set_state(AdminBalanceChange.amount)
-    await state.set_data({"user_id": user_id})
-    await callback.message.answer("💸 Введите новую сумму баланса (RUB):", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminBalanceChange.amount)
-async def process_admin_balance_change(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Изменение баланса отменено.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-        ]))
-        await state.clear()
-        return
-    try:
-        amount = float(message.text.strip().replace(',', '.'))
-        if amount < 0:
-            raise ValueError("Отрицательный баланс")
-    except Exception:
-        await message.answer("❌ Неверная сумма. Введите число (например, 1000.50).", reply_markup=cancel_markup("Отмена"))
-        return
-    data = await state.get_data()
-    user_id = data.get("user_id")
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("UPDATE users SET balance=? WHERE user_id=?", (amount, user_id))
-        await conn.commit()
-    await message.answer(f"✅ Баланс пользователя ID {user_id} обновлён: {format_money(amount)}.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-    ]))
-    if await is_notify_enabled(user_id):
-        try:
-            await bot.send_message(user_id, f"💰 Ваш баланс изменён администратором: {format_money(amount)}")
-        except Exception:
-            pass
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data == "admin_search_product")
-async def cb_admin_search_product(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    await state.set_state(AdminProdSearch.prod_id)
-    await callback.message.answer("🔍 Введите ID товара:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminProdSearch.prod_id)
-async def process_admin_search_product(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Поиск отменён.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-        ]))
-        await state.clear()
-        return
-    try:
-        prod_id = int(message.text.strip())
-    except Exception:
-        await message.answer("❌ Неверный ID. Введите число.", reply_markup=cancel_markup("Отмена"))
-        return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("""SELECT p.*, s.username as seller_username
-                                FROM products p
-                                LEFT JOIN sellers s ON p.seller_id = s.id
-                                WHERE p.id=?""", (prod_id,)) as cur:
-            prod = await cur.fetchone()
-        if not prod:
-            await message.answer("❌ Товар не найден.", reply_markup=simple_markup([
-                [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-            ]))
-            await state.clear()
-            return
-        msk_tz = pytz.timezone('Europe/Moscow')
-        created_at_msk = datetime.fromisoformat(prod['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
-        text = (f"🛒 *{prod['title']}* (ID: {prod['id']})\n\n"
-                f"{prod['description']}\n\n"
-                f"💵 Цена: {format_money(prod['price'])}\n"
-                f"📦 Количество: {prod['quantity']}\n"
-                f"👤 Продавец: @{prod['seller_username'] or 'анон'}\n"
-                f"📅 Создан: {created_at_msk}")
-        markup = simple_markup([
-            [InlineKeyboardButton(text="✏️ Изменить название", callback_data=f"admin_edit_prod_name|{prod['id']}"),
-             InlineKeyboardButton(text="✏️ Изменить описание", callback_data=f"admin_edit_prod_desc|{prod['id']}")],
-            [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"admin_delete_prod|{prod['id']}")],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-        ])
-        if prod['photo_file_id']:
-            await bot.send_photo(message.chat.id, prod['photo_file_id'], caption=text, parse_mode="Markdown", reply_markup=markup)
-        else:
-            await message.answer(text, parse_mode="Markdown", reply_markup=markup)
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_edit_prod_name|"))
-async def cb_admin_edit_product_name(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    prod_id = int(callback.data.split("|", 1)[1])
-    await state.set_state(AdminEditProduct.name)
-    await state.set_data({"prod_id": prod_id})
-    await callback.message.answer("📝 Введите новое название товара:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminEditProduct.name)
-async def process_admin_edit_product_name(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Изменение названия отменено.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-        ]))
-        await state.clear()
-        return
-    name = message.text.strip()
-    if len(name) > 100:
-        await message.answer("❌ Название слишком длинное (макс. 100 символов).", reply_markup=cancel_markup("Отмена"))
-        return
-    data = await state.get_data()
-    prod_id = data.get("prod_id")
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("UPDATE products SET title=? WHERE id=?", (name, prod_id))
-        await conn.commit()
-    await message.answer(f"✅ Название товара обновлено: '{name}'.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-    ]))
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_edit_prod_desc|"))
-async def cb_admin_edit_product_desc(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    prod_id = int(callback.data.split("|", 1)[1])
-    await state.set_state(AdminEditProduct.desc)
-    await state.set_data({"prod_id": prod_id})
-    await callback.message.answer("📝 Введите новое описание товара:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminEditProduct.desc)
-async def process_admin_edit_product_desc(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Изменение описания отменено.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-        ]))
-        await state.clear()
-        return
-    desc = message.text.strip()
-    if len(desc) > 1000:
-        await message.answer("❌ Описание слишком длинное (макс. 1000 символов).", reply_markup=cancel_markup("Отмена"))
-        return
-    data = await state.get_data()
-    prod_id = data.get("prod_id")
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("UPDATE products SET description=? WHERE id=?", (desc, prod_id))
-        await conn.commit()
-    await message.answer(f"✅ Описание товара обновлено.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-    ]))
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_delete_prod|"))
-async def cb_admin_delete_product(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    prod_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("DELETE FROM products WHERE id=?", (prod_id,))
-        await conn.execute("DELETE FROM reviews WHERE product_id=?", (prod_id,))
-        await conn.execute("DELETE FROM disputes WHERE order_id IN (SELECT id FROM orders WHERE product_id=?)", (prod_id,))
-        await conn.execute("DELETE FROM orders WHERE product_id=?", (prod_id,))
-        await conn.commit()
-    await callback.message.answer("✅ Товар удалён.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-    ]))
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data == "admin_disputes")
-async def cb_admin_disputes(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("""SELECT d.id, d.order_id, d.user_id, d.description, d.created_at, u.username, p.title
-                                FROM disputes d
-                                JOIN users u ON d.user_id = u.user_id
-                                JOIN orders o ON d.order_id = o.id
-                                JOIN products p ON o.product_id = p.id
-                                WHERE d.status = 'open'
-                                ORDER BY d.created_at DESC""") as cur:
-            disputes = await cur.fetchall()
-    if not disputes:
-        await callback.message.answer("⚖️ Нет открытых споров.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-        ]))
-        await callback.answer()
-        return
-    msk_tz = pytz.timezone('Europe/Moscow')
-    text = "⚖️ Открытые споры:\n\n"
-    buttons = []
-    for d in disputes:
-        created_at_msk = datetime.fromisoformat(d['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
-        text += f"🆔 Спор {d['id']} (Заказ {d['order_id']}): @{d['username'] or 'анон'}\nТовар: {d['title']}\nОписание: {d['description']}\n📅 {created_at_msk}\n\n"
-        buttons.append([InlineKeyboardButton(text=f"Спор {d['id']}", callback_data=f"admin_view_dispute|{d['id']}")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")])
-    markup = simple_markup(buttons)
-    await callback.message.answer(text, reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_view_dispute|"))
-async def cb_admin_view_dispute(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    dispute_id = int(callback.data.split("|", 1)[1])
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("""SELECT d.id, d.order_id, d.user_id, d.description, d.created_at, u.username, p.title
-                                FROM disputes d
-                                JOIN users u ON d.user_id = u.user_id
-                                JOIN orders o ON d.order_id = o.id
-                                JOIN products p ON o.product_id = p.id
-                                WHERE d.id=?""", (dispute_id,)) as cur:
-            d = await cur.fetchone()
-    if not d:
-        await callback.message.answer("❌ Спор не найден.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_disputes")]
-        ]))
-        await callback.answer()
-        return
-    msk_tz = pytz.timezone('Europe/Moscow')
-    created_at_msk = datetime.fromisoformat(d['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
-    text = (f"⚖️ Спор ID {d['id']} (Заказ {d['order_id']}):\n"
-            f"👤 Пользователь: @{d['username'] or 'анон'}\n"
-            f"🛒 Товар: {d['title']}\n"
-            f"📝 Описание спора: {d['description']}\n"
-            f"📅 Создан: {created_at_msk}")
-    markup = simple_markup([
-        [InlineKeyboardButton(text="✅ Закрыть спор", callback_data=f"admin_close_dispute|{d['id']}")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_disputes")]
-    ])
-    await callback.message.answer(text, reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data.startswith("admin_close_dispute|"))
-async def cb_admin_close_dispute(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    if await maintenance_block(callback): return
-    dispute_id = int(callback.data.split("|", 1)[1])
-    await state.set_state(AdminCloseDispute.reason)
-    await state.set_data({"dispute_id": dispute_id})
-    await callback.message.answer("📝 Укажите причину закрытия спора:", reply_markup=cancel_markup("Отмена"))
-    await callback.answer()
-
-@dp.message(AdminCloseDispute.reason)
-async def process_admin_close_dispute(message: Message, state: FSMContext):
-    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
-        await message.answer("❌ Закрытие спора отменено.", reply_markup=simple_markup([
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_disputes")]
-        ]))
-        await state.clear()
-        return
-    reason = message.text.strip()
-    data = await state.get_data()
-    dispute_id = data.get("dispute_id")
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("UPDATE disputes SET status='closed', close_reason=? WHERE id=?", (reason, dispute_id))
-        await conn.commit()
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT user_id FROM disputes WHERE id=?", (dispute_id,)) as cur:
-            d = await cur.fetchone()
-    await message.answer("✅ Спор закрыт.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_disputes")]
-    ]))
-    if d and await is_notify_enabled(d['user_id']):
-        try:
-            await bot.send_message(d['user_id'], f"⚖️ Ваш спор #{dispute_id} закрыт.\nПричина: {reason}")
-        except Exception:
-            pass
-    await state.clear()
-
-@dp.callback_query(lambda c: c.data == "admin_maintenance")
-async def cb_admin_maintenance(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("❌ Доступ запрещён.")
-        await callback.answer()
-        return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT value FROM settings WHERE key='maintenance'") as cur:
-            current = (await cur.fetchone())['value']
-    new_status = 'off' if current == 'on' else 'on'
-    async with aiosqlite.connect(DB_FILE) as conn:
-        await conn.execute("UPDATE settings SET value=? WHERE key='maintenance'", (new_status,))
-        await conn.commit()
-    status_text = "включены" if new_status == 'on' else "выключены"
-    await callback.message.answer(f"🛠 Технические работы {status_text}.", reply_markup=simple_markup([
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
-    ]))
-    await callback.answer()
-
-# ---------------- Support & Settings ----------------
-@dp.callback_query(lambda c: c.data == "menu_support")
-async def cb_support(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    await callback.message.answer(f"📞 Для поддержки обратитесь к администратору: {ADMIN_USERNAME}", 
-                                reply_markup=main_menu_markup(callback.from_user.id))
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data == "menu_settings")
-async def cb_settings(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT notify_enabled FROM users WHERE user_id=?", (callback.from_user.id,)) as cur:
-            user = await cur.fetchone()
-    notify_status = "вкл" if user['notify_enabled'] else "выкл"
-    text = f"⚙️ Настройки\n\n🔔 Уведомления: {notify_status}"
-    markup = simple_markup([
-        [InlineKeyboardButton(text="🔔 Переключить уведомления", callback_data="toggle_notify")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
-    ])
-    await callback.message.answer(text, reply_markup=markup)
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data == "toggle_notify")
-async def cb_toggle_notify(callback: CallbackQuery):
-    if await maintenance_block(callback): return
-    async with aiosqlite.connect(DB_FILE) as conn:
-        conn.row_factory = aiosqlite.Row
-        async with conn.execute("SELECT notify_enabled FROM users WHERE user_id=?", (callback.from_user.id,)) as cur:
-            user = await cur.fetchone()
-        new_status = 0 if user['notify_enabled'] else 1
-        await conn.execute("UPDATE users SET notify_enabled=? WHERE user_id=?", (new_status, callback.from_user.id))
-        await conn.commit()
-    status_text = "включены" if new_status else "выключены"
-    await callback.message.answer(f"🔔 Уведомления {status_text}.", reply_markup=main_menu_markup(callback.from_user.id))
-    await callback.answer()
-
-@dp.callback_query(lambda c: c.data in ["menu_back_main", "action_cancel"])
-async def cb_back_main(callback: CallbackQuery, state: FSMContext):
-    if await maintenance_block(callback): return
-    await state.clear()
-    await callback.message.answer(f"👋 Главное меню {MARKET_NAME}:", 
-                                parse_mode="Markdown", reply_markup=main_menu_markup(callback.from_user.id))
-    await callback.answer()
-
-# ---------------- Main ----------------
-async def main():
-    await init_db()
-    await dp.start_polling(bot, on_startup=on_startup)
-
-if __name__ == "__main__":
-    asyncio.run(main())
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mexanick Market
+"""
+import asyncio
+import bisect
+import contextvars
+import cProfile
+import hashlib
+import heapq
+import hmac
+import inspect
+import io
+import json
+import logging
+import logging.handlers
+import os
+import pickle
+import pstats
+import re
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+import random
+import pytz
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+from aiogram.filters import CommandObject, CommandStart
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Message
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputMediaPhoto, InputTextMessageContent
+import aiosqlite
+import sqlite3
+import aiohttp
+from aiohttp import web
+
+# ---------------- CONFIG ----------------
+BOT_TOKEN = "8379265766:AAEz5DHkaF3o-edaSR2jJftRpBPADUmo6ds"           
+CRYPTO_TOKEN = "369438:AAEKsbWPZPQ0V3YNV4O0GHcWTvSbzkEar43"       
+ADMIN_ID = 1041720539                       
+ADMIN_USERNAME = "@mexanickq"
+DB_FILE = "mexanick_market.db"
+MARKET_NAME = "💎Mexanick Market💎"
+CRYPTO_PAY_URL = os.getenv('CRYPTO_PAY_URL', 'https://pay.crypt.bot/api')
+CRYPTO_WEBHOOK_PATH = '/cryptopay/webhook'  # Указать в настройках приложения в @CryptoBot
+PAYMENT_RECONCILE_INTERVAL = 300  # Сверка неоплаченных счетов на случай потерянного вебхука, сек
+PAYMENT_RECONCILE_MIN = 30  # Интервал сверки, пока она находит оплаты мимо вебхука, сек
+CRYPTO_PAGE_LIMIT = 1000  # Максимум count в getInvoices
+INVOICE_TTL = 3600  # expires_in счёта в Crypto Pay, сек
+INVOICE_EXPIRE_GRACE = 600  # Запас после истечения, чтобы сверка успела увидеть позднюю оплату, сек
+CRYPTO_ASSETS = ['USDT','BTC','ETH','TON','TRX']
+ASSET_MAP = {'USDT':'tether','BTC':'bitcoin','ETH':'ethereum','TON':'the-open-network','TRX':'tron'}
+COINGECKO_URL = 'https://api.coingecko.com/api/v3'
+RATE_REFRESH_INTERVAL = 60  # Период обновления курсов, сек
+RATE_RETRY_INTERVAL = 5  # Повтор после ошибки обновления, сек
+RATE_MAX_AGE = 600  # Старше этого курс не используется, сек
+PORT = int(os.getenv('PORT', 8080))  # Порт для веб-сервера
+DB_READERS = 4  # Соединений на чтение в пуле
+DB_COMMIT_INTERVAL = 0.005  # Окно группового коммита писателя, сек
+SETTINGS_CACHE_TTL = 60  # Время жизни кэша настроек и уведомлений, сек
+NOTIFY_CACHE_SIZE = 50000
+HTTP_TIMEOUT = 10  # Таймаут запроса к внешним API, сек
+HTTP_RETRIES = 2
+HTTP_BACKOFF = 0.3  # Базовая пауза между повторами, сек
+HTTP_LIMIT_PER_HOST = 10
+BREAKER_THRESHOLD = 5  # Неудачных запросов подряд до размыкания
+BREAKER_COOLDOWN = 30  # сек
+OUTBOX_GLOBAL_RATE = 30  # Сообщений в секунду на бота (лимит Telegram)
+OUTBOX_CHAT_RATE = 1  # Сообщений в секунду в один чат
+OUTBOX_WORKERS = 8
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_FLUSH_INTERVAL = 1  # Период удаления доставленных из очереди в БД, сек
+BROADCAST_CHUNK = 500  # Получателей рассылки на одно чтение и одну отметку прогресса
+BROADCAST_WORKERS = 8
+BROADCAST_MAX_ATTEMPTS = 3  # Попыток на получателя при сетевых ошибках и таймаутах
+BROADCAST_PROGRESS_INTERVAL = 3  # Период обновления прогресса в чате админа, сек
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')  # sqlite | redis | memory
+FSM_REDIS_URL = os.getenv('FSM_REDIS_URL', 'redis://localhost:6379/0')
+FSM_TTL = 86400  # Брошенный сценарий (состояние и данные) забывается через, сек
+FSM_FLUSH_INTERVAL = 0.05  # Окно накопления изменений FSM перед записью в БД, сек
+FSM_EVICT_INTERVAL = 3600  # Период удаления просроченных состояний, сек
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')  # polling | webhook
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL') or os.getenv('RENDER_EXTERNAL_URL', '')  # Публичный https-адрес сервиса
+TELEGRAM_WEBHOOK_PATH = '/telegram/webhook'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = 40  # Параллельных запросов от Telegram
+UPDATE_WORKERS = 16  # Обработчиков обновлений в режиме вебхука
+UPDATE_QUEUE_SIZE = 1000  # Предел необработанных обновлений, дальше вебхук отвечает 503
+UPDATE_DRAIN_TIMEOUT = 10  # Сколько ждать обработки принятых обновлений при остановке, сек
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # Свой Bot API сервер (или подмена для нагрузочных проверок)
+PROCESSES = int(os.getenv('PROCESSES', 1))  # Процессов-обработчиков; больше 1 — режим супервизора
+WORKER_INDEX = int(os.environ['WORKER_INDEX']) if 'WORKER_INDEX' in os.environ else None  # Задаёт супервизор
+MULTIPROCESS = PROCESSES > 1
+IPC_SOCKET = os.getenv('IPC_SOCKET', DB_FILE + '.sock')  # Unix-сокет супервизора: писатель БД и раздача обновлений
+IPC_BUFFER_LIMIT = 4 * 1024 * 1024  # Неотданных обработчику байт, дальше новые обновления отклоняются
+WORKER_RESTART_DELAY = 1  # Пауза перед перезапуском упавшего обработчика, сек
+WORKER_STOP_TIMEOUT = 30  # Сколько ждать завершения обработчиков при остановке, сек
+LEADER_LEASE_TTL = 15  # Срок аренды лидера (сверка, очередь уведомлений, рассылки), сек
+OUTBOX_POLL_INTERVAL = 0.2  # Как часто лидер забирает уведомления других процессов, сек
+BROADCAST_POLL_INTERVAL = 2  # Как часто лидер проверяет новые и остановленные рассылки, сек
+SEARCH_MAX_TERMS = 8  # Слов запроса, дальше отбрасываются
+SEARCH_FACET_ROWS = 1000  # По скольким лучшим совпадениям считать кнопки категорий
+INLINE_PAGE = 20  # Результатов на страницу инлайн-поиска (максимум Telegram — 50)
+INLINE_CACHE_TIME = 60  # cache_time ответа на инлайн-запрос и срок жизни ответа в нашем кэше, сек
+INLINE_CACHE_SIZE = 2000  # Сколько страниц инлайн-ответов держать в памяти
+NAV_RENDER_TTL = 86400  # Сколько помнить, какой экран показан в сообщении меню, сек
+NAV_RENDER_SIZE = 20000  # Сообщений меню, для которых помнится показанный экран
+MARKUP_VERSION_CHECK = 2  # Как часто процесс сверяет версию каталога для кэша клавиатур (при PROCESSES > 1), сек
+PRODUCT_CARD_CACHE_SIZE = 5000  # Отрисованных карточек товаров в памяти
+METRICS_PATH = '/metrics'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # Bearer-токен для METRICS_PATH; пусто — эндпоинт не публикуется
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Границы корзин гистограмм задержек, сек
+METRICS_PUSH_INTERVAL = 5  # Как часто обработчик отправляет метрики супервизору (при PROCESSES > 1), сек
+LOOP_LAG_INTERVAL = 0.5  # Период замера задержки цикла событий, сек
+PROFILE_SLOW_THRESHOLD = float(os.getenv('PROFILE_SLOW_THRESHOLD', 1.0))  # Обновление дольше этого попадает в журнал медленных, сек
+PROFILE_SAMPLE_RATE = 0.01  # Доля обновлений под cProfile; профиль пишется, только если обновление медленное
+PROFILE_STATS_LINES = 30  # Строк профиля в записи журнала
+SLOW_LOG_FILE = os.getenv('SLOW_LOG_FILE', 'slow_updates.log')  # У обработчиков при PROCESSES > 1 — с суффиксом .wN
+SLOW_LOG_MAX_BYTES = 5 * 1024 * 1024
+SLOW_LOG_BACKUPS = 3
+PROFILE_FLUSH_INTERVAL = 60  # Как часто поминутные времена обработчиков пишутся в БД, сек
+PROFILE_WINDOW = 3600  # За какой период админ видит самые медленные обработчики, сек
+PROFILE_RETENTION = 86400  # Сколько хранить поминутные времена обработчиков, сек
+PROFILE_TOP = 10
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,  # KiB
+    'busy_timeout': 5000,
+}
+# ----------------------------------------
+
+LOG_PREFIX = f"[w{WORKER_INDEX}] " if WORKER_INDEX is not None else ""
+logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - {LOG_PREFIX}%(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+
+# ---------------- States ----------------
+class DepositState(StatesGroup):
+    asset = State()
+    amount = State()
+
+class SellerCreate(StatesGroup):
+    info = State()
+
+class SellerEditInfo(StatesGroup):
+    info = State()
+
+class AddProduct(StatesGroup):
+    photo = State()
+    title = State()
+    desc = State()
+    price = State()
+    quantity = State()
+    content = State()
+
+class EditProduct(StatesGroup):
+    field = State()
+    value = State()
+
+class AdminNewCategory(StatesGroup):
+    name = State()
+
+class AdminEditCategory(StatesGroup):
+    cat_id = State()
+    name = State()
+
+class AdminNewSub(StatesGroup):
+    name = State()
+
+class AdminEditSub(StatesGroup):
+    sub_id = State()
+    name = State()
+
+class AdminSearchUser(StatesGroup):
+    user_id = State()
+
+class AdminBalanceChange(StatesGroup):
+    amount = State()
+
+class AdminProdSearch(StatesGroup):
+    prod_id = State()
+
+class AdminEditProduct(StatesGroup):
+    name = State()
+    desc = State()
+
+class AdminBroadcast(StatesGroup):
+    text = State()
+
+class ReviewState(StatesGroup):
+    rating = State()
+    text = State()
+
+class DisputeState(StatesGroup):
+    description = State()
+
+class AdminCloseDispute(StatesGroup):
+    reason = State()
+
+class SettingsState(StatesGroup):
+    action = State()
+
+class SearchState(StatesGroup):
+    query = State()
+
+# ---------------- Database pool ----------------
+class _WriteJob:
+    """Заявка на писателя: транзакционный блок, скрипт или остановка"""
+    __slots__ = ('kind', 'script', 'granted', 'done', 'committed')
+
+    def __init__(self, kind, script=None):
+        loop = asyncio.get_running_loop()
+        self.kind = kind
+        self.script = script
+        self.granted = loop.create_future()
+        self.done = loop.create_future()
+        self.committed = loop.create_future()
+
+class DBPool:
+    """Пул соединений SQLite: фиксированный набор читателей и один писатель.
+
+    Все записи проходят через одну задачу-писателя: каждый блок db.write()
+    выполняется в своём SAVEPOINT, а накопленные за DB_COMMIT_INTERVAL блоки
+    фиксируются одним COMMIT. Читатели в режиме WAL не ждут писателя.
+    """
+
+    def __init__(self, path, readers=DB_READERS, writer_socket=None):
+        self.path = path
+        self.size = readers
+        self._readers = asyncio.Queue()
+        self._reader_conns = []
+        self._writer = None
+        # Worker processes write through the supervisor's writer (see RemoteWriter)
+        self._remote = RemoteWriter(writer_socket) if writer_socket else None
+        self._jobs = asyncio.Queue()
+        self._task = None
+        self._statements = []  # (kind, [executed]) per connection
+        self.counters = {
+            'read_checkouts': 0, 'read_wait_total': 0.0, 'read_wait_max': 0.0,
+            'write_checkouts': 0, 'write_wait_total': 0.0, 'write_wait_max': 0.0,
+            'write_batches': 0, 'write_rollbacks': 0, 'write_errors': 0,
+        }
+
+    async def _connect(self, kind, **kwargs):
+        conn = await aiosqlite.connect(self.path, **kwargs)
+        conn.row_factory = aiosqlite.Row
+        for name, value in DB_PRAGMAS.items():
+            await conn.execute(f"PRAGMA {name}={value}")
+        executed = [0]
+
+        def trace(sql):
+            # Called on the connection's own thread, so each counter has a single writer
+            if not sql.startswith('--'):  # trigger bodies
+                executed[0] += 1
+        await conn.set_trace_callback(trace)
+        self._statements.append((kind, executed))
+        return conn
+
+    async def open(self):
+        if self._reader_conns:
+            return
+        if self._remote is None:
+            # Autocommit: transactions are managed explicitly by the writer task
+            self._writer = await self._connect('write', isolation_level=None)
+            self._task = asyncio.create_task(self._run_writer())
+        for _ in range(self.size):
+            conn = await self._connect('read')
+            await conn.execute("PRAGMA query_only=ON")
+            self._reader_conns.append(conn)
+            self._readers.put_nowait(conn)
+        if self._remote is None:
+            logger.info("Пул БД открыт: %d читателей, 1 писатель", self.size)
+        else:
+            logger.info("Пул БД открыт: %d читателей, писатель в %s", self.size, self._remote.path)
+
+    async def close(self):
+        if not self._reader_conns:
+            return
+        if self._remote is not None:
+            self._remote.close()
+        else:
+            await self._jobs.put(_WriteJob('stop'))
+            await self._task
+            await self._writer.close()
+            self._writer = None
+        for _ in range(len(self._reader_conns)):
+            conn = await self._readers.get()
+            await conn.close()
+        self._reader_conns.clear()
+        logger.info("Пул БД закрыт")
+
+    def _checkout(self, kind, started):
+        waited = time.monotonic() - started
+        c = self.counters
+        c[f'{kind}_checkouts'] += 1
+        c[f'{kind}_wait_total'] += waited
+        if waited > c[f'{kind}_wait_max']:
+            c[f'{kind}_wait_max'] = waited
+
+    @asynccontextmanager
+    async def read(self):
+        started = time.monotonic()
+        conn = await self._readers.get()
+        self._checkout('read', started)
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+            elapsed = time.monotonic() - started
+            db_seconds.observe(elapsed, ('read',))
+            add_span('db', elapsed)
+
+    @asynccontextmanager
+    async def write(self):
+        """Блок записи: возвращает управление после COMMIT своей группы"""
+        started = time.monotonic()
+        if self._remote is not None:
+            async with self._remote.block() as conn:
+                self._checkout('write', started)
+                yield conn
+            elapsed = time.monotonic() - started
+            db_seconds.observe(elapsed, ('write',))
+            add_span('db', elapsed)
+            return
+        job = _WriteJob('tx')
+        self._jobs.put_nowait(job)
+        try:
+            conn = await job.granted
+        except asyncio.CancelledError:
+            # Cancelled right after the writer handed us the connection
+            if job.granted.done() and not job.granted.cancelled():
+                job.done.set_result(None)
+            raise
+        self._checkout('write', started)
+        try:
+            yield conn
+        except BaseException as e:
+            job.done.set_result(e)
+            raise
+        job.done.set_result(None)
+        await job.committed
+        elapsed = time.monotonic() - started
+        db_seconds.observe(elapsed, ('write',))
+        add_span('db', elapsed)
+
+    async def executescript(self, script):
+        """Выполняет скрипт вне групповой транзакции (DDL, миграции)"""
+        if self._remote is not None:
+            await self._remote.script(script)
+            return
+        job = _WriteJob('script', script)
+        self._jobs.put_nowait(job)
+        await job.committed
+
+    async def _run_writer(self):
+        conn = self._writer
+        carry = None
+        while True:
+            job = carry or await self._jobs.get()
+            carry = None
+            if job.kind == 'stop':
+                return
+            if job.kind == 'script':
+                try:
+                    await conn.executescript(job.script)
+                except Exception as e:
+                    await self._rollback(conn)
+                    job.committed.set_exception(e)
+                else:
+                    job.committed.set_result(None)
+                continue
+            batch = []
+            current = job
+            deadline = time.monotonic() + DB_COMMIT_INTERVAL
+            try:
+                await conn.execute("BEGIN")
+                while True:
+                    if await self._run_job(conn, current):
+                        batch.append(current)
+                    current = None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if self._jobs.empty():
+                        await asyncio.sleep(remaining)
+                        if self._jobs.empty():
+                            break
+                    job = self._jobs.get_nowait()
+                    if job.kind != 'tx':
+                        carry = job
+                        break
+                    current = job
+                await conn.execute("COMMIT")
+            except Exception as e:
+                # BEGIN, SAVEPOINT, RELEASE or COMMIT failed: the whole group is lost,
+                # but the writer must survive or every later db.write() hangs
+                self.counters['write_errors'] += 1
+                logger.error("DB writer batch of %d failed: %s", len(batch) + (current is not None), e)
+                await self._rollback(conn)
+                for j in batch + ([current] if current is not None else []):
+                    self._fail(j, e)
+            else:
+                self.counters['write_batches'] += 1
+                for j in batch:
+                    if not j.committed.done():
+                        j.committed.set_result(None)
+
+    async def _rollback(self, conn):
+        try:
+            if conn.in_transaction:
+                await conn.execute("ROLLBACK")
+        except Exception as e:
+            logger.error("DB writer rollback failed: %s", e)
+
+    @staticmethod
+    def _fail(job, error):
+        if not job.granted.done():
+            # SAVEPOINT failed before the block got the connection
+            job.granted.set_exception(error)
+        elif job.granted.cancelled() or not job.done.done() or job.done.result() is not None:
+            # Nobody waits for the commit: the block was cancelled or has already raised
+            return
+        elif not job.committed.done():
+            job.committed.set_exception(error)
+
+    async def _run_job(self, conn, job):
+        if job.granted.cancelled():
+            return False
+        await conn.execute("SAVEPOINT job")
+        job.granted.set_result(conn)
+        error = await job.done
+        if error is None:
+            await conn.execute("RELEASE job")
+            return True
+        self.counters['write_rollbacks'] += 1
+        await conn.execute("ROLLBACK TO job")
+        await conn.execute("RELEASE job")
+        return False
+
+    def stats(self):
+        c = self.counters
+        return {
+            **c,
+            'read_wait_avg': c['read_wait_total'] / c['read_checkouts'] if c['read_checkouts'] else 0.0,
+            'write_wait_avg': c['write_wait_total'] / c['write_checkouts'] if c['write_checkouts'] else 0.0,
+            'write_batch_avg': c['write_checkouts'] / c['write_batches'] if c['write_batches'] else 0.0,
+            'read_statements': sum(n[0] for kind, n in self._statements if kind == 'read'),
+            'write_statements': sum(n[0] for kind, n in self._statements if kind == 'write'),
+            'readers_idle': self._readers.qsize(),
+            'write_queue': self._jobs.qsize(),
+        }
+
+_IPC_HEADER = struct.Struct('!I')
+
+def ipc_send(writer, obj):
+    """Кадр межпроцессного обмена: длина и pickle (сокет доступен только владельцу)"""
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    writer.write(_IPC_HEADER.pack(len(data)) + data)
+
+async def ipc_recv(reader):
+    try:
+        header = await reader.readexactly(_IPC_HEADER.size)
+        return pickle.loads(await reader.readexactly(_IPC_HEADER.unpack(header)[0]))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+class RemoteRow:
+    """Строка результата от удалённого писателя: доступ по имени и по индексу, как у sqlite3.Row"""
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._columns[key] if isinstance(key, str) else key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._columns)
+
+class RemoteCursor:
+    def __init__(self, reply):
+        _, names, values, self.lastrowid, self.rowcount = reply
+        columns = {name: i for i, name in enumerate(names)}
+        self._rows = deque(RemoteRow(columns, v) for v in values)
+
+    async def fetchone(self):
+        return self._rows.popleft() if self._rows else None
+
+    async def fetchall(self):
+        rows, self._rows = list(self._rows), deque()
+        return rows
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+class _RemoteCall:
+    """Как результат aiosqlite execute: можно await и можно async with"""
+    def __init__(self, coro):
+        self._coro = coro
+
+    def __await__(self):
+        return self._cursor().__await__()
+
+    async def _cursor(self):
+        return RemoteCursor(await self._coro)
+
+    async def __aenter__(self):
+        return await self._cursor()
+
+    async def __aexit__(self, *exc):
+        pass
+
+class RemoteConnection:
+    """Соединение внутри удалённого блока db.write(): каждый запрос — обмен с писателем"""
+
+    def __init__(self, remote, channel):
+        self._remote = remote
+        self._channel = channel
+
+    def execute(self, sql, params=()):
+        return _RemoteCall(self._remote.call(self._channel, ('execute', sql, params)))
+
+    def executemany(self, sql, seq):
+        return _RemoteCall(self._remote.call(self._channel, ('executemany', sql, list(seq))))
+
+class _Channel:
+    __slots__ = ('reader', 'writer', 'broken')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.broken = False
+
+class RemoteWriter:
+    """Клиент писателя супервизора: блок db.write() идёт по своему соединению с сокетом.
+
+    Писатель держит SAVEPOINT блока, пока клиент не пришлёт commit или rollback;
+    обрыв соединения откатывает блок. Свободные соединения переиспользуются.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.idle = []
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        ipc_send(writer, ('db',))
+        return _Channel(reader, writer)
+
+    async def call(self, channel, message):
+        try:
+            ipc_send(channel.writer, message)
+            await channel.writer.drain()
+            reply = await ipc_recv(channel.reader)
+        except BaseException:
+            # Cancelled or failed mid-exchange: the reply can no longer be matched
+            channel.broken = True
+            raise
+        if reply is None:
+            channel.broken = True
+            raise ConnectionError("DB writer connection closed")
+        if reply[0] == 'error':
+            raise reply[1]
+        return reply
+
+    def _release(self, channel):
+        if channel.broken:
+            channel.writer.close()
+        else:
+            self.idle.append(channel)
+
+    @asynccontextmanager
+    async def block(self):
+        channel = self.idle.pop() if self.idle else await self._connect()
+        try:
+            await self.call(channel, ('begin',))
+        except BaseException:
+            self._release(channel)
+            raise
+        try:
+            yield RemoteConnection(self, channel)
+        except BaseException:
+            if not channel.broken:
+                try:
+                    await self.call(channel, ('rollback',))
+                except Exception:
+                    pass
+            self._release(channel)
+            raise
+        try:
+            await self.call(channel, ('commit',))
+        finally:
+            self._release(channel)
+
+    async def script(self, script):
+        channel = self.idle.pop() if self.idle else await self._connect()
+        try:
+            await self.call(channel, ('script', script))
+        finally:
+            self._release(channel)
+
+    def close(self):
+        for channel in self.idle:
+            channel.writer.close()
+        self.idle.clear()
+
+db = DBPool(DB_FILE, writer_socket=IPC_SOCKET if WORKER_INDEX is not None else None)
+
+# ---------------- FSM storage ----------------
+class SQLiteStorage(BaseStorage):
+    """Состояния FSM в таблице fsm той же БД.
+
+    Изменения копятся в памяти FSM_FLUSH_INTERVAL и пишутся одним блоком, так
+    что set_state и update_data одного обработчика дают одну запись. Состояние
+    старше FSM_TTL считается брошенным: оно не читается и удаляется evict().
+    """
+
+    def __init__(self, ttl=FSM_TTL):
+        self.ttl = ttl
+        self.pending = {}  # key -> (state, data) not yet handed to the writer
+        self.flushing = {}  # batch currently being written
+        self._flush_task = None
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+                f"{key.business_connection_id or ''}:{key.destiny}")
+
+    def _unflushed(self, k):
+        if k in self.pending:
+            return self.pending[k]
+        return self.flushing.get(k)
+
+    async def _get(self, k):
+        value = self._unflushed(k)
+        if value is not None:
+            return value
+        async with db.read() as conn:
+            async with conn.execute(HOT_QUERIES['fsm_get'][0], (k, time.time() - self.ttl)) as cur:
+                row = await cur.fetchone()
+        # A write for this key may have landed while we were reading
+        value = self._unflushed(k)
+        if value is not None:
+            return value
+        return (row['state'], json.loads(row['data'])) if row else (None, {})
+
+    def _put(self, k, state, data):
+        self.pending[k] = (state, data)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(FSM_FLUSH_INTERVAL)
+        await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        self.flushing = batch
+        now = time.time()
+        try:
+            async with db.write() as conn:
+                await conn.executemany("DELETE FROM fsm WHERE key=?",
+                                       [(k,) for k, (state, data) in batch.items() if state is None and not data])
+                await conn.executemany("""INSERT INTO fsm(key,state,data,updated_at) VALUES (?,?,?,?)
+                                       ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data,
+                                       updated_at=excluded.updated_at""",
+                                       [(k, state, json.dumps(data, ensure_ascii=False), now)
+                                        for k, (state, data) in batch.items() if state is not None or data])
+        except Exception:
+            # Keep the batch for the next flush unless newer values replaced it
+            for k, value in batch.items():
+                self.pending.setdefault(k, value)
+            raise
+        finally:
+            if self.flushing is batch:
+                self.flushing = {}
+
+    async def set_state(self, key: StorageKey, state=None):
+        k = self._key(key)
+        _, data = await self._get(k)
+        self._put(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._get(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data):
+        k = self._key(key)
+        state, _ = await self._get(k)
+        self._put(k, state, dict(data))
+
+    async def get_data(self, key: StorageKey):
+        return dict((await self._get(self._key(key)))[1])
+
+    async def evict(self):
+        async with db.write() as conn:
+            cur = await conn.execute("DELETE FROM fsm WHERE updated_at < ?", (time.time() - self.ttl,))
+            return cur.rowcount
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(FSM_EVICT_INTERVAL)
+            try:
+                evicted = await self.evict()
+                if evicted:
+                    logger.info(f"FSM: удалено {evicted} брошенных состояний")
+            except Exception as e:
+                logging.error("FSM eviction error: %s", e)
+
+    async def close(self):
+        await self.flush()
+
+def make_storage():
+    if FSM_STORAGE == 'redis':
+        # Optional dependency: pip install redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(FSM_REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    if FSM_STORAGE == 'memory':
+        return MemoryStorage()
+    return SQLiteStorage()
+
+storage = make_storage()
+dp = Dispatcher(storage=storage)
+
+# ---------------- Database helpers ----------------
+async def init_db():
+    await db.open()
+    await db.executescript("""
+    CREATE TABLE IF NOT EXISTS users(
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        balance REAL DEFAULT 0.0,
+        notify_enabled INTEGER DEFAULT 1
+    );
+    CREATE TABLE IF NOT EXISTS invoices(
+        invoice_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        amount REAL,
+        asset TEXT,
+        status TEXT DEFAULT 'unpaid',
+        hash TEXT,
+        created_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS categories(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS subcategories(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        category_id INTEGER,
+        name TEXT
+    );
+    CREATE TABLE IF NOT EXISTS sellers(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        username TEXT,
+        info TEXT
+    );
+    CREATE TABLE IF NOT EXISTS products(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        seller_id INTEGER,
+        title TEXT,
+        description TEXT,
+        photo_file_id TEXT,
+        category_id INTEGER,
+        subcategory_id INTEGER,
+        price REAL,
+        quantity INTEGER DEFAULT 1,
+        content_text TEXT,
+        content_file_id TEXT,
+        created_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS reviews(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER,
+        user_id INTEGER,
+        username TEXT,
+        rating INTEGER,
+        text TEXT,
+        created_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS disputes(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER,
+        user_id INTEGER,
+        description TEXT,
+        status TEXT DEFAULT 'open',
+        created_at TEXT,
+        close_reason TEXT
+    );
+    CREATE TABLE IF NOT EXISTS settings(
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS orders(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        product_id INTEGER,
+        seller_id INTEGER,
+        price REAL,
+        created_at TEXT
+    );
+    INSERT OR IGNORE INTO settings(key,value) VALUES ('maintenance','off');
+    """)
+    await run_migrations()
+    await check_query_plans()
+
+# ---------------- Migrations ----------------
+# (version, script): each script runs in its own transaction together with the schema_version bump
+# Recomputes ratings from reviews; also used by the admin "rebuild ratings" button
+RATINGS_REBUILD = (
+    "UPDATE reviews SET seller_id=(SELECT seller_id FROM products WHERE id=reviews.product_id)",
+    "DELETE FROM ratings",
+    "INSERT INTO ratings(scope,ident,total,cnt) SELECT 'product', product_id, SUM(rating), COUNT(*) FROM reviews GROUP BY product_id",
+    """INSERT INTO ratings(scope,ident,total,cnt) SELECT 'seller', seller_id, SUM(rating), COUNT(*) FROM reviews
+    WHERE seller_id IS NOT NULL GROUP BY seller_id""",
+)
+
+MIGRATIONS = [
+    (1, """
+    CREATE INDEX IF NOT EXISTS idx_products_category ON products(category_id, created_at, id, title);
+    CREATE INDEX IF NOT EXISTS idx_products_subcategory ON products(subcategory_id, created_at, id, title);
+    CREATE INDEX IF NOT EXISTS idx_products_seller ON products(seller_id, created_at, id, title);
+    CREATE INDEX IF NOT EXISTS idx_subcategories_category ON subcategories(category_id, name);
+    CREATE INDEX IF NOT EXISTS idx_sellers_user ON sellers(user_id);
+    CREATE INDEX IF NOT EXISTS idx_reviews_product ON reviews(product_id, user_id, rating);
+    CREATE INDEX IF NOT EXISTS idx_orders_seller ON orders(seller_id, created_at, id);
+    CREATE INDEX IF NOT EXISTS idx_orders_user_product ON orders(user_id, product_id);
+    CREATE INDEX IF NOT EXISTS idx_orders_product ON orders(product_id);
+    CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices(status, created_at);
+    CREATE INDEX IF NOT EXISTS idx_disputes_status ON disputes(status, created_at);
+    CREATE INDEX IF NOT EXISTS idx_disputes_order ON disputes(order_id);
+    """),
+    # Trigger-maintained list counters
+    (2, """
+    CREATE TABLE IF NOT EXISTS counters(
+        scope TEXT NOT NULL,
+        ident INTEGER NOT NULL,
+        cnt INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(scope, ident)
+    ) WITHOUT ROWID;
+    DELETE FROM counters WHERE scope IN ('cat','sub','seller','sales');
+    INSERT INTO counters(scope,ident,cnt) SELECT 'cat', COALESCE(category_id,0), COUNT(*) FROM products GROUP BY 2;
+    INSERT INTO counters(scope,ident,cnt) SELECT 'sub', COALESCE(subcategory_id,0), COUNT(*) FROM products GROUP BY 2;
+    INSERT INTO counters(scope,ident,cnt) SELECT 'seller', COALESCE(seller_id,0), COUNT(*) FROM products GROUP BY 2;
+    INSERT INTO counters(scope,ident,cnt) SELECT 'sales', COALESCE(seller_id,0), COUNT(*) FROM orders GROUP BY 2;
+    CREATE TRIGGER IF NOT EXISTS trg_products_count_ins AFTER INSERT ON products BEGIN
+        INSERT INTO counters(scope,ident,cnt) VALUES ('cat',COALESCE(NEW.category_id,0),1) ON CONFLICT(scope,ident) DO UPDATE SET cnt=cnt+1;
+        INSERT INTO counters(scope,ident,cnt) VALUES ('sub',COALESCE(NEW.subcategory_id,0),1) ON CONFLICT(scope,ident) DO UPDATE SET cnt=cnt+1;
+        INSERT INTO counters(scope,ident,cnt) VALUES ('seller',COALESCE(NEW.seller_id,0),1) ON CONFLICT(scope,ident) DO UPDATE SET cnt=cnt+1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_products_count_del AFTER DELETE ON products BEGIN
+        UPDATE counters SET cnt=cnt-1 WHERE scope='cat' AND ident=COALESCE(OLD.category_id,0);
+        UPDATE counters SET cnt=cnt-1 WHERE scope='sub' AND ident=COALESCE(OLD.subcategory_id,0);
+        UPDATE counters SET cnt=cnt-1 WHERE scope='seller' AND ident=COALESCE(OLD.seller_id,0);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_products_count_upd AFTER UPDATE OF category_id, subcategory_id, seller_id ON products BEGIN
+        UPDATE counters SET cnt=cnt-1 WHERE scope='cat' AND ident=COALESCE(OLD.category_id,0);
+        UPDATE counters SET cnt=cnt-1 WHERE scope='sub' AND ident=COALESCE(OLD.subcategory_id,0);
+        UPDATE counters SET cnt=cnt-1 WHERE scope='seller' AND ident=COALESCE(OLD.seller_id,0);
+        INSERT INTO counters(scope,ident,cnt) VALUES ('cat',COALESCE(NEW.category_id,0),1) ON CONFLICT(scope,ident) DO UPDATE SET cnt=cnt+1;
+        INSERT INTO counters(scope,ident,cnt) VALUES ('sub',COALESCE(NEW.subcategory_id,0),1) ON CONFLICT(scope,ident) DO UPDATE SET cnt=cnt+1;
+        INSERT INTO counters(scope,ident,cnt) VALUES ('seller',COALESCE(NEW.seller_id,0),1) ON CONFLICT(scope,ident) DO UPDATE SET cnt=cnt+1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_orders_count_ins AFTER INSERT ON orders BEGIN
+        INSERT INTO counters(scope,ident,cnt) VALUES ('sales',COALESCE(NEW.seller_id,0),1) ON CONFLICT(scope,ident) DO UPDATE SET cnt=cnt+1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_orders_count_del AFTER DELETE ON orders BEGIN
+        UPDATE counters SET cnt=cnt-1 WHERE scope='sales' AND ident=COALESCE(OLD.seller_id,0);
+    END;
+    """),
+    # Undelivered outbound notifications, replayed on startup
+    (3, """
+    CREATE TABLE IF NOT EXISTS outbox(
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        method TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at TEXT
+    );
+    """),
+    # Admin broadcasts; cursor is the last user_id handled, for resuming after a restart
+    (4, """
+    CREATE TABLE IF NOT EXISTS broadcasts(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        admin_chat_id INTEGER NOT NULL,
+        progress_message_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'running',
+        cursor INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT,
+        finished_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status);
+    """),
+    # Persistent FSM storage (SQLiteStorage)
+    (5, """
+    CREATE TABLE IF NOT EXISTS fsm(
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm(updated_at);
+    """),
+    (6, """
+    CREATE TABLE IF NOT EXISTS leases(
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    """),
+    # Rating sum/count per product and per seller, maintained by triggers on reviews
+    (7, """
+    ALTER TABLE reviews ADD COLUMN seller_id INTEGER;
+    CREATE INDEX idx_reviews_seller ON reviews(seller_id, created_at);
+    CREATE TABLE IF NOT EXISTS ratings(
+        scope TEXT NOT NULL,
+        ident INTEGER NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        cnt INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(scope, ident)
+    ) WITHOUT ROWID;
+    """ + ";\n".join(RATINGS_REBUILD) + """;
+    CREATE TRIGGER IF NOT EXISTS trg_reviews_rating_ins AFTER INSERT ON reviews BEGIN
+        INSERT INTO ratings(scope,ident,total,cnt) VALUES ('product',NEW.product_id,NEW.rating,1)
+            ON CONFLICT(scope,ident) DO UPDATE SET total=total+excluded.total, cnt=cnt+1;
+        INSERT INTO ratings(scope,ident,total,cnt) SELECT 'seller',NEW.seller_id,NEW.rating,1 WHERE NEW.seller_id IS NOT NULL
+            ON CONFLICT(scope,ident) DO UPDATE SET total=total+excluded.total, cnt=cnt+1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reviews_rating_del AFTER DELETE ON reviews BEGIN
+        UPDATE ratings SET total=total-OLD.rating, cnt=cnt-1 WHERE scope='product' AND ident=OLD.product_id;
+        UPDATE ratings SET total=total-OLD.rating, cnt=cnt-1 WHERE scope='seller' AND ident=OLD.seller_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reviews_rating_upd AFTER UPDATE OF rating, product_id, seller_id ON reviews BEGIN
+        UPDATE ratings SET total=total-OLD.rating, cnt=cnt-1 WHERE scope='product' AND ident=OLD.product_id;
+        UPDATE ratings SET total=total-OLD.rating, cnt=cnt-1 WHERE scope='seller' AND ident=OLD.seller_id;
+        INSERT INTO ratings(scope,ident,total,cnt) VALUES ('product',NEW.product_id,NEW.rating,1)
+            ON CONFLICT(scope,ident) DO UPDATE SET total=total+excluded.total, cnt=cnt+1;
+        INSERT INTO ratings(scope,ident,total,cnt) SELECT 'seller',NEW.seller_id,NEW.rating,1 WHERE NEW.seller_id IS NOT NULL
+            ON CONFLICT(scope,ident) DO UPDATE SET total=total+excluded.total, cnt=cnt+1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_products_rating_seller AFTER UPDATE OF seller_id ON products BEGIN
+        UPDATE reviews SET seller_id=NEW.seller_id WHERE product_id=NEW.id;
+    END;
+    """),
+    # Full-text search over title and description; rank is BM25 with the title weighted 10x
+    (8, """
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        title, description, content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    );
+    INSERT INTO products_fts(products_fts) VALUES ('rebuild');
+    INSERT INTO products_fts(products_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)');
+    CREATE TRIGGER IF NOT EXISTS trg_products_fts_ins AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid,title,description) VALUES (NEW.id,NEW.title,NEW.description);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_products_fts_del AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts,rowid,title,description) VALUES ('delete',OLD.id,OLD.title,OLD.description);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_products_fts_upd AFTER UPDATE OF title, description ON products BEGIN
+        INSERT INTO products_fts(products_fts,rowid,title,description) VALUES ('delete',OLD.id,OLD.title,OLD.description);
+        INSERT INTO products_fts(rowid,title,description) VALUES (NEW.id,NEW.title,NEW.description);
+    END;
+    """),
+    # Catalog version: any change to categories or subcategories bumps counters('catalog', 0);
+    # a deleted category or subcategory also takes its product counter with it
+    (9, """
+    INSERT OR IGNORE INTO counters(scope,ident,cnt) VALUES ('catalog',0,0);
+    CREATE TRIGGER IF NOT EXISTS trg_categories_version_ins AFTER INSERT ON categories BEGIN
+        UPDATE counters SET cnt=cnt+1 WHERE scope='catalog' AND ident=0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_categories_version_upd AFTER UPDATE ON categories BEGIN
+        UPDATE counters SET cnt=cnt+1 WHERE scope='catalog' AND ident=0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_categories_version_del AFTER DELETE ON categories BEGIN
+        UPDATE counters SET cnt=cnt+1 WHERE scope='catalog' AND ident=0;
+        DELETE FROM counters WHERE scope='cat' AND ident=OLD.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_subcategories_version_ins AFTER INSERT ON subcategories BEGIN
+        UPDATE counters SET cnt=cnt+1 WHERE scope='catalog' AND ident=0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_subcategories_version_upd AFTER UPDATE ON subcategories BEGIN
+        UPDATE counters SET cnt=cnt+1 WHERE scope='catalog' AND ident=0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_subcategories_version_del AFTER DELETE ON subcategories BEGIN
+        UPDATE counters SET cnt=cnt+1 WHERE scope='catalog' AND ident=0;
+        DELETE FROM counters WHERE scope='sub' AND ident=OLD.id;
+    END;
+    """),
+    # Products whose card changed (stock, text, reviews), so other processes can drop their cached card
+    (10, """
+    CREATE TABLE IF NOT EXISTS card_changes(
+        product_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_card_changes_version ON card_changes(version);
+    CREATE TRIGGER IF NOT EXISTS trg_products_card_upd AFTER UPDATE OF title, description, price, quantity, photo_file_id, seller_id ON products BEGIN
+        INSERT OR REPLACE INTO card_changes(product_id, version) VALUES (NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM card_changes));
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_products_card_del AFTER DELETE ON products BEGIN
+        INSERT OR REPLACE INTO card_changes(product_id, version) VALUES (OLD.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM card_changes));
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reviews_card_ins AFTER INSERT ON reviews BEGIN
+        INSERT OR REPLACE INTO card_changes(product_id, version) VALUES (NEW.product_id, (SELECT COALESCE(MAX(version), 0) + 1 FROM card_changes));
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reviews_card_upd AFTER UPDATE OF rating, product_id ON reviews BEGIN
+        INSERT OR REPLACE INTO card_changes(product_id, version) VALUES (NEW.product_id, (SELECT COALESCE(MAX(version), 0) + 1 FROM card_changes));
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reviews_card_del AFTER DELETE ON reviews BEGIN
+        INSERT OR REPLACE INTO card_changes(product_id, version) VALUES (OLD.product_id, (SELECT COALESCE(MAX(version), 0) + 1 FROM card_changes));
+    END;
+    """),
+    # Per-minute handler timings from every process, for the admin's slowest-handlers view
+    (11, """
+    CREATE TABLE IF NOT EXISTS handler_timings(
+        minute INTEGER NOT NULL,
+        handler TEXT NOT NULL,
+        cnt INTEGER NOT NULL,
+        total REAL NOT NULL,
+        worst REAL NOT NULL,
+        db REAL NOT NULL,
+        telegram REAL NOT NULL,
+        upstream REAL NOT NULL,
+        PRIMARY KEY(minute, handler)
+    ) WITHOUT ROWID;
+    """),
+]
+
+SEARCH_SQL = """SELECT p.id, p.title, p.price, p.quantity, p.category_id FROM products_fts
+JOIN products p ON p.id = products_fts.rowid WHERE products_fts MATCH ? {cond} ORDER BY rank LIMIT ? OFFSET ?"""
+
+# Queries on the request path that must be served by an index; checked at startup
+HOT_QUERIES = {
+    'products_by_category': ("""SELECT id,title,created_at FROM products WHERE category_id=?
+                             AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?""", (1, '', 0, 10)),
+    'products_by_subcategory': ("""SELECT id,title,created_at FROM products WHERE subcategory_id=?
+                                AND (created_at, id) > (?, ?) ORDER BY created_at ASC, id ASC LIMIT ?""", (1, '', 0, 10)),
+    'products_by_seller': ("""SELECT id,title,created_at FROM products WHERE seller_id=?
+                           AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?""", (1, '', 0, 10)),
+    'list_counter': ("SELECT cnt FROM counters WHERE scope=? AND ident=?", ('cat', 1)),
+    'seller_by_user': ("SELECT id FROM sellers WHERE user_id=?", (1,)),
+    'rating': ("SELECT total, cnt FROM ratings WHERE scope=? AND ident=?", ('product', 1)),
+    'review_exists': ("SELECT 1 FROM reviews WHERE product_id=? AND user_id=? LIMIT 1", (1, 1)),
+    'seller_reviews': ("""SELECT username, rating, text, created_at FROM reviews WHERE seller_id=?
+                       ORDER BY created_at DESC LIMIT 5""", (1,)),
+    'purchase_exists': ("SELECT 1 FROM orders WHERE user_id=? AND product_id=? LIMIT 1", (1, 1)),
+    'sales_by_seller': ("""SELECT o.id, o.price, o.created_at, p.title, u.username FROM orders o
+                        JOIN products p ON o.product_id = p.id JOIN users u ON o.user_id = u.user_id
+                        WHERE o.seller_id=? AND (o.created_at, o.id) < (?, ?)
+                        ORDER BY o.created_at DESC, o.id DESC LIMIT ?""", (1, '', 0, 10)),
+    'unpaid_invoices': ("""SELECT invoice_id,user_id,amount,asset,created_at FROM invoices WHERE status='unpaid'
+                        AND (created_at, invoice_id) > (?, ?)
+                        ORDER BY created_at, invoice_id LIMIT ?""", ('', 0, 1000)),
+    'fsm_get': ("SELECT state,data FROM fsm WHERE key=? AND updated_at >= ?", ('', 0)),
+    'broadcast_recipients': ("SELECT user_id FROM users WHERE user_id > ? AND notify_enabled=1 ORDER BY user_id LIMIT ?", (0, 500)),
+    'search': (SEARCH_SQL.format(cond=''), ('"a"*', 10, 0)),
+    'search_in_category': (SEARCH_SQL.format(cond='AND p.category_id=?'), ('"a"*', 1, 10, 0)),
+    'dispute_exists': ("SELECT 1 FROM disputes WHERE order_id=?", (1,)),
+    'product_card': ("""SELECT p.*, s.user_id as seller_user_id, s.username as seller_username
+                     FROM products p LEFT JOIN sellers s ON p.seller_id = s.id WHERE p.id=?""", (1,)),
+    'card_changes': ("SELECT product_id, version FROM card_changes WHERE version > ?", (0,)),
+    'slowest_handlers': ("""SELECT handler, SUM(cnt) AS cnt, SUM(total) AS total, MAX(worst) AS worst, SUM(db) AS db,
+                         SUM(telegram) AS telegram, SUM(upstream) AS upstream FROM handler_timings WHERE minute >= ?
+                         GROUP BY handler ORDER BY SUM(total) / SUM(cnt) DESC LIMIT ?""", (0, 10)),
+    'open_disputes': ("""SELECT d.id, d.order_id, d.user_id, d.description, d.created_at, u.username, p.title
+                      FROM disputes d JOIN users u ON d.user_id = u.user_id JOIN orders o ON d.order_id = o.id
+                      JOIN products p ON o.product_id = p.id WHERE d.status = 'open' ORDER BY d.created_at DESC""", ()),
+}
+
+async def get_schema_version():
+    async with db.read() as conn:
+        async with conn.execute("SELECT value FROM settings WHERE key='schema_version'") as cur:
+            r = await cur.fetchone()
+    return int(r['value']) if r else 0
+
+async def run_migrations():
+    current = await get_schema_version()
+    for version, script in MIGRATIONS:
+        if version <= current:
+            continue
+        await db.executescript(f"""
+        BEGIN;
+        {script}
+        INSERT OR REPLACE INTO settings(key,value) VALUES ('schema_version','{version}');
+        COMMIT;
+        """)
+        logger.info("Применена миграция схемы %d", version)
+
+async def check_query_plans():
+    """Падает при старте, если горячий запрос читает таблицу полным сканированием"""
+    failures = []
+    async with db.read() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            async with conn.execute("EXPLAIN QUERY PLAN " + sql, params) as cur:
+                plan = [r['detail'] for r in await cur.fetchall()]
+            # An FTS5 "SCAN ... VIRTUAL TABLE INDEX" is the full-text index lookup itself
+            scans = [d for d in plan if d.startswith('SCAN') and 'VIRTUAL TABLE' not in d]
+            if scans:
+                failures.append(f"{name}: {'; '.join(scans)}")
+    if failures:
+        raise RuntimeError("Hot queries fall back to SCAN:\n" + "\n".join(failures))
+
+# ---------------- Caches ----------------
+_MISSING = object()
+
+class TTLCache:
+    """Кэш в памяти с временем жизни записей и счётчиками попаданий"""
+
+    def __init__(self, ttl, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return _MISSING
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        if self.maxsize and len(self._data) > self.maxsize:
+            # Oldest write goes first
+            del self._data[next(iter(self._data))]
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data),
+                'hit_rate': self.hits / total if total else 0.0}
+
+class MarkupCache:
+    """Клавиатуры каталога: строятся при первом показе и живут до правки категорий.
+
+    Сбрасывается деревом категорий (catalog) при любой правке таксономии, в том
+    числе сделанной другим процессом. Закэшированные клавиатуры общие: менять их
+    на месте нельзя.
+    """
+
+    def __init__(self):
+        self.markups = {}
+        self.generation = 0  # bumped by invalidate(); a build started before it is not stored
+        self.counters = {'hits': 0, 'builds': 0, 'invalidations': 0}
+
+    def cached(self, name):
+        def decorator(build):
+            @wraps(build)
+            async def wrapper(*args, **kwargs):
+                return await self.get((name, args, tuple(sorted(kwargs.items()))), lambda: build(*args, **kwargs))
+            return wrapper
+        return decorator
+
+    async def get(self, key, build):
+        await catalog.ready()
+        value = self.markups.get(key, _MISSING)
+        if value is not _MISSING:
+            self.counters['hits'] += 1
+            return value
+        generation = self.generation
+        value = await build()
+        self.counters['builds'] += 1
+        if generation == self.generation:
+            self.markups[key] = value
+        return value
+
+    def invalidate(self):
+        self.markups.clear()
+        self.generation += 1
+        self.counters['invalidations'] += 1
+
+    def stats(self):
+        return {**self.counters, 'size': len(self.markups)}
+
+class CategoryTree:
+    """Категории и подкатегории в памяти с числом товаров в каждой.
+
+    Загружается целиком при старте; обработчики, которые меняют categories,
+    subcategories или состав products, после COMMIT своей записи вносят ту же
+    правку в дерево. Навигация по каталогу читает только его. При нескольких
+    процессах ready() не чаще раза в MARKUP_VERSION_CHECK секунд перечитывает
+    счётчики товаров и, если версия каталога сдвинулась, всё дерево.
+    """
+
+    def __init__(self):
+        self.categories = {}  # id -> {'id', 'name'}
+        self.subcategories = {}  # id -> {'id', 'name', 'category_id'}
+        self.counts = {}  # ('cat' | 'sub', id) -> products
+        self._sorted = None
+        self.version = None
+        self.loaded = False
+        self.checked = 0.0
+        self.counters = {'loads': 0, 'refreshes': 0}
+
+    async def ready(self):
+        if not self.loaded:
+            await self.load()
+        elif MULTIPROCESS and time.monotonic() - self.checked >= MARKUP_VERSION_CHECK:
+            await self.refresh()
+        return self
+
+    async def _read_counts(self, conn):
+        async with conn.execute("SELECT scope, ident, cnt FROM counters WHERE scope IN ('cat','sub','catalog')") as cur:
+            rows = await cur.fetchall()
+        counts = {(r['scope'], r['ident']): r['cnt'] for r in rows}
+        return counts.pop(('catalog', 0), 0), counts
+
+    async def load(self):
+        async with db.read() as conn:
+            async with conn.execute("SELECT id, name FROM categories") as cur:
+                categories = await cur.fetchall()
+            async with conn.execute("SELECT id, category_id, name FROM subcategories") as cur:
+                subcategories = await cur.fetchall()
+            version, counts = await self._read_counts(conn)
+        self.categories = {c['id']: {'id': c['id'], 'name': c['name']} for c in categories}
+        self.subcategories = {s['id']: {'id': s['id'], 'name': s['name'], 'category_id': s['category_id']}
+                              for s in subcategories}
+        self.counts = counts
+        self.version = version
+        self.loaded = True
+        self.checked = time.monotonic()
+        self.counters['loads'] += 1
+        self._changed()
+
+    async def refresh(self):
+        self.checked = time.monotonic()
+        async with db.read() as conn:
+            version, counts = await self._read_counts(conn)
+        self.counters['refreshes'] += 1
+        if version != self.version:
+            await self.load()
+        else:
+            self.counts = counts
+
+    def _changed(self):
+        self._sorted = None
+        markups.invalidate()
+
+    # --- Reads ---
+    def sorted_categories(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.categories.values(), key=lambda c: c['name'])
+        return self._sorted
+
+    def category(self, cat_id):
+        return self.categories.get(cat_id)
+
+    def subcategory(self, sub_id):
+        return self.subcategories.get(sub_id)
+
+    def children(self, cat_id):
+        return sorted((s for s in self.subcategories.values() if s['category_id'] == cat_id), key=lambda s: s['name'])
+
+    def count(self, scope, ident):
+        return self.counts.get((scope, ident), 0)
+
+    def total(self):
+        return sum(cnt for (scope, _), cnt in self.counts.items() if scope == 'cat')
+
+    # --- Write-through, called after the DB write has committed ---
+    def add_category(self, cat_id, name):
+        self.categories[cat_id] = {'id': cat_id, 'name': name}
+        self._changed()
+
+    def rename_category(self, cat_id, name):
+        if cat_id in self.categories:
+            self.categories[cat_id]['name'] = name
+            self._changed()
+
+    def remove_category(self, cat_id):
+        self.categories.pop(cat_id, None)
+        self.counts.pop(('cat', cat_id), None)
+        for sub_id in [s['id'] for s in self.subcategories.values() if s['category_id'] == cat_id]:
+            del self.subcategories[sub_id]
+            self.counts.pop(('sub', sub_id), None)
+        self._changed()
+
+    def add_subcategory(self, sub_id, cat_id, name):
+        self.subcategories[sub_id] = {'id': sub_id, 'name': name, 'category_id': cat_id}
+        self._changed()
+
+    def rename_subcategory(self, sub_id, name):
+        if sub_id in self.subcategories:
+            self.subcategories[sub_id]['name'] = name
+            self._changed()
+
+    def remove_subcategory(self, sub_id):
+        self.subcategories.pop(sub_id, None)
+        self.counts.pop(('sub', sub_id), None)
+        self._changed()
+
+    def product_added(self, cat_id, sub_id, delta=1):
+        # Same keys as the counters triggers: NULL goes to 0
+        for key in (('cat', cat_id or 0), ('sub', sub_id or 0)):
+            self.counts[key] = self.counts.get(key, 0) + delta
+
+    def product_removed(self, cat_id, sub_id):
+        self.product_added(cat_id, sub_id, -1)
+
+    def stats(self):
+        return {**self.counters, 'categories': len(self.categories), 'subcategories': len(self.subcategories)}
+
+class CardCache:
+    """Отрисованные карточки товаров (текст, клавиатура, фото) по id товара.
+
+    Размер ограничен, вытесняется карточка, которую дольше всех не открывали.
+    Обработчики, меняющие товар или его отзывы, после COMMIT вызывают
+    invalidate(pid). При нескольких процессах get() не чаще раза в
+    MARKUP_VERSION_CHECK секунд забирает из card_changes товары, изменённые
+    другими процессами; таблицу ведут триггеры, product_id 0 сбрасывает все карточки.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.cards = OrderedDict()
+        self.generation = 0  # bumped on invalidation; a render started before it is not stored
+        self.version = None
+        self.checked = 0.0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'syncs': 0}
+
+    async def get(self, pid):
+        if MULTIPROCESS and time.monotonic() - self.checked >= MARKUP_VERSION_CHECK:
+            await self.sync()
+        card = self.cards.get(pid)
+        if card is None:
+            self.counters['misses'] += 1
+            return None
+        self.cards.move_to_end(pid)
+        self.counters['hits'] += 1
+        return card
+
+    def set(self, pid, card, generation):
+        if generation != self.generation:
+            return
+        self.cards[pid] = card
+        self.cards.move_to_end(pid)
+        while len(self.cards) > self.maxsize:
+            self.cards.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def invalidate(self, pid=None):
+        if pid is None:
+            self.cards.clear()
+        else:
+            self.cards.pop(pid, None)
+        self.generation += 1
+        self.counters['invalidations'] += 1
+
+    async def sync(self):
+        self.checked = time.monotonic()
+        async with db.read() as conn:
+            if self.version is None:
+                async with conn.execute("SELECT COALESCE(MAX(version), 0) AS v FROM card_changes") as cur:
+                    self.version = (await cur.fetchone())['v']
+                self.invalidate()
+                return
+            async with conn.execute("SELECT product_id, version FROM card_changes WHERE version > ?", (self.version,)) as cur:
+                rows = await cur.fetchall()
+        self.counters['syncs'] += 1
+        for r in rows:
+            self.invalidate(r['product_id'] or None)
+            self.version = max(self.version, r['version'])
+
+    def stats(self):
+        lookups = self.counters['hits'] + self.counters['misses']
+        return {**self.counters, 'size': len(self.cards),
+                'hit_rate': self.counters['hits'] / lookups if lookups else 0.0}
+
+settings_cache = TTLCache(SETTINGS_CACHE_TTL)
+notify_cache = TTLCache(SETTINGS_CACHE_TTL, maxsize=NOTIFY_CACHE_SIZE)
+markups = MarkupCache()
+catalog = CategoryTree()
+product_cards = CardCache(PRODUCT_CARD_CACHE_SIZE)
+
+# ---------------- Utility ----------------
+def now_iso():
+    msk_tz = pytz.timezone('Europe/Moscow')
+    return datetime.now(msk_tz).isoformat()
+
+async def is_maintenance():
+    value = settings_cache.get('maintenance')
+    if value is _MISSING:
+        async with db.read() as conn:
+            async with conn.execute("SELECT value FROM settings WHERE key='maintenance'") as cur:
+                r = await cur.fetchone()
+        value = bool(r and r['value'] == 'on')
+        settings_cache.set('maintenance', value)
+    return value
+
+async def maintenance_block(message: types.Message | CallbackQuery):
+    if await is_maintenance():
+        text = "🛠️ Сейчас идут технические работы. Попробуйте позже."
+        if isinstance(message, CallbackQuery):
+            await message.answer(text)
+            await bot.send_message(message.message.chat.id, text)
+        else:
+            await message.answer(text)
+        return True
+    return False
+
+async def ensure_user_record(user: types.User):
+    async with db.write() as conn:
+        await conn.execute("INSERT OR IGNORE INTO users(user_id,username,balance,notify_enabled) VALUES (?,?,?,?)", 
+                         (user.id, user.username, 0.0, 1))
+        await conn.execute("UPDATE users SET username = ? WHERE user_id = ?", (user.username, user.id))
+
+async def is_notify_enabled(user_id: int) -> bool:
+    value = notify_cache.get(user_id)
+    if value is _MISSING:
+        async with db.read() as conn:
+            async with conn.execute("SELECT notify_enabled FROM users WHERE user_id=?", (user_id,)) as cur:
+                r = await cur.fetchone()
+        value = r['notify_enabled'] == 1 if r else True
+        notify_cache.set(user_id, value)
+    return value
+
+def format_money(amount):
+    return f"{amount:.2f} RUB"
+
+# ---------------- MARKUP HELPER ----------------
+def simple_markup(buttons_list):
+    """Создаёт InlineKeyboardMarkup для aiogram 3.20.0"""
+    inline_keyboard = []
+    for row in buttons_list:
+        if isinstance(row, list):
+            inline_keyboard.append(row)
+        else:
+            inline_keyboard.append([row])
+    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+
+# ---------------- Inline markups ----------------
+# Static keyboards are built once; they are shared, so never modify them in place
+def _main_menu_markup(admin):
+    buttons = [
+        [
+            InlineKeyboardButton(text="💰 Баланс", callback_data="menu_balance"),
+            InlineKeyboardButton(text="💸 Пополнить", callback_data="menu_deposit")
+        ],
+        [
+            InlineKeyboardButton(text="🛍 Товары", callback_data="menu_products"),
+            InlineKeyboardButton(text="➕ Продать", callback_data="menu_sell")
+        ],
+        [
+            InlineKeyboardButton(text="📋 Мои покупки", callback_data="menu_my_orders"),
+            InlineKeyboardButton(text="📞 Поддержка", callback_data="menu_support")
+        ],
+        [
+            InlineKeyboardButton(text="🔎 Поиск", callback_data="menu_search"),
+            InlineKeyboardButton(text="⚙️ Настройки", callback_data="menu_settings")
+        ]
+    ]
+    if admin:
+        buttons.append([InlineKeyboardButton(text="🔧 Админ панель", callback_data="menu_admin")])
+    return simple_markup(buttons)
+
+MAIN_MENU_MARKUP = _main_menu_markup(False)
+ADMIN_MAIN_MENU_MARKUP = _main_menu_markup(True)
+
+def main_menu_markup(user_id: int):
+    return ADMIN_MAIN_MENU_MARKUP if user_id == ADMIN_ID else MAIN_MENU_MARKUP
+
+@lru_cache(maxsize=None)
+def cancel_markup(text="Отмена"):
+    return simple_markup([InlineKeyboardButton(text="❌ " + text, callback_data="action_cancel")])
+
+@lru_cache(maxsize=1024)
+def back_markup(callback_data):
+    return simple_markup([[InlineKeyboardButton(text="⬅️ Назад", callback_data=callback_data)]])
+
+@lru_cache(maxsize=1024)
+def rating_markup(pid):
+    buttons = [[InlineKeyboardButton(text=f"{'⭐' * r} {r}", callback_data=f"leave_rating|{pid}|{r}")] for r in range(5, 0, -1)]
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"view_product|{pid}")])
+    return simple_markup(buttons)
+
+DEPOSIT_MARKUP = simple_markup([
+    [InlineKeyboardButton(text="USDT", callback_data="deposit_asset|USDT"),
+     InlineKeyboardButton(text="BTC", callback_data="deposit_asset|BTC")],
+    [InlineKeyboardButton(text="ETH", callback_data="deposit_asset|ETH"),
+     InlineKeyboardButton(text="TON", callback_data="deposit_asset|TON")],
+    [InlineKeyboardButton(text="TRX", callback_data="deposit_asset|TRX")],
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
+])
+
+ADMIN_PANEL_MARKUP = simple_markup([
+    [InlineKeyboardButton(text="📁 Категории", callback_data="admin_cats")],
+    [InlineKeyboardButton(text="🔍 Найти пользователя", callback_data="admin_search_user")],
+    [InlineKeyboardButton(text="🔍 Найти товар", callback_data="admin_search_product")],
+    [InlineKeyboardButton(text="⚖️ Споры", callback_data="admin_disputes")],
+    [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+    [InlineKeyboardButton(text="🛠 Технические работы", callback_data="admin_maintenance")],
+    [InlineKeyboardButton(text="⭐ Пересчитать рейтинги", callback_data="admin_rebuild_ratings")],
+    [InlineKeyboardButton(text="🐢 Медленные обработчики", callback_data="admin_slow")],
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
+])
+
+# Catalog keyboards come from the DB and live in `markups` until categories change
+
+@markups.cached('categories')
+async def build_categories_markup(admin_view=False, browse=False):
+    buttons = []
+    for c in catalog.sorted_categories():
+        buttons.append([InlineKeyboardButton(text=f"📁 {c['name']}", callback_data=f"cat|{c['id']}")])
+    
+    if browse:
+        buttons.append([InlineKeyboardButton(text="🔎 Листать в инлайн-режиме", switch_inline_query_current_chat="")])
+    if admin_view:
+        buttons.append([InlineKeyboardButton(text="➕ Создать категорию", callback_data="admin_create_category")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")])
+    
+    return simple_markup(buttons)
+
+@markups.cached('admin_categories')
+async def build_admin_categories_markup():
+    buttons = []
+    for c in catalog.sorted_categories():
+        buttons.append([
+            InlineKeyboardButton(text=f"📁 {c['name']}", callback_data=f"admin_view_cat|{c['id']}"),
+            InlineKeyboardButton(text="✏️", callback_data=f"admin_edit_cat|{c['id']}"),
+            InlineKeyboardButton(text="🗑", callback_data=f"admin_delete_cat|{c['id']}")
+        ])
+    buttons.append([InlineKeyboardButton(text="➕ Создать категорию", callback_data="admin_create_category")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")])
+    
+    return simple_markup(buttons)
+
+@markups.cached('admin_subcategories')
+async def build_admin_subcategories_markup(cat_id):
+    buttons = []
+    for s in catalog.children(cat_id):
+        buttons.append([
+            InlineKeyboardButton(text=f"📂 {s['name']}", callback_data=f"list_products|sub|{s['id']}|1"),
+            InlineKeyboardButton(text="✏️", callback_data=f"admin_edit_sub|{s['id']}"),
+            InlineKeyboardButton(text="🗑", callback_data=f"admin_delete_sub|{s['id']}")
+        ])
+    buttons.append([InlineKeyboardButton(text="➕ Создать подкатегорию", callback_data=f"admin_create_sub|{cat_id}")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_cats")])
+    
+    return simple_markup(buttons)
+
+@markups.cached('category')
+async def build_category_markup(cat_id, admin_view=False):
+    """(название, клавиатура) категории для покупателя; (None, None), если её нет"""
+    cat = catalog.category(cat_id)
+    if not cat:
+        return None, None
+    buttons = [[InlineKeyboardButton(text="📦 Все товары в категории", callback_data=f"list_products|cat|{cat_id}|1")],
+               [InlineKeyboardButton(text="🔎 Листать в инлайн-режиме",
+                                     switch_inline_query_current_chat=f"{category_tag(cat_id, cat['name'])} ")]]
+    for s in catalog.children(cat_id):
+        buttons.append([InlineKeyboardButton(text=f"📂 {s['name']}", callback_data=f"list_products|sub|{s['id']}|1")])
+    if admin_view:
+        buttons.append([InlineKeyboardButton(text="➕ Создать подкатегорию", callback_data=f"admin_create_sub|{cat_id}")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_products")])
+    return cat['name'], simple_markup(buttons)
+
+@markups.cached('pick_subcategory')
+async def build_pick_subcategory_markup(cat_id):
+    buttons = [[InlineKeyboardButton(text=f"📂 {s['name']}", callback_data=f"subcat|{s['id']}")] for s in catalog.children(cat_id)]
+    buttons.append([InlineKeyboardButton(text="❌ Отмена", callback_data="action_cancel")])
+    return simple_markup(buttons)
+
+# ---------------- Pagination ----------------
+PER_PAGE = 10
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MSK_TZ = pytz.timezone('Europe/Moscow')
+
+def _b36(n):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+def encode_cursor(created_at, row_id):
+    """(created_at, id) -> короткий токен для callback_data (лимит Telegram 64 байта)"""
+    delta = datetime.fromisoformat(created_at) - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+    return f"{_b36(micros)}.{_b36(row_id)}"
+
+def decode_cursor(token):
+    # created_at is always written by now_iso(), so the MSK isoformat round-trips exactly
+    micros, row_id = token.split(".")
+    created_at = (EPOCH + timedelta(microseconds=int(micros, 36))).astimezone(MSK_TZ).isoformat()
+    return created_at, int(row_id, 36)
+
+def keyset(cursor, alias=""):
+    """SQL-условие, параметры и порядок для страницы относительно курсора.
+
+    Курсор: 'n<token>' — следующая (более старые записи), 'p<token>' — предыдущая.
+    Для 'p' строки выбираются по возрастанию и должны быть развёрнуты.
+    """
+    col, rid = f"{alias}created_at", f"{alias}id"
+    if not cursor:
+        return "", (), f"ORDER BY {col} DESC, {rid} DESC"
+    created_at, row_id = decode_cursor(cursor[1:])
+    if cursor[0] == "n":
+        return f"AND ({col}, {rid}) < (?, ?)", (created_at, row_id), f"ORDER BY {col} DESC, {rid} DESC"
+    return f"AND ({col}, {rid}) > (?, ?)", (created_at, row_id), f"ORDER BY {col} ASC, {rid} ASC"
+
+def parse_page(parts, page_idx):
+    """Номер страницы и курсор из callback_data; старые кнопки без курсора ведут на первую страницу"""
+    if len(parts) > page_idx + 1:
+        return int(parts[page_idx]), parts[page_idx + 1]
+    return 1, None
+
+async def fetch_page(conn, sql, params, cursor):
+    async with conn.execute(sql, params) as cur:
+        rows = await cur.fetchall()
+    if cursor and cursor[0] == "p":
+        rows.reverse()
+    return rows
+
+async def get_counter(conn, scope, ident):
+    async with conn.execute("SELECT cnt FROM counters WHERE scope=? AND ident=?", (scope, ident)) as cur:
+        r = await cur.fetchone()
+    return r['cnt'] if r else 0
+
+async def get_rating(conn, scope, ident):
+    """Средняя оценка и число отзывов из ratings: ('product', id товара) или ('seller', id продавца)"""
+    async with conn.execute("SELECT total, cnt FROM ratings WHERE scope=? AND ident=?", (scope, ident)) as cur:
+        r = await cur.fetchone()
+    return (r['total'] / r['cnt'], r['cnt']) if r and r['cnt'] else (0.0, 0)
+
+async def rebuild_ratings():
+    async with db.write() as conn:
+        for sql in RATINGS_REBUILD:
+            await conn.execute(sql)
+        # Every card shows a rating: product_id 0 tells other processes to drop all of them
+        await conn.execute("INSERT OR REPLACE INTO card_changes(product_id, version) "
+                           "VALUES (0, (SELECT COALESCE(MAX(version), 0) + 1 FROM card_changes))")
+    product_cards.invalidate()
+
+def page_nav(prefix, page, total_pages, rows):
+    nav_buttons = []
+    if page > 1:
+        token = encode_cursor(rows[0]['created_at'], rows[0]['id'])
+        nav_buttons.append(InlineKeyboardButton(text="◀️ Prev", callback_data=f"{prefix}|{page-1}|p{token}"))
+    if page < total_pages:
+        token = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+        nav_buttons.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"{prefix}|{page+1}|n{token}"))
+    return nav_buttons
+
+# ---------------- Navigation ----------------
+class Navigator:
+    """Экраны меню на месте сообщения, на кнопку которого нажали.
+
+    Новое сообщение отправляется, только если правка невозможна: экран меняет тип
+    (фото и текст), сообщение недоступно или Telegram отказал в правке. Отпечаток
+    показанного экрана помнится по сообщению, и повторный показ того же экрана
+    обходится без запроса к Bot API.
+    """
+
+    def __init__(self):
+        self.rendered = TTLCache(NAV_RENDER_TTL, maxsize=NAV_RENDER_SIZE)  # (chat_id, message_id) -> fingerprint
+        self.counters = {'edited': 0, 'sent': 0, 'unchanged': 0, 'media_changed': 0, 'edit_failed': 0}
+
+    @staticmethod
+    def fingerprint(text, reply_markup, parse_mode, photo):
+        markup = reply_markup.model_dump(exclude_none=True) if reply_markup is not None else None
+        rendered = json.dumps([text, parse_mode, photo, markup], ensure_ascii=False, sort_keys=True)
+        return hashlib.blake2b(rendered.encode(), digest_size=16).digest()
+
+    async def show(self, target, text, reply_markup=None, parse_mode=None, photo=None):
+        """target — CallbackQuery (править её сообщение) или chat_id (отправить новое)"""
+        fingerprint = self.fingerprint(text, reply_markup, parse_mode, photo)
+        if isinstance(target, CallbackQuery):
+            message = target.message
+            chat_id = message.chat.id
+            key = (chat_id, message.message_id)
+            if self.rendered.get(key) == fingerprint:
+                self.counters['unchanged'] += 1
+                return
+            # InaccessibleMessage (older than 48h) has neither photo nor text
+            kind = 'photo' if getattr(message, 'photo', None) else 'text' if getattr(message, 'text', None) is not None else None
+            if kind == ('photo' if photo else 'text'):
+                try:
+                    if photo:
+                        await message.edit_media(InputMediaPhoto(media=photo, caption=text, parse_mode=parse_mode),
+                                                 reply_markup=reply_markup)
+                    else:
+                        await message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+                    self.counters['edited'] += 1
+                    self.rendered.set(key, fingerprint)
+                    return
+                except TelegramBadRequest as e:
+                    if 'message is not modified' in e.message:
+                        # Shown before the fingerprint was taken, e.g. before a restart
+                        self.counters['unchanged'] += 1
+                        self.rendered.set(key, fingerprint)
+                        return
+                    self.counters['edit_failed'] += 1
+                    logger.warning(f"Edit of message {message.message_id} in chat {chat_id} failed, sending new: {e.message}")
+            else:
+                self.counters['media_changed'] += 1
+        else:
+            chat_id = target
+        if photo:
+            sent = await bot.send_photo(chat_id, photo, caption=text, parse_mode=parse_mode, reply_markup=reply_markup)
+        else:
+            sent = await bot.send_message(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+        self.counters['sent'] += 1
+        self.rendered.set((chat_id, sent.message_id), fingerprint)
+
+    def stats(self):
+        return {**self.counters, 'tracked': self.rendered.stats()['size']}
+
+nav = Navigator()
+
+# ---------------- Search ----------------
+def fts_query(text):
+    """Текст пользователя в выражение FTS5: каждое слово — префикс, все слова обязательны"""
+    words = re.findall(r'\w+', text.lower())[:SEARCH_MAX_TERMS]
+    return ' '.join(f'"{w}"*' for w in words) or None
+
+async def search_products(text, category_id=None, limit=PER_PAGE, offset=0):
+    match = fts_query(text)
+    if match is None:
+        return []
+    if category_id:
+        sql, params = SEARCH_SQL.format(cond='AND p.category_id=?'), (match, category_id, limit, offset)
+    else:
+        sql, params = SEARCH_SQL.format(cond=''), (match, limit, offset)
+    async with db.read() as conn:
+        try:
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchall()
+        except sqlite3.OperationalError:
+            return []  # e.g. a query made only of FTS5 syntax characters
+
+async def search_facets(text):
+    """Категории среди лучших SEARCH_FACET_ROWS совпадений: (id, name, count) по убыванию"""
+    match = fts_query(text)
+    if match is None:
+        return []
+    tree = await catalog.ready()
+    async with db.read() as conn:
+        async with conn.execute("""SELECT p.category_id AS id, COUNT(*) AS cnt FROM
+                                (SELECT rowid FROM products_fts WHERE products_fts MATCH ? LIMIT ?) m
+                                JOIN products p ON p.id = m.rowid
+                                GROUP BY p.category_id ORDER BY cnt DESC""", (match, SEARCH_FACET_ROWS)) as cur:
+            rows = await cur.fetchall()
+    facets = [{'id': r['id'], 'name': tree.category(r['id'])['name'], 'cnt': r['cnt']} for r in rows if tree.category(r['id'])]
+    return facets[:6]
+
+# ---------------- Outbound messages ----------------
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Сколько секунд ждать до свободного токена (0 — можно сейчас)"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class Outbox:
+    """Фоновая доставка уведомлений: очередь в БД, лимиты Telegram и повтор после 429.
+
+    Сообщение сначала записывается в outbox и только потом отправляется, поэтому
+    недоставленное переживает перезапуск. Доставка at-least-once: удаление
+    отправленных идёт пачками раз в OUTBOX_FLUSH_INTERVAL.
+    """
+
+    METHODS = ('send_message', 'send_photo', 'send_document')
+
+    def __init__(self):
+        self.heap = []  # (ready_at monotonic, job id, job)
+        self.wakeup = asyncio.Event()
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, 1)
+        self.chat_buckets = {}
+        self.in_flight = set()  # chats with a send in progress; keeps per-chat order
+        self.paused_until = 0.0
+        self.delivered = []
+        self.loaded_id = 0
+        self.counters = {'queued': 0, 'sent': 0, 'retry_after': 0, 'failed': 0, 'dropped': 0}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.enqueue('send_message', chat_id, text=text, **kwargs)
+
+    async def enqueue(self, method, chat_id, **kwargs):
+        if method not in self.METHODS:
+            raise ValueError(f"Unsupported method {method}")
+        if isinstance(kwargs.get('reply_markup'), InlineKeyboardMarkup):
+            kwargs['reply_markup'] = kwargs['reply_markup'].model_dump(exclude_none=True)
+        payload = json.dumps(kwargs, ensure_ascii=False)
+        async with db.write() as conn:
+            cur = await conn.execute("INSERT INTO outbox(chat_id,method,payload,created_at) VALUES (?,?,?,?)",
+                                     (chat_id, method, payload, now_iso()))
+            job_id = cur.lastrowid
+        self.counters['queued'] += 1
+        if not MULTIPROCESS:
+            # With several processes only the leader delivers; it picks the row up in _poll
+            self._push(time.monotonic(), {'id': job_id, 'chat_id': chat_id, 'method': method, 'payload': kwargs, 'attempts': 0})
+
+    def _push(self, ready_at, job):
+        heapq.heappush(self.heap, (ready_at, job['id'], job))
+        self.wakeup.set()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, 1)
+        return bucket
+
+    async def load(self, after=0):
+        if not after:
+            self.heap.clear()
+        async with db.read() as conn:
+            async with conn.execute("SELECT id,chat_id,method,payload FROM outbox WHERE id>? ORDER BY id", (after,)) as cur:
+                rows = await cur.fetchall()
+        now = time.monotonic()
+        for r in rows:
+            self._push(now, {'id': r['id'], 'chat_id': r['chat_id'], 'method': r['method'],
+                             'payload': json.loads(r['payload']), 'attempts': 0})
+        if rows:
+            self.loaded_id = rows[-1]['id']
+            if not after:
+                logger.info(f"Очередь уведомлений: восстановлено {len(rows)} недоставленных")
+
+    async def _poll(self):
+        """Уведомления, поставленные другими процессами"""
+        while True:
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+            await self.load(self.loaded_id)
+
+    async def _next(self):
+        while True:
+            now = time.monotonic()
+            if self.heap and self.heap[0][0] <= now:
+                ready_at, job_id, job = heapq.heappop(self.heap)
+                chat_id = job['chat_id']
+                if chat_id in self.in_flight:
+                    self._push(now + 0.05, job)
+                    continue
+                wait = max(self.paused_until - now, self._chat_bucket(chat_id).delay())
+                if wait > 0:
+                    self._push(now + wait, job)
+                    continue
+                wait = self.global_bucket.delay()
+                if wait > 0:
+                    heapq.heappush(self.heap, (ready_at, job_id, job))
+                    await asyncio.sleep(wait)
+                    continue
+                self.global_bucket.take()
+                self.chat_buckets[chat_id].take()
+                self.in_flight.add(chat_id)
+                return job
+            timeout = self.heap[0][0] - now if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            job = await self._next()
+            payload = dict(job['payload'])
+            if 'reply_markup' in payload:
+                payload['reply_markup'] = InlineKeyboardMarkup.model_validate(payload['reply_markup'])
+            try:
+                await getattr(bot, job['method'])(job['chat_id'], **payload)
+                self.counters['sent'] += 1
+                self.delivered.append(job['id'])
+            except TelegramRetryAfter as e:
+                # Flood control is per bot: hold every chat, not just this one
+                self.counters['retry_after'] += 1
+                self.paused_until = time.monotonic() + e.retry_after
+                self._push(self.paused_until, job)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Bot blocked or chat gone: retrying will not help
+                self.counters['dropped'] += 1
+                self.delivered.append(job['id'])
+                logging.warning("Outbox: dropped message to %s: %s", job['chat_id'], e)
+            except Exception as e:
+                job['attempts'] += 1
+                if job['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                    self.counters['dropped'] += 1
+                    self.delivered.append(job['id'])
+                    logging.error("Outbox: giving up on message to %s: %s", job['chat_id'], e)
+                else:
+                    self.counters['failed'] += 1
+                    self._push(time.monotonic() + HTTP_BACKOFF * 2 ** job['attempts'], job)
+            finally:
+                self.in_flight.discard(job['chat_id'])
+
+    async def acquire_bulk(self):
+        """Токен для массовой рассылки: выдаётся, только когда уведомлений в очереди нет"""
+        while True:
+            now = time.monotonic()
+            wait = max(self.paused_until - now, self.global_bucket.delay())
+            if wait <= 0 and not (self.heap and self.heap[0][0] <= now):
+                self.global_bucket.take()
+                return
+            await asyncio.sleep(max(wait, 1 / OUTBOX_GLOBAL_RATE))
+
+    async def flush(self):
+        if not self.delivered:
+            return
+        ids, self.delivered = self.delivered, []
+        async with db.write() as conn:
+            await conn.executemany("DELETE FROM outbox WHERE id=?", [(i,) for i in ids])
+
+    async def run(self):
+        await self.load()
+        workers = [asyncio.create_task(self._worker()) for _ in range(OUTBOX_WORKERS)]
+        if MULTIPROCESS:
+            workers.append(asyncio.create_task(self._poll()))
+        try:
+            while True:
+                await asyncio.sleep(OUTBOX_FLUSH_INTERVAL)
+                await self.flush()
+                # Idle chat buckets are full again and carry no state worth keeping
+                for chat_id in [c for c, b in self.chat_buckets.items() if b.delay() == 0 and c not in self.in_flight]:
+                    del self.chat_buckets[chat_id]
+        finally:
+            for w in workers:
+                w.cancel()
+
+    def stats(self):
+        return {**self.counters, 'pending': len(self.heap), 'paused': max(0.0, self.paused_until - time.monotonic())}
+
+outbox = Outbox()
+
+# ---------------- Broadcast ----------------
+class Broadcaster:
+    """Рассылка всем пользователям с включёнными уведомлениями.
+
+    Получатели читаются пачками по user_id; курсор и счётчики сохраняются после
+    каждой пачки, поэтому после перезапуска рассылка продолжается с места
+    остановки. Лимит Telegram общий с Outbox, уведомления идут вперёд.
+    """
+
+    def __init__(self):
+        self.tasks = {}  # broadcast id -> task
+        self.stopping = set()
+
+    async def start(self, admin_chat_id, text):
+        async with db.write() as conn:
+            async with conn.execute("SELECT COUNT(*) AS n FROM users WHERE notify_enabled=1") as cur:
+                total = (await cur.fetchone())['n']
+            cur = await conn.execute("INSERT INTO broadcasts(text,admin_chat_id,total,created_at) VALUES (?,?,?,?)",
+                                     (text, admin_chat_id, total, now_iso()))
+            bid = cur.lastrowid
+        msg = await bot.send_message(admin_chat_id, f"📢 Рассылка #{bid}: запуск…")
+        async with db.write() as conn:
+            await conn.execute("UPDATE broadcasts SET progress_message_id=? WHERE id=?", (msg.message_id, bid))
+        if not MULTIPROCESS:
+            self._spawn(bid)  # otherwise the leader picks it up in watch()
+        return bid
+
+    async def resume(self):
+        async with db.read() as conn:
+            async with conn.execute("SELECT id,status FROM broadcasts WHERE status IN ('running','stopping')") as cur:
+                rows = await cur.fetchall()
+        for r in rows:
+            if r['status'] == 'stopping':
+                self.stopping.add(r['id'])
+            if r['id'] not in self.tasks:
+                logger.info(f"Рассылка #{r['id']} продолжена в этом процессе")
+                self._spawn(r['id'])
+
+    async def watch(self):
+        """Задача лидера: подхватывает рассылки и остановки из других процессов"""
+        try:
+            while True:
+                await self.resume()
+                await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+        finally:
+            # Leadership lost: rows stay 'running' and the next leader resumes them
+            for task in list(self.tasks.values()):
+                task.cancel()
+
+    def _spawn(self, bid):
+        if bid not in self.tasks:
+            self.tasks[bid] = asyncio.create_task(self._run(bid))
+
+    async def stop(self, bid):
+        if bid in self.tasks:
+            self.stopping.add(bid)
+        elif MULTIPROCESS:
+            async with db.write() as conn:
+                await conn.execute("UPDATE broadcasts SET status='stopping' WHERE id=? AND status='running'", (bid,))
+
+    async def _run(self, bid):
+        async with db.read() as conn:
+            async with conn.execute("SELECT * FROM broadcasts WHERE id=?", (bid,)) as cur:
+                b = dict(await cur.fetchone())
+        b['started'] = time.monotonic()
+        b['sent_before'] = b['sent']
+        reporter = asyncio.create_task(self._report_loop(b))
+        try:
+            while bid not in self.stopping:
+                async with db.read() as conn:
+                    async with conn.execute(HOT_QUERIES['broadcast_recipients'][0], (b['cursor'], BROADCAST_CHUNK)) as cur:
+                        rows = await cur.fetchall()
+                if not rows:
+                    break
+                queue = deque(r['user_id'] for r in rows)
+                await asyncio.gather(*(self._worker(b, queue) for _ in range(BROADCAST_WORKERS)))
+                if queue:
+                    break  # stopped mid-chunk; the cursor stays at the chunk start
+                b['cursor'] = rows[-1]['user_id']
+                async with db.write() as conn:
+                    await conn.execute("UPDATE broadcasts SET cursor=?, sent=?, failed=? WHERE id=?",
+                                       (b['cursor'], b['sent'], b['failed'], bid))
+            b['status'] = 'cancelled' if bid in self.stopping else 'done'
+            async with db.write() as conn:
+                await conn.execute("UPDATE broadcasts SET status=?, sent=?, failed=?, finished_at=? WHERE id=?",
+                                   (b['status'], b['sent'], b['failed'], now_iso(), bid))
+            logger.info(f"Рассылка #{bid} завершена: отправлено {b['sent']}, ошибок {b['failed']}")
+        except Exception as e:
+            # Not resumed automatically: the same error would most likely repeat
+            logging.error("Broadcast %s error: %s", bid, e)
+            b['status'] = 'error'
+            try:
+                async with db.write() as conn:
+                    await conn.execute("UPDATE broadcasts SET status='error', sent=?, failed=?, finished_at=? WHERE id=?",
+                                       (b['sent'], b['failed'], now_iso(), bid))
+            except Exception as e:
+                logging.error("Broadcast %s: cannot mark as failed: %s", bid, e)
+        finally:
+            reporter.cancel()
+            self.tasks.pop(bid, None)
+            self.stopping.discard(bid)
+        await self._report(b)
+
+    async def _worker(self, b, queue):
+        while queue and b['id'] not in self.stopping:
+            user_id = queue.popleft()
+            for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+                await outbox.acquire_bulk()
+                try:
+                    await bot.send_message(user_id, b['text'])
+                    b['sent'] += 1
+                except TelegramRetryAfter as e:
+                    outbox.paused_until = time.monotonic() + e.retry_after
+                    queue.appendleft(user_id)
+                except (TelegramNetworkError, asyncio.TimeoutError):
+                    if attempt < BROADCAST_MAX_ATTEMPTS:
+                        await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+                        continue
+                    b['failed'] += 1
+                except Exception:
+                    # Blocked bot or deleted account: not retried
+                    b['failed'] += 1
+                break
+
+    async def _report_loop(self, b):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._report(b)
+
+    async def _report(self, b):
+        if not b.get('progress_message_id'):
+            return
+        elapsed = max(time.monotonic() - b['started'], 1e-3)
+        status = {'done': "завершена", 'cancelled': "остановлена", 'error': "прервана из-за ошибки"}.get(b['status'], "идёт")
+        text = (f"📢 Рассылка #{b['id']}: {status}\n"
+                f"Отправлено: {b['sent']} из {b['total']}\n"
+                f"Ошибок: {b['failed']}\n"
+                f"Скорость: {(b['sent'] - b['sent_before']) / elapsed:.1f} сообщ./с")
+        markup = None
+        if b['status'] == 'running':
+            markup = simple_markup([[InlineKeyboardButton(text="⏹ Остановить", callback_data=f"bcast_stop|{b['id']}")]])
+        try:
+            await bot.edit_message_text(text, chat_id=b['admin_chat_id'], message_id=b['progress_message_id'], reply_markup=markup)
+        except TelegramBadRequest:
+            pass  # "message is not modified"
+
+broadcaster = Broadcaster()
+
+# ---------------- Purchases ----------------
+class PurchaseError(Exception):
+    def __init__(self, reason, balance=None, price=None):
+        super().__init__(reason)
+        self.reason = reason  # 'not_found' | 'sold_out' | 'no_funds'
+        self.balance = balance
+        self.price = price
+
+class PurchaseEngine:
+    """Покупки: проверка и списание условными UPDATE в транзакции писателя.
+
+    Заявки на один товар встают в его очередь; пока обрабатывается одна пачка,
+    следующие копятся и уходят одним блоком записи, поэтому ажиотажный товар
+    занимает писателя один раз на пачку, а не на каждого покупателя.
+    """
+
+    def __init__(self):
+        self.queues = {}  # product_id -> [(user_id, future)]
+        self.tasks = set()  # drain and late-delivery tasks, referenced until done
+        self.counters = {'purchases': 0, 'sold_out': 0, 'no_funds': 0, 'not_found': 0, 'batches': 0, 'batch_max': 0,
+                         'late_deliveries': 0}
+
+    async def buy(self, user_id, product_id):
+        """Возвращает (order_id, товар, user_id продавца) или бросает PurchaseError"""
+        fut = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(product_id)
+        if queue is None:
+            # The drain task acts as the per-product lock: at most one batch in flight
+            queue = self.queues[product_id] = []
+            self._spawn(self._drain(product_id))
+        queue.append((user_id, fut))
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # The buyer may already be charged: hand the result over to the outbox
+            fut.add_done_callback(lambda f: self._deliver_late(user_id, f))
+            raise
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def _deliver_late(self, user_id, fut):
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        self.counters['late_deliveries'] += 1
+        self._spawn(notify_purchase(user_id, *fut.result()))
+
+    async def _drain(self, product_id):
+        while self.queues[product_id]:
+            batch, self.queues[product_id] = self.queues[product_id], []
+            try:
+                results = await self._apply(product_id, batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, fut), result in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+        del self.queues[product_id]
+
+    async def _apply(self, product_id, batch):
+        c = self.counters
+        c['batches'] += 1
+        c['batch_max'] = max(c['batch_max'], len(batch))
+        results = []
+        sold_out = None
+        async with db.write() as conn:
+            for user_id, _ in batch:
+                if sold_out:
+                    results.append(sold_out)
+                    continue
+                await conn.execute("SAVEPOINT buy")
+                async with conn.execute("""UPDATE products SET quantity = quantity - 1 WHERE id=? AND quantity > 0
+                                        RETURNING id, title, price, seller_id, content_text, content_file_id""", (product_id,)) as cur:
+                    p = await cur.fetchone()
+                if not p:
+                    await conn.execute("RELEASE buy")
+                    async with conn.execute("SELECT 1 FROM products WHERE id=?", (product_id,)) as cur:
+                        exists = await cur.fetchone() is not None
+                    sold_out = PurchaseError('sold_out' if exists else 'not_found')
+                    results.append(sold_out)
+                    continue
+                cur = await conn.execute("UPDATE users SET balance = balance - ? WHERE user_id=? AND balance >= ?",
+                                         (p['price'], user_id, p['price']))
+                if cur.rowcount == 0:
+                    # Undo the stock decrement of this buyer only
+                    await conn.execute("ROLLBACK TO buy")
+                    await conn.execute("RELEASE buy")
+                    async with conn.execute("SELECT balance FROM users WHERE user_id=?", (user_id,)) as cur:
+                        row = await cur.fetchone()
+                    results.append(PurchaseError('no_funds', row['balance'] if row else 0.0, p['price']))
+                    continue
+                async with conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = (SELECT user_id FROM sellers WHERE id=?) RETURNING user_id",
+                                        (p['price'], p['seller_id'])) as cur:
+                    seller = await cur.fetchone()
+                async with conn.execute("INSERT INTO orders(user_id, product_id, seller_id, price, created_at) VALUES (?, ?, ?, ?, ?) RETURNING id",
+                                        (user_id, product_id, p['seller_id'], p['price'], now_iso())) as cur:
+                    order_id = (await cur.fetchone())['id']
+                await conn.execute("RELEASE buy")
+                results.append((order_id, p, seller['user_id'] if seller else None))
+        for r in results:
+            if isinstance(r, PurchaseError):
+                c[r.reason] += 1
+            else:
+                c['purchases'] += 1
+        if any(not isinstance(r, PurchaseError) for r in results):
+            # Stock went down
+            product_cards.invalidate(product_id)
+        return results
+
+    def stats(self):
+        return {**self.counters, 'queued': sum(len(q) for q in self.queues.values())}
+
+purchases = PurchaseEngine()
+
+# ---------------- HTTP client ----------------
+class UpstreamError(Exception):
+    pass
+
+class Upstream:
+    """Клиент внешнего API: общая keep-alive сессия, ретраи с джиттером и circuit breaker"""
+
+    def __init__(self, name, base_url, headers=None, limit=HTTP_LIMIT_PER_HOST, timeout=HTTP_TIMEOUT):
+        self.name = name
+        self.base_url = base_url
+        self.headers = headers
+        self.limit = limit
+        self.timeout = timeout
+        self._session = None
+        self.failures = 0
+        self.open_until = 0.0
+        self.counters = {'requests': 0, 'retries': 0, 'errors': 0, 'circuit_rejects': 0, 'latency_total': 0.0}
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def request(self, method, path, **kwargs):
+        if time.monotonic() < self.open_until:
+            self.counters['circuit_rejects'] += 1
+            raise UpstreamError(f"{self.name}: circuit open")
+        self.counters['requests'] += 1
+        last_error = None
+        for attempt in range(HTTP_RETRIES + 1):
+            if attempt:
+                self.counters['retries'] += 1
+                await asyncio.sleep(HTTP_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            started = time.monotonic()
+            try:
+                async with self.session.request(method, self.base_url + path, **kwargs) as r:
+                    if r.status >= 500 or r.status == 429:
+                        last_error = f"HTTP {r.status}"
+                        continue
+                    if r.status >= 400:
+                        # Client error: retrying will not help and the upstream itself is healthy
+                        raise UpstreamError(f"{self.name}: HTTP {r.status} {await r.text()}")
+                    data = await r.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                last_error = e
+                continue
+            finally:
+                elapsed = time.monotonic() - started
+                self.counters['latency_total'] += elapsed
+                upstream_seconds.observe(elapsed, (self.name,))
+                add_span('upstream', elapsed)
+            self.failures = 0
+            return data
+        self.counters['errors'] += 1
+        self.failures += 1
+        if self.failures >= BREAKER_THRESHOLD:
+            # Stays armed: after the cooldown a single failed probe re-opens it
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+            logger.warning("Upstream %s: circuit open for %ds", self.name, BREAKER_COOLDOWN)
+        raise UpstreamError(f"{self.name}: {last_error}")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def stats(self):
+        return {**self.counters, 'failures': self.failures, 'circuit_open': time.monotonic() < self.open_until}
+
+# ---------------- Crypto ----------------
+def crypto_headers():
+    return {'Crypto-Pay-API-Token': CRYPTO_TOKEN, 'Content-Type': 'application/json'}
+
+crypto_pay = Upstream('cryptopay', CRYPTO_PAY_URL, headers=crypto_headers())
+coingecko = Upstream('coingecko', COINGECKO_URL, timeout=8)
+
+class RateUnavailable(Exception):
+    pass
+
+class RateService:
+    """Курсы CRYPTO_ASSETS к RUB в памяти: один запрос на все активы по расписанию.
+
+    При PROCESSES > 1 курсы запрашивает только супервизор, обработчики получают их по IPC.
+    """
+
+    def __init__(self):
+        self.quotes = {}  # asset -> (rate, fetched_at unix time)
+        self.changed = asyncio.Event()  # replaced after every refresh; subscribers wait on the current one
+
+    async def refresh(self):
+        ids = ','.join(ASSET_MAP[a] for a in CRYPTO_ASSETS)
+        data = await coingecko.request('GET', '/simple/price', params={'ids': ids, 'vs_currencies': 'rub'})
+        fetched_at = time.time()
+        for asset in CRYPTO_ASSETS:
+            rub = data.get(ASSET_MAP[asset], {}).get('rub')
+            if rub:
+                self.quotes[asset] = (float(rub), fetched_at)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+                delay = RATE_REFRESH_INTERVAL
+            except Exception as e:
+                logging.error("Rate refresh error: %s", e)
+                delay = RATE_RETRY_INTERVAL
+            await asyncio.sleep(delay)
+
+    async def follow(self):
+        """Обработчик: принимает курсы от супервизора вместо своих запросов"""
+        reader, writer = await asyncio.open_unix_connection(IPC_SOCKET)
+        ipc_send(writer, ('rates', WORKER_INDEX))
+        try:
+            while True:
+                quotes = await ipc_recv(reader)
+                if quotes is None:
+                    return
+                self.quotes = quotes
+        finally:
+            writer.close()
+
+    def age(self, asset):
+        quote = self.quotes.get(asset)
+        return time.time() - quote[1] if quote else None
+
+    def get(self, asset):
+        if asset not in ASSET_MAP:
+            raise ValueError("Unknown asset")
+        age = self.age(asset)
+        if age is None or age > RATE_MAX_AGE:
+            raise RateUnavailable(f"{asset}: no quote newer than {RATE_MAX_AGE}s")
+        return self.quotes[asset][0]
+
+    def stats(self):
+        return {asset: {'rate': rate, 'age': time.time() - fetched_at} for asset, (rate, fetched_at) in self.quotes.items()}
+
+rates = RateService()
+
+def get_rate(asset):
+    return rates.get(asset)
+
+async def create_invoice(asset, amount, description, user_id):
+    payload = {'asset': asset, 'amount': str(amount), 'description': description, 'expires_in': INVOICE_TTL}
+    try:
+        resp = await crypto_pay.request('POST', '/createInvoice', json=payload)
+        if resp.get('ok'):
+            inv = resp['result']
+            await save_invoice_db(int(inv['invoice_id']), user_id, amount, asset, inv.get('hash'))
+        return resp
+    except Exception as e:
+        logging.error("create_invoice error: %s", e)
+        return {'ok': False, 'error': str(e)}
+
+async def save_invoice_db(invoice_id, user_id, amount, asset, hash_val):
+    async with db.write() as conn:
+        await conn.execute("INSERT OR IGNORE INTO invoices(invoice_id,user_id,amount,asset,hash,created_at) VALUES (?,?,?,?,?,?)",
+                           (invoice_id, user_id, amount, asset, hash_val, now_iso()))
+
+async def get_invoices(invoice_ids):
+    try:
+        payload = {'invoice_ids': ','.join(map(str, invoice_ids)), 'count': len(invoice_ids)}
+        return await crypto_pay.request('GET', '/getInvoices', params=payload)
+    except Exception as e:
+        logging.error("get_invoices error: %s", e)
+        return {'ok': False, 'error': str(e)}
+
+def verify_crypto_signature(body: bytes, signature) -> bool:
+    """Подпись Crypto Pay: HMAC-SHA256 тела запроса на ключе SHA256(токена)"""
+    secret = hashlib.sha256(CRYPTO_TOKEN.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+async def apply_credit(conn, invoice_id, user_id, rub_amount):
+    """Отмечает счёт оплаченным и пополняет баланс; False, если счёт уже не в статусе unpaid"""
+    # The status guard makes webhook and reconciler safe to race on the same invoice
+    cur = await conn.execute("UPDATE invoices SET status='paid' WHERE invoice_id=? AND status='unpaid'", (invoice_id,))
+    if cur.rowcount == 0:
+        return False
+    await conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (rub_amount, user_id))
+    return True
+
+async def credit_invoice(invoice_id):
+    """Зачисляет оплаченный счёт один раз; возвращает (user_id, сумма в RUB) или None"""
+    async with db.read() as conn:
+        async with conn.execute("SELECT user_id,amount,asset FROM invoices WHERE invoice_id=? AND status='unpaid'", (invoice_id,)) as cur:
+            row = await cur.fetchone()
+    if not row:
+        return None
+    rub_amount = float(row['amount']) * get_rate(row['asset'])
+    async with db.write() as conn:
+        if not await apply_credit(conn, invoice_id, row['user_id'], rub_amount):
+            return None
+    return row['user_id'], rub_amount
+
+async def notify_payment(user_id, rub_amount):
+    if await is_notify_enabled(user_id):
+        await outbox.send_message(user_id, f"🎉 Платёж подтверждён — баланс пополнен на {rub_amount:.2f} RUB")
+
+async def crypto_webhook(request):
+    body = await request.read()
+    if not verify_crypto_signature(body, request.headers.get('crypto-pay-api-signature')):
+        logging.warning("Crypto Pay webhook: bad signature from %s", request.remote)
+        return web.Response(status=401)
+    update = None
+    try:
+        update = json.loads(body)
+        if update['update_type'] != 'invoice_paid':
+            return web.Response(text="ok")
+        invoice_id = int(update['payload']['invoice_id'])
+    except (KeyError, TypeError, ValueError) as e:
+        update_id = update.get('update_id') if isinstance(update, dict) else None
+        logging.warning("Crypto Pay webhook: malformed update %s: %r", update_id, e)
+        return web.Response(status=400)
+    try:
+        credited = await credit_invoice(invoice_id)
+    except RateUnavailable as e:
+        # Non-200 makes Crypto Pay redeliver; the reconciler is the second safety net
+        logging.warning("Payment %s postponed: %s", invoice_id, e)
+        return web.Response(status=503)
+    if credited:
+        logger.info(f"Счёт {invoice_id} оплачен (вебхук)")
+        await notify_payment(*credited)
+    return web.Response(text="ok")
+
+class PaymentReconciler:
+    """Сверка с getInvoices: подбирает оплаты, вебхук которых не дошёл, и закрывает просроченные счета"""
+
+    def __init__(self):
+        self.interval = PAYMENT_RECONCILE_INTERVAL
+        self.last = {}
+        self.finished_at = None
+        self.totals = {'cycles': 0, 'checked': 0, 'paid': 0, 'expired': 0, 'postponed': 0}
+
+    def watermark(self):
+        # Past this age an invoice can no longer be paid: a remote non-paid status is final
+        cutoff = datetime.now(pytz.timezone('Europe/Moscow')) - timedelta(seconds=INVOICE_TTL + INVOICE_EXPIRE_GRACE)
+        return cutoff.isoformat()
+
+    async def unpaid_chunks(self):
+        after = ('', 0)
+        while True:
+            async with db.read() as conn:
+                async with conn.execute(HOT_QUERIES['unpaid_invoices'][0], (*after, CRYPTO_PAGE_LIMIT)) as cur:
+                    rows = await cur.fetchall()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < CRYPTO_PAGE_LIMIT:
+                return
+            after = (rows[-1]['created_at'], rows[-1]['invoice_id'])
+
+    async def apply_chunk(self, rows, counts, since):
+        resp = await get_invoices([r['invoice_id'] for r in rows])
+        if not resp.get('ok'):
+            raise UpstreamError(resp.get('error'))
+        remote = {int(it['invoice_id']): it.get('status') for it in resp['result'].get('items', [])}
+        credits, expired = [], []
+        for r in rows:
+            status = remote.get(r['invoice_id'])
+            if status == 'paid':
+                try:
+                    credits.append((r['invoice_id'], r['user_id'], float(r['amount']) * get_rate(r['asset'])))
+                except RateUnavailable as e:
+                    # Leave the invoice unpaid; it is credited on a later pass
+                    logging.warning("Payment %s postponed: %s", r['invoice_id'], e)
+                    counts['postponed'] += 1
+            elif status == 'expired' or r['created_at'] < since:
+                # Stale and just confirmed unpaid by Crypto Pay (or unknown to it)
+                expired.append(r['invoice_id'])
+        if not credits and not expired:
+            return []
+        credited = []
+        async with db.write() as conn:
+            for invoice_id, user_id, rub_amount in credits:
+                if await apply_credit(conn, invoice_id, user_id, rub_amount):
+                    credited.append((user_id, rub_amount))
+            for invoice_id in expired:
+                cur = await conn.execute("UPDATE invoices SET status='expired' WHERE invoice_id=? AND status='unpaid'", (invoice_id,))
+                counts['expired'] += cur.rowcount
+        return credited
+
+    async def cycle(self):
+        started = time.monotonic()
+        since = self.watermark()
+        counts = {'checked': 0, 'paid': 0, 'expired': 0, 'postponed': 0, 'chunks': 0}
+        async for rows in self.unpaid_chunks():
+            counts['chunks'] += 1
+            counts['checked'] += len(rows)
+            for user_id, rub_amount in await self.apply_chunk(rows, counts, since):
+                counts['paid'] += 1
+                await notify_payment(user_id, rub_amount)
+        counts['duration'] = time.monotonic() - started
+        return counts
+
+    async def run(self):
+        while True:
+            try:
+                counts = await self.cycle()
+                self.last = counts
+                self.finished_at = time.monotonic()
+                self.totals['cycles'] += 1
+                for key in ('checked', 'paid', 'expired', 'postponed'):
+                    self.totals[key] += counts[key]
+                if counts['paid']:
+                    # Payments reached us only by polling: webhooks are likely failing, poll more often
+                    logger.info(f"Сверка: зачислено {counts['paid']} счетов мимо вебхука")
+                    self.interval = PAYMENT_RECONCILE_MIN
+                else:
+                    self.interval = min(self.interval * 2, PAYMENT_RECONCILE_INTERVAL)
+                if counts['checked'] or counts['expired']:
+                    logger.info("Сверка счетов: проверено %d, оплачено %d, просрочено %d, отложено %d, пачек %d, %.3f с",
+                                counts['checked'], counts['paid'], counts['expired'], counts['postponed'],
+                                counts['chunks'], counts['duration'])
+            except Exception as e:
+                logging.error("Payment reconcile error: %s", e)
+                self.interval = PAYMENT_RECONCILE_MIN
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        # Payment-checker lag: a webhook-less payment waits at most this long plus the interval
+        since = time.monotonic() - self.finished_at if self.finished_at is not None else None
+        return {**self.totals, 'interval': self.interval, 'last': self.last, 'since_last': since}
+
+reconciler = PaymentReconciler()
+
+# ---------------- Webhook updates ----------------
+def update_chat_id(data):
+    """Чат, к которому относится обновление в сыром JSON (для инлайн-запросов — пользователь)"""
+    for event in data.values():
+        if isinstance(event, dict):
+            chat = event.get('chat') or (event.get('message') or {}).get('chat') or event.get('from')
+            return chat['id'] if chat else 0
+    return 0
+
+class UpdateQueue:
+    """Обработка обновлений из вебхука пулом воркеров.
+
+    Обновления одного чата всегда попадают к одному воркеру и обрабатываются по
+    порядку, разные чаты — параллельно. Очереди ограничены: при переполнении вебхук
+    отвечает 503, и Telegram повторит доставку позже.
+    """
+
+    def __init__(self):
+        self.queues = []
+        self.workers = []
+        self.counters = {'accepted': 0, 'rejected': 0, 'handled': 0, 'failed': 0}
+
+    def start(self):
+        size = max(1, UPDATE_QUEUE_SIZE // UPDATE_WORKERS)
+        self.queues = [asyncio.Queue(size) for _ in range(UPDATE_WORKERS)]
+        self.workers = [asyncio.create_task(self._worker(q)) for q in self.queues]
+
+    def put(self, chat_id, update):
+        queue = self.queues[chat_id % len(self.queues)]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.counters['rejected'] += 1
+            return False
+        self.counters['accepted'] += 1
+        return True
+
+    async def put_wait(self, chat_id, update):
+        """Для обновлений от супервизора: полная очередь притормаживает чтение из сокета"""
+        await self.queues[chat_id % len(self.queues)].put(update)
+        self.counters['accepted'] += 1
+
+    async def _worker(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await dp.feed_update(bot, update)
+                self.counters['handled'] += 1
+            except Exception:
+                self.counters['failed'] += 1
+                logging.exception("Update %s failed", update.update_id)
+            finally:
+                queue.task_done()
+
+    async def stop(self):
+        if not self.workers:
+            return
+        # Telegram already got 200 for queued updates: finish them before exiting
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), UPDATE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("Update queue: %d updates left unprocessed", self.stats()['pending'])
+        for w in self.workers:
+            w.cancel()
+        self.workers = []
+
+    def stats(self):
+        return {**self.counters, 'pending': sum(q.qsize() for q in self.queues)}
+
+updates = UpdateQueue()
+
+async def telegram_webhook(request):
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        logging.warning("Telegram webhook: bad secret token from %s", request.remote)
+        return web.Response(status=401)
+    try:
+        data = await request.json()
+        chat_id = update_chat_id(data)
+        if supervisor is not None:
+            accepted = supervisor.forward(chat_id, data)
+        else:
+            accepted = updates.put(chat_id, types.Update.model_validate(data, context={'bot': bot}))
+    except (ValueError, TypeError, AttributeError, KeyError):
+        return web.Response(status=400)
+    if not accepted:
+        return web.Response(status=503)
+    return web.Response(text="ok")
+
+async def set_telegram_webhook():
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("UPDATE_MODE=webhook requires WEBHOOK_BASE_URL")
+    # Without drop_pending_updates: updates sent during a restart are delivered after it
+    await bot.set_webhook(WEBHOOK_BASE_URL.rstrip('/') + TELEGRAM_WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types(),
+                          max_connections=WEBHOOK_MAX_CONNECTIONS)
+
+# ---------------- Processes ----------------
+class LeaderLease:
+    """Аренда роли лидера в таблице leases: фоновые задачи в одном экземпляре на все процессы.
+
+    Держатель продлевает аренду каждую треть LEADER_LEASE_TTL; если он упал или завис,
+    после истечения срока роль забирает другой процесс. Задачи лидера запускаются при
+    получении роли и отменяются при её потере.
+    """
+
+    def __init__(self, name, *factories):
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.factories = factories
+        self.tasks = []
+        self.counters = {'acquired': 0, 'lost': 0, 'errors': 0}
+
+    async def try_acquire(self):
+        now = time.time()
+        async with db.write() as conn:
+            cur = await conn.execute("""INSERT INTO leases(name,owner,expires_at) VALUES (?,?,?)
+                                     ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+                                     WHERE leases.owner=excluded.owner OR leases.expires_at<?""",
+                                     (self.name, self.owner, now + LEADER_LEASE_TTL, now))
+            return cur.rowcount > 0
+
+    @property
+    def is_leader(self):
+        return bool(self.tasks)
+
+    def _stop_tasks(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    held = await self.try_acquire()
+                except Exception as e:
+                    # Cannot prove we still hold it: step down rather than risk two leaders
+                    self.counters['errors'] += 1
+                    logging.error("Leader lease error: %s", e)
+                    held = False
+                if held and not self.tasks:
+                    self.counters['acquired'] += 1
+                    self.tasks = [asyncio.create_task(f()) for f in self.factories]
+                    logger.info(f"Процесс стал лидером ({self.name})")
+                elif not held and self.tasks:
+                    self.counters['lost'] += 1
+                    self._stop_tasks()
+                    logging.warning("Leadership (%s) lost", self.name)
+                await asyncio.sleep(LEADER_LEASE_TTL / 3)
+        finally:
+            self._stop_tasks()
+
+    async def release(self):
+        if not self.tasks:
+            return
+        self._stop_tasks()
+        async with db.write() as conn:
+            await conn.execute("DELETE FROM leases WHERE name=? AND owner=?", (self.name, self.owner))
+
+    def stats(self):
+        return {**self.counters, 'leader': self.is_leader}
+
+leader = LeaderLease('leader', lambda: reconciler.run(), lambda: outbox.run(), lambda: broadcaster.watch())
+
+class _Rollback(Exception):
+    pass
+
+class Supervisor:
+    """Режим PROCESSES > 1: запускает обработчики и сам обновления не обрабатывает.
+
+    Держит единственного писателя БД и обслуживает их блоки db.write() через IPC_SOCKET,
+    принимает обновления (polling или вебхук) и раздаёт по chat_id % PROCESSES, так что
+    обновления одного чата, а с ними и его FSM, всегда обрабатывает один процесс по порядку.
+    Упавший обработчик перезапускается, его обновления ждут в ограниченной очереди.
+    """
+
+    def __init__(self):
+        self.links = [None] * PROCESSES  # StreamWriter of each worker's update channel
+        self.backlog = [deque() for _ in range(PROCESSES)]
+        self.procs = [None] * PROCESSES
+        self.stopping = False
+        self.counters = {'forwarded': 0, 'rejected': 0, 'restarts': 0, 'db_blocks': 0, 'db_errors': 0}
+
+    def forward(self, chat_id, data):
+        index = chat_id % PROCESSES
+        link = self.links[index]
+        if link is None:
+            if len(self.backlog[index]) >= UPDATE_QUEUE_SIZE:
+                self.counters['rejected'] += 1
+                return False
+            self.backlog[index].append(data)
+            return True
+        if link.transport.get_write_buffer_size() > IPC_BUFFER_LIMIT:
+            self.counters['rejected'] += 1
+            return False
+        ipc_send(link, data)
+        self.counters['forwarded'] += 1
+        return True
+
+    async def _client(self, reader, writer):
+        hello = await ipc_recv(reader)
+        try:
+            if hello == ('db',):
+                await self._serve_db(reader, writer)
+            elif hello and hello[0] == 'updates':
+                await self._serve_updates(hello[1], reader, writer)
+            elif hello and hello[0] == 'metrics':
+                await self._serve_metrics(hello[1], reader)
+            elif hello and hello[0] == 'rates':
+                await self._serve_rates(reader, writer)
+        finally:
+            writer.close()
+
+    async def _serve_updates(self, index, reader, writer):
+        self.links[index] = writer
+        while self.backlog[index]:
+            ipc_send(writer, self.backlog[index].popleft())
+            self.counters['forwarded'] += 1
+        logger.info(f"Обработчик {index} подключён")
+        await ipc_recv(reader)  # workers send nothing back; returns on disconnect
+        if self.links[index] is writer:
+            self.links[index] = None
+
+    async def _serve_metrics(self, index, reader):
+        try:
+            while True:
+                snapshot = await ipc_recv(reader)
+                if snapshot is None:
+                    return
+                metrics.remote[index] = snapshot
+        finally:
+            metrics.remote.pop(index, None)
+
+    async def _serve_rates(self, reader, writer):
+        """Курсы обработчику: сразу при подключении и после каждого обновления"""
+        gone = asyncio.ensure_future(ipc_recv(reader))  # workers send nothing back; returns on disconnect
+        try:
+            while not gone.done():
+                changed = asyncio.ensure_future(rates.changed.wait())
+                ipc_send(writer, rates.quotes)
+                await writer.drain()
+                await asyncio.wait((gone, changed), return_when=asyncio.FIRST_COMPLETED)
+                changed.cancel()
+        except ConnectionError:
+            pass
+        finally:
+            gone.cancel()
+
+    async def _serve_db(self, reader, writer):
+        while True:
+            message = await ipc_recv(reader)
+            if message is None:
+                return
+            if message[0] == 'script':
+                try:
+                    await db.executescript(message[1])
+                    reply = ('ok',)
+                except Exception as e:
+                    reply = ('error', e)
+            else:
+                reply = await self._serve_block(reader, writer)
+                if reply is None:
+                    return
+            ipc_send(writer, reply)
+            await writer.drain()
+
+    async def _serve_block(self, reader, writer):
+        """Один блок db.write() обработчика; None — соединение оборвалось и блок откатан"""
+        try:
+            async with db.write() as conn:
+                ipc_send(writer, ('ok',))
+                while True:
+                    await writer.drain()
+                    message = await ipc_recv(reader)
+                    if message is None:
+                        raise ConnectionError("worker disconnected mid-transaction")
+                    if message[0] == 'commit':
+                        break
+                    if message[0] == 'rollback':
+                        raise _Rollback()
+                    ipc_send(writer, await self._execute(conn, message))
+        except _Rollback:
+            return ('ok',)
+        except ConnectionError:
+            return None
+        except Exception as e:
+            self.counters['db_errors'] += 1
+            return ('error', e)
+        self.counters['db_blocks'] += 1
+        return ('ok',)
+
+    async def _execute(self, conn, message):
+        op, sql, params = message
+        try:
+            if op == 'executemany':
+                cur = await conn.executemany(sql, params)
+                return ('ok', (), [], cur.lastrowid, cur.rowcount)
+            async with conn.execute(sql, params) as cur:
+                rows = await cur.fetchall()
+                names = [d[0] for d in cur.description] if cur.description else []
+                return ('ok', names, [tuple(r) for r in rows], cur.lastrowid, cur.rowcount)
+        except sqlite3.Error as e:
+            return ('error', e)
+
+    async def _keep_alive(self, index):
+        env = {**os.environ, 'WORKER_INDEX': str(index)}
+        while True:
+            proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            self.procs[index] = proc
+            code = await proc.wait()
+            if self.stopping:
+                return
+            self.counters['restarts'] += 1
+            logging.error("Worker %d exited with code %s, restarting", index, code)
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+
+    async def poll(self):
+        """Long polling без разбора обновлений: нужен только chat_id для раздачи"""
+        await bot.delete_webhook(drop_pending_updates=True)
+        url = bot.session.api.api_url(bot.token, 'getUpdates')
+        body = {'timeout': 30, 'allowed_updates': dp.resolve_used_update_types()}
+        offset = 0
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+            while True:
+                try:
+                    async with session.post(url, json={**body, 'offset': offset}) as r:
+                        result = await r.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logging.error("getUpdates error: %s", e)
+                    await asyncio.sleep(RATE_RETRY_INTERVAL)
+                    continue
+                if not result.get('ok'):
+                    logging.error("getUpdates failed: %s", result.get('description'))
+                    await asyncio.sleep(result.get('parameters', {}).get('retry_after', RATE_RETRY_INTERVAL))
+                    continue
+                for data in result['result']:
+                    chat_id = update_chat_id(data)
+                    while not self.forward(chat_id, data):
+                        await asyncio.sleep(0.1)
+                    offset = data['update_id'] + 1
+
+    async def run(self):
+        await init_db()
+        if os.path.exists(IPC_SOCKET):
+            os.unlink(IPC_SOCKET)
+        server = await asyncio.start_unix_server(self._client, IPC_SOCKET)
+        os.chmod(IPC_SOCKET, 0o600)
+        monitors = [asyncio.create_task(self._keep_alive(i)) for i in range(PROCESSES)]
+        # Crypto Pay webhooks are credited here and need fresh rates
+        background = [asyncio.create_task(rates.run()), asyncio.create_task(metrics.watch_loop())]
+        await run_web_server()
+        if UPDATE_MODE == 'webhook':
+            await set_telegram_webhook()
+        else:
+            background.append(asyncio.create_task(self.poll()))
+        logger.info(f"Супервизор запущен: {PROCESSES} обработчиков, приём обновлений: {UPDATE_MODE}")
+        await wait_for_signal()
+        logger.info("Остановка: ждём завершения обработчиков")
+        self.stopping = True
+        for task in background:
+            task.cancel()
+        for proc in self.procs:
+            if proc is not None and proc.returncode is None:
+                proc.terminate()
+        # Workers still flush FSM and outbox state through our writer while exiting
+        done, pending = await asyncio.wait(monitors, timeout=WORKER_STOP_TIMEOUT)
+        for proc in self.procs:
+            if proc is not None and proc.returncode is None:
+                proc.kill()
+        server.close()
+        os.unlink(IPC_SOCKET)
+        await crypto_pay.close()
+        await coingecko.close()
+        await db.close()
+        await bot.session.close()
+
+    def stats(self):
+        return {**self.counters, 'workers': sum(link is not None for link in self.links),
+                'backlog': sum(len(b) for b in self.backlog)}
+
+supervisor = Supervisor() if MULTIPROCESS and WORKER_INDEX is None else None
+
+async def run_worker_link(stop):
+    """Обработчик: получает свою долю обновлений от супервизора; обрыв связи — сигнал остановки"""
+    reader, writer = await asyncio.open_unix_connection(IPC_SOCKET)
+    ipc_send(writer, ('updates', WORKER_INDEX))
+    await writer.drain()
+    try:
+        while True:
+            data = await ipc_recv(reader)
+            if data is None:
+                break
+            await updates.put_wait(update_chat_id(data), types.Update.model_validate(data, context={'bot': bot}))
+    finally:
+        writer.close()
+        stop.set()
+
+async def wait_for_signal(stop=None):
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+# ---------------- Web Server ----------------
+async def health_check(request):
+    return web.Response(text="Bot is running")
+
+async def run_web_server():
+    app = web.Application()
+    app.router.add_get('/', health_check)
+    if METRICS_TOKEN:
+        app.router.add_get(METRICS_PATH, metrics_endpoint)
+    app.router.add_post(CRYPTO_WEBHOOK_PATH, crypto_webhook)
+    if UPDATE_MODE == 'webhook':
+        app.router.add_post(TELEGRAM_WEBHOOK_PATH, telegram_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', PORT)
+    await site.start()
+    logger.info(f"Веб-сервер запущен на порту {PORT}")
+
+async def on_startup():
+    if not os.path.exists("media"):
+        os.makedirs("media")
+    await catalog.load()
+    asyncio.create_task(metrics.watch_loop())
+    asyncio.create_task(profiler.run())
+    asyncio.create_task(profiler.watch())
+    if isinstance(storage, SQLiteStorage):
+        asyncio.create_task(storage.run())
+    if WORKER_INDEX is not None:
+        # Updates come from the supervisor; singleton jobs run on the elected leader
+        updates.start()
+        asyncio.create_task(rates.follow())
+        asyncio.create_task(leader.run())
+        asyncio.create_task(metrics.push())
+        logger.info(f"Обработчик {WORKER_INDEX} запущен")
+        return
+    asyncio.create_task(rates.run())
+    asyncio.create_task(reconciler.run())
+    asyncio.create_task(outbox.run())
+    asyncio.create_task(broadcaster.resume())
+    if UPDATE_MODE == 'webhook':
+        updates.start()
+        await run_web_server()
+        await set_telegram_webhook()
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        asyncio.create_task(run_web_server())
+    logger.info("Бот запущен и готов к работе")
+
+async def on_shutdown():
+    await updates.stop()
+    await leader.release()
+    await outbox.flush()
+    await profiler.flush()
+    await crypto_pay.close()
+    await coingecko.close()
+    await db.close()
+
+# ---------------- Callback router ----------------
+PAGE = object()  # Route argument: page number and keyset cursor, see parse_page
+
+class CallbackRouter:
+    """Маршрутизация callback_data вида prefix|arg|arg за O(1).
+
+    Префикс до первого '|' ищется в словаре, аргументы разбираются один раз по
+    типам из объявления маршрута. Маршруты с состоянием FSM проверяются раньше
+    маршрутов без него, поэтому порядок объявления обработчиков не важен.
+    """
+
+    def __init__(self):
+        self.routes = {}  # prefix -> [(state name or None, arg types, handler, wants_state)]
+        self.order = []  # (prefix, state name, has args) in declaration order
+        self.counters = {'routed': 0, 'unhandled': 0, 'bad_args': 0}
+
+    def route(self, prefix, *arg_types, state=None):
+        def decorator(handler):
+            state_name = state.state if state is not None else None
+            wants_state = 'state' in inspect.signature(handler).parameters
+            routes = self.routes.setdefault(prefix, [])
+            routes.append((state_name, arg_types, handler, wants_state))
+            routes.sort(key=lambda r: r[0] is None)
+            self.order.append((prefix, state_name, bool(arg_types)))
+            return handler
+        return decorator
+
+    def parse(self, arg_types, parts):
+        args = []
+        for i, t in enumerate(arg_types):
+            if t is PAGE:
+                args.extend(parse_page(parts, i))
+            else:
+                args.append(t(parts[i]))
+        return args
+
+    async def dispatch(self, callback: CallbackQuery, state: FSMContext):
+        prefix, _, rest = (callback.data or '').partition('|')
+        routes = self.routes.get(prefix)
+        current = await state.get_state() if routes and routes[0][0] is not None else None
+        for state_name, arg_types, handler, wants_state in routes or ():
+            if state_name is not None and state_name != current:
+                continue
+            try:
+                args = self.parse(arg_types, rest.split('|') if rest else [])
+            except (ValueError, IndexError):
+                self.counters['bad_args'] += 1
+                break
+            self.counters['routed'] += 1
+            profile = current_profile.get()
+            if profile is not None:
+                profile.handler = handler.__name__
+            if wants_state:
+                return await handler(callback, *args, state=state)
+            return await handler(callback, *args)
+        else:
+            self.counters['unhandled'] += 1
+        # Stale or malformed button: stop the client spinner
+        await callback.answer()
+
+    def stats(self):
+        return {**self.counters, 'prefixes': len(self.routes)}
+
+callbacks = CallbackRouter()
+dp.callback_query.register(callbacks.dispatch)
+
+# ---------------- Handlers ----------------
+@dp.message(CommandStart())
+async def handler_start(message: Message, command: CommandObject):
+    if await maintenance_block(message): return
+    await ensure_user_record(message.from_user)
+    # Deep link from an inline search result: /start p<product id>
+    if command.args and command.args[0] == 'p' and command.args[1:].isdigit():
+        if await show_product_card(message.chat.id, int(command.args[1:])):
+            return
+    await message.answer(f"👋 Добро пожаловать в *{MARKET_NAME}*!\nВыберите действие ниже:", 
+                        parse_mode="Markdown", 
+                        reply_markup=main_menu_markup(message.from_user.id))
+
+# --- Balance & deposit ---
+@callbacks.route("menu_balance")
+async def cb_balance(callback: CallbackQuery):
+    if await maintenance_block(callback): return
+    await ensure_user_record(callback.from_user)
+    async with db.read() as conn:
+        async with conn.execute("SELECT balance FROM users WHERE user_id=?", (callback.from_user.id,)) as cur:
+            bal = (await cur.fetchone())['balance']
+    text = f"💰 Ваш баланс: *{format_money(bal)}*"
+    markup = simple_markup([
+        [InlineKeyboardButton(text="💸 Пополнить", callback_data="menu_deposit")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
+    ])
+    await nav.show(callback, text, parse_mode="Markdown", reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("menu_deposit")
+async def cb_deposit(callback: CallbackQuery, state: FSMContext):
+    if await maintenance_block(callback): return
+    await nav.show(callback, "💸 Выберите валюту для пополнения (через CryptoBot):", reply_markup=DEPOSIT_MARKUP)
+    await callback.answer()
+
+@callbacks.route("deposit_asset", str)
+async def cb_deposit_asset(callback: CallbackQuery, asset: str, state: FSMContext):
+    if await maintenance_block(callback): return
+    await state.set_state(DepositState.amount)
+    await state.set_data({"asset": asset})
+    await callback.message.answer(f"💸 Введите сумму в RUB, которую хотите пополнить через *{asset}*:", 
+                                parse_mode="Markdown", reply_markup=cancel_markup())
+    await callback.answer()
+
+@dp.message(DepositState.amount)
+async def process_deposit_amount(message: Message, state: FSMContext):
+    data = await state.get_data()
+    asset = data.get("asset")
+    if message.text.strip().lower() in ["отмена", "cancel", "❌"]:
+        await message.answer("❌ Пополнение отменено.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    try:
+        rub = float(message.text.strip().replace(',', '.'))
+        if rub <= 0:
+            raise ValueError("<=0")
+    except Exception:
+        await message.answer("❌ Неверная сумма. Введите число (например 1000.50).", reply_markup=cancel_markup())
+        return
+    try:
+        rate = get_rate(asset)
+        crypto_amount = rub / rate
+    except Exception:
+        await message.answer("❌ Не удалось получить курс. Попробуйте позже.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    resp = await create_invoice(asset, crypto_amount, f"Пополнение {MARKET_NAME} для {message.from_user.id}", message.from_user.id)
+    if resp.get('ok'):
+        inv = resp['result']
+        pay_url = f"https://t.me/CryptoBot/app?startapp=invoice-{inv.get('hash')}&mode=compact"
+        markup = simple_markup([
+            [InlineKeyboardButton(text="💳 Оплатить", url=pay_url)],
+            [InlineKeyboardButton(text="❌ Отменить", callback_data=f"invoice_cancel|{inv.get('invoice_id')}")]
+        ])
+        await message.answer(f"💳 Счет создан:\nСумма: *{rub:.2f} RUB* (~{crypto_amount:.6f} {asset})\nНажмите кнопку для оплаты (CryptoBot).", 
+                           parse_mode="Markdown", reply_markup=markup)
+    else:
+        await message.answer(f"❌ Ошибка создания счета: {resp.get('error')}", reply_markup=main_menu_markup(message.from_user.id))
+    await state.clear()
+
+@callbacks.route("invoice_cancel", int)
+async def cb_invoice_cancel(callback: CallbackQuery, inv_id: int):
+    error = None
+    async with db.write() as conn:
+        async with conn.execute("SELECT user_id,status FROM invoices WHERE invoice_id=?", (inv_id,)) as cur:
+            r = await cur.fetchone()
+        if not r:
+            error = "Счет не найден."
+        elif r['user_id'] != callback.from_user.id:
+            error = "Это не ваш счет."
+        elif r['status'] != 'unpaid':
+            error = "Счет уже оплачен или отменён."
+        else:
+            await conn.execute("DELETE FROM invoices WHERE invoice_id=?", (inv_id,))
+    if error:
+        await callback.message.answer(error)
+        await callback.answer()
+        return
+    await callback.message.answer("❌ Счет отменён.", reply_markup=main_menu_markup(callback.from_user.id))
+    await callback.answer()
+
+# ---------------- Categories & Products ----------------
+@callbacks.route("menu_products")
+async def cb_products(callback: CallbackQuery):
+    if await maintenance_block(callback): return
+    await ensure_user_record(callback.from_user)
+    text = f"🛍 Категории товаров (всего товаров: {(await catalog.ready()).total()})"
+    markup = await build_categories_markup(admin_view=(callback.from_user.id == ADMIN_ID), browse=True)
+    await nav.show(callback, text, reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("cat", int)
+async def cb_category(callback: CallbackQuery, cat_id: int):
+    if await maintenance_block(callback): return
+    name, markup = await build_category_markup(cat_id, callback.from_user.id == ADMIN_ID)
+    if name is None:
+        await callback.message.answer("Категория не найдена.")
+        await callback.answer()
+        return
+    await nav.show(callback, f"📁 *{name}*\nВыберите подкатегорию или просмотреть все товары:",
+                   parse_mode="Markdown", reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("list_products", str, int, PAGE)
+async def cb_list_products(callback: CallbackQuery, mode: str, ident: int, page: int, cursor):
+    if await maintenance_block(callback): return
+    column = "category_id" if mode == "cat" else "subcategory_id"
+    cond, cond_params, order = keyset(cursor)
+    total = (await catalog.ready()).count(mode, ident)
+    async with db.read() as conn:
+        prods = await fetch_page(conn, f"SELECT id,title,created_at FROM products WHERE {column}=? {cond} {order} LIMIT ?",
+                                 (ident, *cond_params, PER_PAGE), cursor)
+    if not prods:
+        await nav.show(callback, "В этой категории пока нет товаров.", reply_markup=main_menu_markup(callback.from_user.id))
+        await callback.answer("Товары не найдены.")
+        return
+    buttons = []
+    for p in prods:
+        buttons.append([InlineKeyboardButton(text=f"🛒 {p['title']}", callback_data=f"view_product|{p['id']}")])
+    total_pages = (total + PER_PAGE - 1) // PER_PAGE
+    nav_buttons = page_nav(f"list_products|{mode}|{ident}", page, total_pages, prods)
+    if nav_buttons:
+        buttons.append(nav_buttons)
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"cat|{ident}" if mode == "cat" else f"list_products|cat|{ident}|1")])
+    markup = simple_markup(buttons)
+    await nav.show(callback, f"Товары (страница {page}/{total_pages}):", reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("view_product", int)
+async def cb_view_product(callback: CallbackQuery, pid: int):
+    if await maintenance_block(callback): return
+    if not await show_product_card(callback, pid):
+        await callback.message.answer("Товар не найден.")
+    await callback.answer()
+
+async def render_product_card(pid):
+    """(текст, клавиатура, фото) карточки товара; None, если товара нет"""
+    async with db.read() as conn:
+        async with conn.execute("""SELECT p.*, s.user_id as seller_user_id, s.username as seller_username
+                                FROM products p LEFT JOIN sellers s ON p.seller_id = s.id WHERE p.id=?""", (pid,)) as cur:
+            p = await cur.fetchone()
+        if not p:
+            return None
+        avg, cnt = await get_rating(conn, 'product', pid)
+    created_at_msk = datetime.fromisoformat(p['created_at']).astimezone(MSK_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    text = f"🛒 *{p['title']}* (ID: {p['id']})\n\n{p['description']}\n\n💵 Цена: *{format_money(p['price'])}*\n📦 Количество: {p['quantity']}\n👤 Продавец: @{p['seller_username'] or '-'}\n⭐ Рейтинг товара: *{avg:.1f}* / 5.0 ({cnt} отзывов)\n📅 Создан: {created_at_msk}"
+    markup = simple_markup([
+        [
+            InlineKeyboardButton(text="🛍 Купить", callback_data=f"buy|{pid}"),
+            InlineKeyboardButton(text="📝 Отзыв", callback_data=f"review|{pid}")
+        ],
+        [InlineKeyboardButton(text="👤 Карточка продавца", callback_data=f"seller_card|{p['seller_user_id']}")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_products")]
+    ])
+    return text, markup, p['photo_file_id']
+
+async def show_product_card(target, pid):
+    """Карточка товара через nav.show; False, если товара нет"""
+    card = await product_cards.get(pid)
+    if card is None:
+        generation = product_cards.generation
+        card = await render_product_card(pid)
+        if card is None:
+            return False
+        product_cards.set(pid, card, generation)
+    text, markup, photo = card
+    await nav.show(target, text, parse_mode="Markdown", reply_markup=markup, photo=photo)
+    return True
+
+# ---------------- Search ----------------
+def search_markup(rows, facets, category_id, page, has_more):
+    buttons = [[InlineKeyboardButton(text=f"{r['title'][:40]} — {format_money(r['price'])}", callback_data=f"view_product|{r['id']}")]
+               for r in rows]
+    page_buttons = []
+    if page > 1:
+        page_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"search_page|{category_id}|{page - 1}"))
+    if has_more:
+        page_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"search_page|{category_id}|{page + 1}"))
+    if page_buttons:
+        buttons.append(page_buttons)
+    filters = [InlineKeyboardButton(text=f"{'✅ ' if f['id'] == category_id else ''}{f['name']} ({f['cnt']})",
+                                    callback_data=f"search_page|{f['id']}|1") for f in facets]
+    if category_id:
+        filters.insert(0, InlineKeyboardButton(text="Все категории", callback_data="search_page|0|1"))
+    for i in range(0, len(filters), 2):
+        buttons.append(filters[i:i + 2])
+    buttons.append([InlineKeyboardButton(text="🔎 Новый поиск", callback_data="menu_search"),
+                    InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")])
+    return simple_markup(buttons)
+
+async def show_search_results(target, query, category_id=0, page=1):
+    rows = await search_products(query, category_id, PER_PAGE + 1, (page - 1) * PER_PAGE)
+    if not rows:
+        await nav.show(target, f"🔎 По запросу «{query}» ничего не найдено.", reply_markup=simple_markup([
+            [InlineKeyboardButton(text="🔎 Новый поиск", callback_data="menu_search"),
+             InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
+        ]))
+        return
+    facets = await search_facets(query)
+    first = (page - 1) * PER_PAGE + 1
+    text = f"🔎 «{query}»: результаты {first}–{first + min(len(rows), PER_PAGE) - 1}"
+    await nav.show(target, text, reply_markup=search_markup(rows[:PER_PAGE], facets, category_id, page,
+                                                            len(rows) > PER_PAGE))
+
+@callbacks.route("menu_search")
+async def cb_search(callback: CallbackQuery, state: FSMContext):
+    if await maintenance_block(callback): return
+    me = await bot.me()
+    await state.set_state(SearchState.query)
+    await callback.message.answer(f"🔎 Введите название товара или начало слова.\n"
+                                  f"В любом чате можно набрать @{me.username} и запрос, "
+                                  f"а #категория сузит поиск.",
+                                  reply_markup=simple_markup([
+                                      [InlineKeyboardButton(text="🔎 Искать прямо здесь", switch_inline_query_current_chat="")],
+                                      [InlineKeyboardButton(text="❌ Отмена", callback_data="action_cancel")]
+                                  ]))
+    await callback.answer()
+
+@dp.message(SearchState.query)
+async def process_search_query(message: Message, state: FSMContext):
+    query = (message.text or '').strip()
+    if not fts_query(query):
+        await message.answer("❌ Введите хотя бы одно слово.", reply_markup=cancel_markup())
+        return
+    # Keep the query for the page and category buttons, leave the input state
+    await state.set_state(None)
+    await state.set_data({"search": query[:100]})
+    await show_search_results(message.chat.id, query[:100])
+
+@callbacks.route("search_page", int, int)
+async def cb_search_page(callback: CallbackQuery, category_id: int, page: int, state: FSMContext):
+    if await maintenance_block(callback): return
+    query = (await state.get_data()).get("search")
+    if not query:
+        await callback.answer("Поиск устарел, начните новый.")
+        return
+    await show_search_results(callback, query, category_id, max(page, 1))
+    await callback.answer()
+
+# ---------------- Inline catalog ----------------
+# Answers depend only on the query text and offset, so they are shared by all users
+inline_cache = TTLCache(INLINE_CACHE_TIME, maxsize=INLINE_CACHE_SIZE)
+
+def category_tag(category_id, name):
+    """Тег категории для инлайн-запроса: слова названия через '_' или #id"""
+    words = re.findall(r'\w+', name.lower())
+    return f"#{'_'.join(words)}" if words else f"#{category_id}"
+
+async def resolve_category_filter(text):
+    """#слово в инлайн-запросе — фильтр по категории: по тегу, иначе по началу названия"""
+    tags = re.findall(r'#(\w+)', text.lower())
+    if not tags:
+        return text, None
+    categories = (await catalog.ready()).sorted_categories()
+    tag = tags[0]
+    found = [c['id'] for c in categories if category_tag(c['id'], c['name']) == f"#{tag}"]
+    found += [c['id'] for c in categories if c['name'].lower().startswith(tag)]
+    return re.sub(r'#\w+', ' ', text), found[0] if found else None
+
+def product_article(r, username):
+    link = f"https://t.me/{username}?start=p{r['id']}"
+    return InlineQueryResultArticle(
+        id=f"p{r['id']}",
+        title=r['title'],
+        description=f"{format_money(r['price'])} · в наличии: {r['quantity']}",
+        input_message_content=InputTextMessageContent(message_text=f"🛒 {r['title']}\n💵 {format_money(r['price'])}\n{link}"),
+        reply_markup=simple_markup([[InlineKeyboardButton(text="🛍 Открыть в боте", url=link)]]),
+    )
+
+def category_article(c, cnt):
+    return InlineQueryResultArticle(
+        id=f"c{c['id']}",
+        title=f"📁 {c['name']}",
+        description=f"Товаров: {cnt}",
+        input_message_content=InputTextMessageContent(message_text=f"📁 {c['name']}"),
+        reply_markup=simple_markup([[InlineKeyboardButton(
+            text="📦 Листать категорию", switch_inline_query_current_chat=f"{category_tag(c['id'], c['name'])} ")]]),
+    )
+
+async def inline_answer(query, offset):
+    """(результаты, next_offset) для запроса.
+
+    Пустой запрос — категории, только #категория — её товары от новых к старым
+    (next_offset — курсор keyset), иначе полнотекстовый поиск (next_offset — смещение).
+    """
+    text, category_id = await resolve_category_filter(query)
+    username = (await bot.me()).username
+    if fts_query(text):
+        start = int(offset) if offset.isdigit() else 0
+        rows = await search_products(text, category_id, INLINE_PAGE, start)
+        next_offset = str(start + INLINE_PAGE) if len(rows) == INLINE_PAGE else ""
+        return [product_article(r, username) for r in rows], next_offset
+    if category_id:
+        cursor = offset if offset.startswith('n') else None
+        cond, cond_params, order = keyset(cursor)
+        async with db.read() as conn:
+            rows = await fetch_page(conn, f"""SELECT id,title,price,quantity,created_at FROM products
+                                    WHERE category_id=? {cond} {order} LIMIT ?""",
+                                    (category_id, *cond_params, INLINE_PAGE), cursor)
+        next_offset = "n" + encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if len(rows) == INLINE_PAGE else ""
+        return [product_article(r, username) for r in rows], next_offset
+    start = int(offset) if offset.isdigit() else 0
+    tree = await catalog.ready()
+    categories = tree.sorted_categories()[start:start + INLINE_PAGE]
+    next_offset = str(start + INLINE_PAGE) if start + INLINE_PAGE < len(tree.categories) else ""
+    return [category_article(c, tree.count('cat', c['id'])) for c in categories], next_offset
+
+@dp.inline_query()
+async def inline_search(inline_query: InlineQuery):
+    if await is_maintenance():
+        # Not cached by Telegram, or results stay empty after maintenance ends
+        await inline_query.answer([], cache_time=0, is_personal=True)
+        return
+    query = ' '.join(inline_query.query.lower().split())
+    key = (query, inline_query.offset)
+    answer = inline_cache.get(key)
+    if answer is _MISSING:
+        try:
+            answer = await inline_answer(query, inline_query.offset)
+        except ValueError:
+            answer = ([], "")  # offset that is not ours
+        inline_cache.set(key, answer)
+    results, next_offset = answer
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+
+# ---------------- Seller Card ----------------
+@callbacks.route("seller_card", int)
+async def cb_seller_card(callback: CallbackQuery, seller_user_id: int):
+    if await maintenance_block(callback): return
+    async with db.read() as conn:
+        async with conn.execute("SELECT id,username,info,user_id FROM sellers WHERE user_id=?", (seller_user_id,)) as cur:
+            s = await cur.fetchone()
+        if s:
+            total_products = await get_counter(conn, 'seller', s['id'])
+            avg, cnt = await get_rating(conn, 'seller', s['id'])
+            async with conn.execute("""SELECT username, rating, text, created_at FROM reviews WHERE seller_id=?
+                                    ORDER BY created_at DESC LIMIT 5""", (s['id'],)) as cur:
+                reviews = await cur.fetchall()
+    if not s:
+        await callback.message.answer("Продавец не найден.")
+        await callback.answer()
+        return
+    msk_tz = pytz.timezone('Europe/Moscow')
+    reviews_text = ""
+    for r in reviews:
+        uname = r['username'] or 'анон'
+        created_at_msk = datetime.fromisoformat(r['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
+        reviews_text += f"⭐ {r['rating']}/5 — @{uname} ({created_at_msk}): {r['text'] or 'Без текста'}\n"
+    text = (f"👤 *Продавец:* @{s['username'] or 'анон'}\n"
+            f"📌 О продавце: {s['info'] or '-'}\n\n"
+            f"📦 Товаров: {total_products}\n⭐ Средняя оценка: *{avg:.1f}* / 5.0 ({cnt} отзывов)\n\n"
+            f"📝 Последние отзывы:\n{reviews_text or 'Отзывов пока нет.'}")
+    markup = simple_markup([
+        [InlineKeyboardButton(text="📦 Посмотреть товары продавца", callback_data=f"list_seller_products|{s['id']}|1")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_products")]
+    ])
+    await nav.show(callback, text, parse_mode="Markdown", reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("list_seller_products", int, PAGE)
+async def cb_list_seller_products(callback: CallbackQuery, sid: int, page: int, cursor):
+    cond, cond_params, order = keyset(cursor)
+    async with db.read() as conn:
+        total = await get_counter(conn, 'seller', sid)
+        prods = await fetch_page(conn, f"SELECT id,title,created_at FROM products WHERE seller_id=? {cond} {order} LIMIT ?",
+                                 (sid, *cond_params, PER_PAGE), cursor)
+    if not prods:
+        await nav.show(callback, "У продавца пока нет товаров.", reply_markup=main_menu_markup(callback.from_user.id))
+        await callback.answer("Нет товаров")
+        return
+    buttons = []
+    for p in prods:
+        buttons.append([InlineKeyboardButton(text=f"🛒 {p['title']}", callback_data=f"view_product|{p['id']}")])
+    total_pages = (total + PER_PAGE - 1) // PER_PAGE
+    nav_buttons = page_nav(f"list_seller_products|{sid}", page, total_pages, prods)
+    if nav_buttons:
+        buttons.append(nav_buttons)
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_products")])
+    markup = simple_markup(buttons)
+    await nav.show(callback, f"Товары продавца (страница {page}/{total_pages}):", reply_markup=markup)
+    await callback.answer()
+
+# ---------------- Buy & Reviews & Disputes logic ----------------
+@callbacks.route("buy", int)
+async def cb_buy(callback: CallbackQuery, pid: int):
+    if await maintenance_block(callback): return
+    await ensure_user_record(callback.from_user)
+    try:
+        order_id, p, seller_user_id = await purchases.buy(callback.from_user.id, pid)
+    except PurchaseError as e:
+        if e.reason == 'not_found':
+            await callback.message.answer("Товар не найден.")
+            await callback.answer()
+        elif e.reason == 'sold_out':
+            await callback.message.answer("Товар закончился.")
+            await callback.answer()
+        else:
+            await callback.message.answer(f"❌ На балансе {format_money(e.balance)}, цена: {format_money(e.price)}. Пополните баланс.", 
+                                        reply_markup=main_menu_markup(callback.from_user.id))
+            await callback.answer("Недостаточно средств.")
+        return
+    await callback.message.answer(f"✅ Вы купили *{p['title']}* за {format_money(p['price'])}.\nСпасибо за покупку!", 
+                                parse_mode="Markdown")
+    # Send content
+    if p['content_text']:
+        await callback.message.answer(f"Содержимое товара: {p['content_text']}")
+    elif p['content_file_id']:
+        try:
+            await bot.send_document(callback.message.chat.id, p['content_file_id'], caption="Содержимое товара")
+        except:
+            await bot.send_photo(callback.message.chat.id, p['content_file_id'], caption="Содержимое товара")
+    # Post-purchase options
+    markup = simple_markup([
+        [InlineKeyboardButton(text="📝 Оставить отзыв", callback_data=f"review|{pid}"),
+         InlineKeyboardButton(text="⚖️ Открыть спор", callback_data=f"dispute|{order_id}")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
+    ])
+    await callback.message.answer("Что дальше?", reply_markup=markup)
+    await notify_seller(seller_user_id, p)
+    await callback.answer()
+
+async def notify_seller(seller_user_id, p):
+    if seller_user_id and await is_notify_enabled(seller_user_id):
+        await outbox.send_message(seller_user_id, 
+                                  f"🎉 Ваш товар *{p['title']}* куплен за {format_money(p['price'])}!\nБаланс пополнен.", 
+                                  parse_mode="Markdown")
+
+async def notify_purchase(user_id, order_id, p, seller_user_id):
+    """Доставка покупки через outbox, если обработчик был прерван после списания"""
+    try:
+        await outbox.send_message(user_id, f"✅ Вы купили *{p['title']}* за {format_money(p['price'])} (заказ #{order_id}).",
+                                  parse_mode="Markdown")
+        if p['content_text']:
+            await outbox.send_message(user_id, f"Содержимое товара: {p['content_text']}")
+        elif p['content_file_id']:
+            await outbox.enqueue('send_document', user_id, document=p['content_file_id'], caption="Содержимое товара")
+        await notify_seller(seller_user_id, p)
+    except Exception as e:
+        logging.error("Late delivery of order %s failed: %s", order_id, e)
+
+@callbacks.route("review", int)
+async def cb_review(callback: CallbackQuery, pid: int, state: FSMContext):
+    if await maintenance_block(callback): return
+    user_id = callback.from_user.id
+    async with db.read() as conn:
+        async with conn.execute("SELECT 1 FROM orders WHERE user_id=? AND product_id=? LIMIT 1", (user_id, pid)) as cur:
+            purchased = await cur.fetchone() is not None
+        async with conn.execute("SELECT 1 FROM reviews WHERE product_id=? AND user_id=? LIMIT 1", (pid, user_id)) as cur:
+            already = await cur.fetchone() is not None
+    if not purchased:
+        await callback.message.answer("Отзыв можно оставить только после покупки этого товара!")
+        await callback.answer()
+        return
+    if already:
+        await callback.message.answer("Вы уже оставляли отзыв на этот товар.")
+        await callback.answer()
+        return
+    await callback.message.answer("⭐ Выберите оценку (1–5):", reply_markup=rating_markup(pid))
+    await callback.answer()
+
+@callbacks.route("leave_rating", int, int)
+async def cb_leave_rating(callback: CallbackQuery, pid: int, rating: int, state: FSMContext):
+    await state.set_state(ReviewState.text)
+    await state.set_data({"pid": pid, "rating": rating})
+    await callback.message.answer("✍️ Оставьте текст отзыва (или напишите `-` чтобы пропустить):", reply_markup=cancel_markup("Пропустить"))
+    await callback.answer()
+
+@dp.message(ReviewState.text)
+async def process_review_text(message: Message, state: FSMContext):
+    data = await state.get_data()
+    pid = data.get("pid")
+    rating = data.get("rating")
+    text = message.text.strip() if message.text and message.text.strip().lower() not in ["-", "отмена", "cancel", "❌"] else ""
+    async with db.write() as conn:
+        # ratings are updated by trigger in this same transaction
+        await conn.execute("""INSERT INTO reviews(product_id,user_id,username,rating,text,created_at,seller_id)
+                           VALUES (?,?,?,?,?,?,(SELECT seller_id FROM products WHERE id=?))""",
+                           (pid, message.from_user.id, message.from_user.username, rating, text, now_iso(), pid))
+    product_cards.invalidate(pid)
+    await message.answer("✅ Спасибо за отзыв!", reply_markup=main_menu_markup(message.from_user.id))
+    await state.clear()
+
+@callbacks.route("dispute", int)
+async def cb_dispute(callback: CallbackQuery, order_id: int, state: FSMContext):
+    if await maintenance_block(callback): return
+    async with db.read() as conn:
+        async with conn.execute("SELECT 1 FROM disputes WHERE order_id=?", (order_id,)) as cur:
+            exists = await cur.fetchone() is not None
+    if exists:
+        await callback.message.answer("Спор по этой покупке уже открыт.")
+        await callback.answer()
+        return
+    await state.set_state(DisputeState.description)
+    await state.set_data({"order_id": order_id})
+    await callback.message.answer("⚖️ Опишите проблему со сделкой:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(DisputeState.description)
+async def process_dispute_desc(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Отмена.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    desc = message.text.strip()
+    data = await state.get_data()
+    order_id = data.get("order_id")
+    async with db.write() as conn:
+        await conn.execute("INSERT INTO disputes(order_id, user_id, description, created_at) VALUES (?, ?, ?, ?)",
+                           (order_id, message.from_user.id, desc, now_iso()))
+    await message.answer("⚖️ Заявка на спор отправлена администраторам.", reply_markup=main_menu_markup(message.from_user.id))
+    await state.clear()
+
+# ---------------- Selling ----------------
+@callbacks.route("menu_sell")
+async def cb_menu_sell(callback: CallbackQuery):
+    if await maintenance_block(callback): return
+    await ensure_user_record(callback.from_user)
+    async with db.read() as conn:
+        async with conn.execute("SELECT id FROM sellers WHERE user_id=?", (callback.from_user.id,)) as cur:
+            s = await cur.fetchone()
+    if not s:
+        markup = simple_markup([
+            [InlineKeyboardButton(text="📝 Создать профиль продавца", callback_data="seller_create")],
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
+        ])
+        await nav.show(callback, "Вы ещё не продавец. Создайте профиль продавца, чтобы выставлять товары.", reply_markup=markup)
+    else:
+        markup = simple_markup([
+            [InlineKeyboardButton(text="➕ Добавить товар", callback_data="add_product")],
+            [InlineKeyboardButton(text="📦 Мои товары", callback_data=f"my_products|{callback.from_user.id}|1")],
+            [InlineKeyboardButton(text="💸 Мои продажи", callback_data=f"my_sales|{s['id']}|1")],
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
+        ])
+        await nav.show(callback, "🎪 Панель продавца", reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("seller_create")
+async def cb_seller_create(callback: CallbackQuery, state: FSMContext):
+    if await maintenance_block(callback): return
+    await state.set_state(SellerCreate.info)
+    await callback.message.answer("📝 Введите краткую информацию о себе (описание продавца):", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(SellerCreate.info)
+async def process_seller_info(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Создание профиля отменено.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    info = message.text.strip()
+    async with db.write() as conn:
+        await conn.execute("INSERT OR IGNORE INTO sellers(user_id,username,info) VALUES (?,?,?)", 
+                         (message.from_user.id, message.from_user.username, info))
+        await conn.execute("UPDATE sellers SET info=? WHERE user_id=?", (info, message.from_user.id))
+    await message.answer("✅ Профиль продавца создан/обновлён.", reply_markup=main_menu_markup(message.from_user.id))
+    await state.clear()
+
+@callbacks.route("seller_edit_info")
+async def cb_seller_edit_info(callback: CallbackQuery, state: FSMContext):
+    if await maintenance_block(callback): return
+    async with db.read() as conn:
+        async with conn.execute("SELECT id FROM sellers WHERE user_id=?", (callback.from_user.id,)) as cur:
+            s = await cur.fetchone()
+    if not s:
+        await callback.message.answer("Профиль продавца не найден.")
+        await callback.answer()
+        return
+    await state.set_state(SellerEditInfo.info)
+    await callback.message.answer("📝 Введите новое описание продавца:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(SellerEditInfo.info)
+async def process_seller_edit_info(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Изменение профиля отменено.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    info = message.text.strip()
+    async with db.write() as conn:
+        await conn.execute("UPDATE sellers SET info=? WHERE user_id=?", (info, message.from_user.id))
+    await message.answer("✅ Описание продавца обновлено.", reply_markup=main_menu_markup(message.from_user.id))
+    await state.clear()
+
+# ---------------- Add Product ----------------
+@callbacks.route("add_product")
+async def cb_add_product(callback: CallbackQuery, state: FSMContext):
+    if await maintenance_block(callback): return
+    async with db.read() as conn:
+        async with conn.execute("SELECT id FROM sellers WHERE user_id=?", (callback.from_user.id,)) as cur:
+            seller = await cur.fetchone()
+    if not seller:
+        await callback.message.answer("Вы не зарегистрированы как продавец. Сначала создайте профиль продавца.", 
+                                    reply_markup=main_menu_markup(callback.from_user.id))
+        await callback.answer()
+        return
+    await state.set_state(AddProduct.photo)
+    await state.set_data({"seller_id": seller['id']})
+    await callback.message.answer("📸 Отправьте фото товара (или напишите `-` для пропуска):", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AddProduct.photo)
+async def process_product_photo(message: Message, state: FSMContext):
+    if message.text and message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    data = await state.get_data()
+    photo_file_id = None
+    if message.text and message.text.strip().lower() == "-":
+        pass
+    elif message.photo:
+        photo_file_id = message.photo[-1].file_id
+    else:
+        await message.answer("❌ Пожалуйста, отправьте фото или напишите `-` для пропуска.", reply_markup=cancel_markup("Отмена"))
+        return
+    await state.set_state(AddProduct.title)
+    await state.update_data({"photo_file_id": photo_file_id})
+    await message.answer("📝 Введите название товара:", reply_markup=cancel_markup("Отмена"))
+    
+@dp.message(AddProduct.title)
+async def process_product_title(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    title = message.text.strip()
+    if len(title) > 100:
+        await message.answer("❌ Название слишком длинное (макс. 100 символов).", reply_markup=cancel_markup("Отмена"))
+        return
+    await state.set_state(AddProduct.desc)
+    await state.update_data({"title": title})
+    await message.answer("📝 Введите описание товара:", reply_markup=cancel_markup("Отмена"))
+
+@dp.message(AddProduct.desc)
+async def process_product_desc(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    desc = message.text.strip()
+    if len(desc) > 1000:
+        await message.answer("❌ Описание слишком длинное (макс. 1000 символов).", reply_markup=cancel_markup("Отмена"))
+        return
+    await state.set_state(AddProduct.price)
+    await state.update_data({"description": desc})
+    await message.answer("💵 Введите цену товара в RUB (например, 1000.50):", reply_markup=cancel_markup("Отмена"))
+
+@dp.message(AddProduct.price)
+async def process_product_price(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    try:
+        price = float(message.text.strip().replace(',', '.'))
+        if price <= 0:
+            raise ValueError("<=0")
+    except Exception:
+        await message.answer("❌ Неверная цена. Введите число (например, 1000.50).", reply_markup=cancel_markup("Отмена"))
+        return
+    await state.set_state(AddProduct.quantity)
+    await state.update_data({"price": price})
+    await message.answer("📦 Введите количество товара (например, 1):", reply_markup=cancel_markup("Отмена"))
+
+@dp.message(AddProduct.quantity)
+async def process_product_quantity(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    try:
+        quantity = int(message.text.strip())
+        if quantity <= 0:
+            raise ValueError("<=0")
+    except Exception:
+        await message.answer("❌ Неверное количество. Введите целое число (например, 1).", reply_markup=cancel_markup("Отмена"))
+        return
+    await state.set_state(AddProduct.content)
+    await state.update_data({"quantity": quantity})
+    markup = await build_categories_markup()
+    await message.answer("📁 Выберите категорию для товара:", reply_markup=markup)
+
+@callbacks.route("cat", int, state=AddProduct.content)
+async def cb_product_category(callback: CallbackQuery, cat_id: int, state: FSMContext):
+    if await maintenance_block(callback): return
+    markup = await build_pick_subcategory_markup(cat_id)
+    await state.update_data({"category_id": cat_id})
+    await callback.message.answer("📂 Выберите подкатегорию:", reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("subcat", int, state=AddProduct.content)
+async def cb_product_subcategory(callback: CallbackQuery, subcat_id: int, state: FSMContext):
+    if await maintenance_block(callback): return
+    await state.update_data({"subcategory_id": subcat_id})
+    await callback.message.answer("📝 Отправьте содержимое товара (текст или файл):", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AddProduct.content)
+async def process_product_content(message: Message, state: FSMContext):
+    if message.text and message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Добавление товара отменено.", reply_markup=main_menu_markup(message.from_user.id))
+        await state.clear()
+        return
+    data = await state.get_data()
+    content_text = None
+    content_file_id = None
+    if message.text:
+        content_text = message.text.strip()
+    elif message.document:
+        content_file_id = message.document.file_id
+    elif message.photo:
+        content_file_id = message.photo[-1].file_id
+    else:
+        await message.answer("❌ Отправьте текст или файл для содержимого товара.", reply_markup=cancel_markup("Отмена"))
+        return
+    async with db.write() as conn:
+        await conn.execute("""INSERT INTO products(seller_id, title, description, photo_file_id, category_id, 
+                           subcategory_id, price, quantity, content_text, content_file_id, created_at) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                           (data['seller_id'], data['title'], data['description'], data.get('photo_file_id'), 
+                            data['category_id'], data['subcategory_id'], data['price'], data['quantity'], 
+                            content_text, content_file_id, now_iso()))
+    catalog.product_added(data['category_id'], data['subcategory_id'])
+    await message.answer("✅ Товар успешно добавлен!", reply_markup=main_menu_markup(message.from_user.id))
+    await state.clear()
+
+# ---------------- My Products ----------------
+@callbacks.route("my_products", int, PAGE)
+async def cb_my_products(callback: CallbackQuery, user_id: int, page: int, cursor):
+    if await maintenance_block(callback): return
+    if user_id != callback.from_user.id:
+        await callback.message.answer("❌ Это не ваши товары!")
+        await callback.answer()
+        return
+    cond, cond_params, order = keyset(cursor)
+    async with db.read() as conn:
+        async with conn.execute("SELECT id FROM sellers WHERE user_id=?", (user_id,)) as cur:
+            seller = await cur.fetchone()
+        if seller:
+            total = await get_counter(conn, 'seller', seller['id'])
+            prods = await fetch_page(conn, f"SELECT id,title,created_at FROM products WHERE seller_id=? {cond} {order} LIMIT ?",
+                                     (seller['id'], *cond_params, PER_PAGE), cursor)
+    if not seller:
+        await nav.show(callback, "Вы не зарегистрированы как продавец.", reply_markup=main_menu_markup(user_id))
+        await callback.answer()
+        return
+    if not prods:
+        await nav.show(callback, "У вас пока нет товаров.", reply_markup=main_menu_markup(user_id))
+        await callback.answer()
+        return
+    buttons = []
+    for p in prods:
+        buttons.append([InlineKeyboardButton(text=f"🛒 {p['title']}", callback_data=f"view_product|{p['id']}")])
+    total_pages = (total + PER_PAGE - 1) // PER_PAGE
+    nav_buttons = page_nav(f"my_products|{user_id}", page, total_pages, prods)
+    if nav_buttons:
+        buttons.append(nav_buttons)
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_sell")])
+    markup = simple_markup(buttons)
+    await nav.show(callback, f"Ваши товары (страница {page}/{total_pages}):", reply_markup=markup)
+    await callback.answer()
+
+# ---------------- My Sales ----------------
+@callbacks.route("my_sales", int, PAGE)
+async def cb_my_sales(callback: CallbackQuery, seller_id: int, page: int, cursor):
+    if await maintenance_block(callback): return
+    cond, cond_params, order = keyset(cursor, alias="o.")
+    async with db.read() as conn:
+        async with conn.execute("SELECT user_id FROM sellers WHERE id=?", (seller_id,)) as cur:
+            seller = await cur.fetchone()
+        allowed = seller and seller['user_id'] == callback.from_user.id
+        if allowed:
+            total = await get_counter(conn, 'sales', seller_id)
+            orders = await fetch_page(conn, f"""SELECT o.id, o.price, o.created_at, p.title, u.username
+                                      FROM orders o
+                                      JOIN products p ON o.product_id = p.id
+                                      JOIN users u ON o.user_id = u.user_id
+                                      WHERE o.seller_id=? {cond}
+                                      {order} LIMIT ?""",
+                                      (seller_id, *cond_params, PER_PAGE), cursor)
+    if not allowed:
+        await callback.message.answer("❌ Это не ваши продажи!")
+        await callback.answer()
+        return
+    if not orders:
+        await nav.show(callback, "У вас пока нет продаж.", reply_markup=main_menu_markup(callback.from_user.id))
+        await callback.answer()
+        return
+    total_pages = (total + PER_PAGE - 1) // PER_PAGE
+    msk_tz = pytz.timezone('Europe/Moscow')
+    text = f"📊 Ваши продажи (страница {page}/{total_pages}):\n\n"
+    for o in orders:
+        created_at_msk = datetime.fromisoformat(o['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
+        text += f"🛒 {o['title']} — {format_money(o['price'])} (@{o['username'] or 'анон'}, {created_at_msk})\n"
+    buttons = [[b] for b in page_nav(f"my_sales|{seller_id}", page, total_pages, orders)]
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_sell")])
+    markup = simple_markup(buttons)
+    await nav.show(callback, text, reply_markup=markup)
+    await callback.answer()
+
+# ---------------- Admin Panel ----------------
+@callbacks.route("menu_admin")
+async def cb_admin_panel(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await nav.show(callback, "🔧 Админ-панель:", reply_markup=ADMIN_PANEL_MARKUP)
+    await callback.answer()
+
+@callbacks.route("admin_cats")
+async def cb_admin_cats(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    markup = await build_admin_categories_markup()
+    await nav.show(callback, "📁 Управление категориями:", reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("admin_create_category")
+async def cb_admin_create_category(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await state.set_state(AdminNewCategory.name)
+    await callback.message.answer("📝 Введите название новой категории:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminNewCategory.name)
+async def process_admin_new_category(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Создание категории отменено.", reply_markup=back_markup("admin_cats"))
+        await state.clear()
+        return
+    name = message.text.strip()
+    try:
+        async with db.write() as conn:
+            cur = await conn.execute("INSERT INTO categories(name) VALUES (?)", (name,))
+            cat_id = cur.lastrowid
+        catalog.add_category(cat_id, name)
+        await message.answer(f"✅ Категория '{name}' создана.", reply_markup=back_markup("admin_cats"))
+    except sqlite3.IntegrityError:
+        await message.answer("❌ Категория с таким названием уже существует.", reply_markup=cancel_markup("Отмена"))
+        return
+    await state.clear()
+
+@callbacks.route("admin_edit_cat", int)
+async def cb_admin_edit_category(callback: CallbackQuery, cat_id: int, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await state.set_state(AdminEditCategory.name)
+    await state.set_data({"cat_id": cat_id})
+    await callback.message.answer("📝 Введите новое название категории:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminEditCategory.name)
+async def process_admin_edit_category(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Изменение категории отменено.", reply_markup=back_markup("admin_cats"))
+        await state.clear()
+        return
+    name = message.text.strip()
+    data = await state.get_data()
+    cat_id = data.get("cat_id")
+    try:
+        async with db.write() as conn:
+            await conn.execute("UPDATE categories SET name=? WHERE id=?", (name, cat_id))
+        catalog.rename_category(cat_id, name)
+        await message.answer(f"✅ Категория обновлена: '{name}'.", reply_markup=back_markup("admin_cats"))
+    except sqlite3.IntegrityError:
+        await message.answer("❌ Категория с таким названием уже существует.", reply_markup=cancel_markup("Отмена"))
+        return
+    await state.clear()
+
+@callbacks.route("admin_delete_cat", int)
+async def cb_admin_delete_category(callback: CallbackQuery, cat_id: int):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    async with db.write() as conn:
+        cnt = await get_counter(conn, 'cat', cat_id)
+        if cnt == 0:
+            await conn.execute("DELETE FROM categories WHERE id=?", (cat_id,))
+            await conn.execute("DELETE FROM subcategories WHERE category_id=?", (cat_id,))
+    if cnt > 0:
+        await callback.message.answer("❌ Нельзя удалить категорию, в которой есть товары.")
+        await callback.answer()
+        return
+    catalog.remove_category(cat_id)
+    await nav.show(callback, "✅ Категория удалена.", reply_markup=back_markup("admin_cats"))
+    await callback.answer()
+
+@callbacks.route("admin_view_cat", int)
+async def cb_admin_view_category(callback: CallbackQuery, cat_id: int):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    markup = await build_admin_subcategories_markup(cat_id)
+    await nav.show(callback, f"📁 Категория ID {cat_id}:", reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("admin_create_sub", int)
+async def cb_admin_create_subcategory(callback: CallbackQuery, cat_id: int, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await state.set_state(AdminNewSub.name)
+    await state.set_data({"cat_id": cat_id})
+    await callback.message.answer("📝 Введите название новой подкатегории:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminNewSub.name)
+async def process_admin_new_subcategory(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Создание подкатегории отменено.", reply_markup=back_markup("admin_cats"))
+        await state.clear()
+        return
+    name = message.text.strip()
+    data = await state.get_data()
+    cat_id = data.get("cat_id")
+    async with db.write() as conn:
+        cur = await conn.execute("INSERT INTO subcategories(category_id, name) VALUES (?, ?)", (cat_id, name))
+        sub_id = cur.lastrowid
+    catalog.add_subcategory(sub_id, cat_id, name)
+    await message.answer(f"✅ Подкатегория '{name}' создана.", reply_markup=back_markup(f"admin_view_cat|{cat_id}"))
+    await state.clear()
+
+@callbacks.route("admin_edit_sub", int)
+async def cb_admin_edit_subcategory(callback: CallbackQuery, sub_id: int, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    cat = (await catalog.ready()).subcategory(sub_id)
+    if not cat:
+        await callback.message.answer("❌ Подкатегория не найдена.")
+        await callback.answer()
+        return
+    await state.set_state(AdminEditSub.name)
+    await state.set_data({"sub_id": sub_id, "cat_id": cat['category_id']})
+    await callback.message.answer("📝 Введите новое название подкатегории:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminEditSub.name)
+async def process_admin_edit_subcategory(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Изменение подкатегории отменено.", reply_markup=back_markup("admin_cats"))
+        await state.clear()
+        return
+    name = message.text.strip()
+    data = await state.get_data()
+    sub_id = data.get("sub_id")
+    cat_id = data.get("cat_id")
+    async with db.write() as conn:
+        await conn.execute("UPDATE subcategories SET name=? WHERE id=?", (name, sub_id))
+    catalog.rename_subcategory(sub_id, name)
+    await message.answer(f"✅ Подкатегория обновлена: '{name}'.", reply_markup=back_markup(f"admin_view_cat|{cat_id}"))
+    await state.clear()
+
+@callbacks.route("admin_delete_sub", int)
+async def cb_admin_delete_subcategory(callback: CallbackQuery, sub_id: int):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    cat = (await catalog.ready()).subcategory(sub_id)
+    if not cat:
+        await callback.message.answer("❌ Подкатегория не найдена.")
+        await callback.answer()
+        return
+    # The count is checked inside the write: a product may be added right now
+    async with db.write() as conn:
+        cnt = await get_counter(conn, 'sub', sub_id)
+        if cnt == 0:
+            await conn.execute("DELETE FROM subcategories WHERE id=?", (sub_id,))
+    if cnt > 0:
+        await callback.message.answer("❌ Нельзя удалить подкатегорию, в которой есть товары.")
+        await callback.answer()
+        return
+    catalog.remove_subcategory(sub_id)
+    await nav.show(callback, "✅ Подкатегория удалена.", reply_markup=back_markup(f"admin_view_cat|{cat['category_id']}"))
+    await callback.answer()
+
+@callbacks.route("admin_search_user")
+async def cb_admin_search_user(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await state.set_state(AdminSearchUser.user_id)
+    await callback.message.answer("🔍 Введите ID пользователя:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminSearchUser.user_id)
+async def process_admin_search_user(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Поиск отменён.", reply_markup=back_markup("menu_admin"))
+        await state.clear()
+        return
+    try:
+        user_id = int(message.text.strip())
+    except Exception:
+        await message.answer("❌ Неверный ID. Введите число.", reply_markup=cancel_markup("Отмена"))
+        return
+    async with db.read() as conn:
+        async with conn.execute("SELECT user_id,username,balance,notify_enabled FROM users WHERE user_id=?", (user_id,)) as cur:
+            user = await cur.fetchone()
+    if not user:
+        await message.answer("❌ Пользователь не найден.", reply_markup=back_markup("menu_admin"))
+        await state.clear()
+        return
+    text = (f"👤 Пользователь: @{user['username'] or 'анон'}\n"
+            f"🆔 ID: {user['user_id']}\n"
+            f"💰 Баланс: {format_money(user['balance'])}\n"
+            f"🔔 Уведомления: {'вкл' if user['notify_enabled'] else 'выкл'}")
+    markup = simple_markup([
+        [InlineKeyboardButton(text="💸 Изменить баланс", callback_data=f"admin_balance|{user['user_id']}")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
+    ])
+    await message.answer(text, reply_markup=markup)
+    await state.clear()
+
+@callbacks.route("admin_balance", int)
+async def cb_admin_balance(callback: CallbackQuery, user_id: int, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await state.set_state(AdminBalanceChange.amount)
+    await state.set_data({"user_id": user_id})
+    await callback.message.answer("💸 Введите новую сумму баланса (RUB):", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminBalanceChange.amount)
+async def process_admin_balance_change(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Изменение баланса отменено.", reply_markup=back_markup("menu_admin"))
+        await state.clear()
+        return
+    try:
+        amount = float(message.text.strip().replace(',', '.'))
+        if amount < 0:
+            raise ValueError("Отрицательный баланс")
+    except Exception:
+        await message.answer("❌ Неверная сумма. Введите число (например, 1000.50).", reply_markup=cancel_markup("Отмена"))
+        return
+    data = await state.get_data()
+    user_id = data.get("user_id")
+    async with db.write() as conn:
+        await conn.execute("UPDATE users SET balance=? WHERE user_id=?", (amount, user_id))
+    await message.answer(f"✅ Баланс пользователя ID {user_id} обновлён: {format_money(amount)}.", reply_markup=back_markup("menu_admin"))
+    if await is_notify_enabled(user_id):
+        await outbox.send_message(user_id, f"💰 Ваш баланс изменён администратором: {format_money(amount)}")
+    await state.clear()
+
+@callbacks.route("admin_search_product")
+async def cb_admin_search_product(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await state.set_state(AdminProdSearch.prod_id)
+    await callback.message.answer("🔍 Введите ID товара:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminProdSearch.prod_id)
+async def process_admin_search_product(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Поиск отменён.", reply_markup=back_markup("menu_admin"))
+        await state.clear()
+        return
+    try:
+        prod_id = int(message.text.strip())
+    except Exception:
+        await message.answer("❌ Неверный ID. Введите число.", reply_markup=cancel_markup("Отмена"))
+        return
+    async with db.read() as conn:
+        async with conn.execute("""SELECT p.*, s.username as seller_username
+                                FROM products p
+                                LEFT JOIN sellers s ON p.seller_id = s.id
+                                WHERE p.id=?""", (prod_id,)) as cur:
+            prod = await cur.fetchone()
+    if not prod:
+        await message.answer("❌ Товар не найден.", reply_markup=back_markup("menu_admin"))
+        await state.clear()
+        return
+    msk_tz = pytz.timezone('Europe/Moscow')
+    created_at_msk = datetime.fromisoformat(prod['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
+    text = (f"🛒 *{prod['title']}* (ID: {prod['id']})\n\n"
+            f"{prod['description']}\n\n"
+            f"💵 Цена: {format_money(prod['price'])}\n"
+            f"📦 Количество: {prod['quantity']}\n"
+            f"👤 Продавец: @{prod['seller_username'] or 'анон'}\n"
+            f"📅 Создан: {created_at_msk}")
+    markup = simple_markup([
+        [InlineKeyboardButton(text="✏️ Изменить название", callback_data=f"admin_edit_prod_name|{prod['id']}"),
+         InlineKeyboardButton(text="✏️ Изменить описание", callback_data=f"admin_edit_prod_desc|{prod['id']}")],
+        [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"admin_delete_prod|{prod['id']}")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
+    ])
+    if prod['photo_file_id']:
+        await bot.send_photo(message.chat.id, prod['photo_file_id'], caption=text, parse_mode="Markdown", reply_markup=markup)
+    else:
+        await message.answer(text, parse_mode="Markdown", reply_markup=markup)
+    await state.clear()
+
+@callbacks.route("admin_edit_prod_name", int)
+async def cb_admin_edit_product_name(callback: CallbackQuery, prod_id: int, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await state.set_state(AdminEditProduct.name)
+    await state.set_data({"prod_id": prod_id})
+    await callback.message.answer("📝 Введите новое название товара:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminEditProduct.name)
+async def process_admin_edit_product_name(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Изменение названия отменено.", reply_markup=back_markup("menu_admin"))
+        await state.clear()
+        return
+    name = message.text.strip()
+    if len(name) > 100:
+        await message.answer("❌ Название слишком длинное (макс. 100 символов).", reply_markup=cancel_markup("Отмена"))
+        return
+    data = await state.get_data()
+    prod_id = data.get("prod_id")
+    async with db.write() as conn:
+        await conn.execute("UPDATE products SET title=? WHERE id=?", (name, prod_id))
+    product_cards.invalidate(prod_id)
+    await message.answer(f"✅ Название товара обновлено: '{name}'.", reply_markup=back_markup("menu_admin"))
+    await state.clear()
+
+@callbacks.route("admin_edit_prod_desc", int)
+async def cb_admin_edit_product_desc(callback: CallbackQuery, prod_id: int, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await state.set_state(AdminEditProduct.desc)
+    await state.set_data({"prod_id": prod_id})
+    await callback.message.answer("📝 Введите новое описание товара:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminEditProduct.desc)
+async def process_admin_edit_product_desc(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Изменение описания отменено.", reply_markup=back_markup("menu_admin"))
+        await state.clear()
+        return
+    desc = message.text.strip()
+    if len(desc) > 1000:
+        await message.answer("❌ Описание слишком длинное (макс. 1000 символов).", reply_markup=cancel_markup("Отмена"))
+        return
+    data = await state.get_data()
+    prod_id = data.get("prod_id")
+    async with db.write() as conn:
+        await conn.execute("UPDATE products SET description=? WHERE id=?", (desc, prod_id))
+    product_cards.invalidate(prod_id)
+    await message.answer(f"✅ Описание товара обновлено.", reply_markup=back_markup("menu_admin"))
+    await state.clear()
+
+@callbacks.route("admin_delete_prod", int)
+async def cb_admin_delete_product(callback: CallbackQuery, prod_id: int):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    async with db.write() as conn:
+        async with conn.execute("SELECT category_id, subcategory_id FROM products WHERE id=?", (prod_id,)) as cur:
+            prod = await cur.fetchone()
+        await conn.execute("DELETE FROM products WHERE id=?", (prod_id,))
+        await conn.execute("DELETE FROM reviews WHERE product_id=?", (prod_id,))
+        await conn.execute("DELETE FROM disputes WHERE order_id IN (SELECT id FROM orders WHERE product_id=?)", (prod_id,))
+        await conn.execute("DELETE FROM orders WHERE product_id=?", (prod_id,))
+    product_cards.invalidate(prod_id)
+    if prod:
+        catalog.product_removed(prod['category_id'], prod['subcategory_id'])
+    await nav.show(callback, "✅ Товар удалён.", reply_markup=back_markup("menu_admin"))
+    await callback.answer()
+
+@callbacks.route("admin_disputes")
+async def cb_admin_disputes(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    async with db.read() as conn:
+        async with conn.execute("""SELECT d.id, d.order_id, d.user_id, d.description, d.created_at, u.username, p.title
+                                FROM disputes d
+                                JOIN users u ON d.user_id = u.user_id
+                                JOIN orders o ON d.order_id = o.id
+                                JOIN products p ON o.product_id = p.id
+                                WHERE d.status = 'open'
+                                ORDER BY d.created_at DESC""") as cur:
+            disputes = await cur.fetchall()
+    if not disputes:
+        await nav.show(callback, "⚖️ Нет открытых споров.", reply_markup=back_markup("menu_admin"))
+        await callback.answer()
+        return
+    msk_tz = pytz.timezone('Europe/Moscow')
+    text = "⚖️ Открытые споры:\n\n"
+    buttons = []
+    for d in disputes:
+        created_at_msk = datetime.fromisoformat(d['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
+        text += f"🆔 Спор {d['id']} (Заказ {d['order_id']}): @{d['username'] or 'анон'}\nТовар: {d['title']}\nОписание: {d['description']}\n📅 {created_at_msk}\n\n"
+        buttons.append([InlineKeyboardButton(text=f"Спор {d['id']}", callback_data=f"admin_view_dispute|{d['id']}")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")])
+    markup = simple_markup(buttons)
+    await nav.show(callback, text, reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("admin_view_dispute", int)
+async def cb_admin_view_dispute(callback: CallbackQuery, dispute_id: int, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    async with db.read() as conn:
+        async with conn.execute("""SELECT d.id, d.order_id, d.user_id, d.description, d.created_at, u.username, p.title
+                                FROM disputes d
+                                JOIN users u ON d.user_id = u.user_id
+                                JOIN orders o ON d.order_id = o.id
+                                JOIN products p ON o.product_id = p.id
+                                WHERE d.id=?""", (dispute_id,)) as cur:
+            d = await cur.fetchone()
+    if not d:
+        await nav.show(callback, "❌ Спор не найден.", reply_markup=back_markup("admin_disputes"))
+        await callback.answer()
+        return
+    msk_tz = pytz.timezone('Europe/Moscow')
+    created_at_msk = datetime.fromisoformat(d['created_at']).astimezone(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
+    text = (f"⚖️ Спор ID {d['id']} (Заказ {d['order_id']}):\n"
+            f"👤 Пользователь: @{d['username'] or 'анон'}\n"
+            f"🛒 Товар: {d['title']}\n"
+            f"📝 Описание спора: {d['description']}\n"
+            f"📅 Создан: {created_at_msk}")
+    markup = simple_markup([
+        [InlineKeyboardButton(text="✅ Закрыть спор", callback_data=f"admin_close_dispute|{d['id']}")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_disputes")]
+    ])
+    await nav.show(callback, text, reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("admin_close_dispute", int)
+async def cb_admin_close_dispute(callback: CallbackQuery, dispute_id: int, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    if await maintenance_block(callback): return
+    await state.set_state(AdminCloseDispute.reason)
+    await state.set_data({"dispute_id": dispute_id})
+    await callback.message.answer("📝 Укажите причину закрытия спора:", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminCloseDispute.reason)
+async def process_admin_close_dispute(message: Message, state: FSMContext):
+    if message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Закрытие спора отменено.", reply_markup=back_markup("admin_disputes"))
+        await state.clear()
+        return
+    reason = message.text.strip()
+    data = await state.get_data()
+    dispute_id = data.get("dispute_id")
+    async with db.write() as conn:
+        await conn.execute("UPDATE disputes SET status='closed', close_reason=? WHERE id=?", (reason, dispute_id))
+        async with conn.execute("SELECT user_id FROM disputes WHERE id=?", (dispute_id,)) as cur:
+            d = await cur.fetchone()
+    await message.answer("✅ Спор закрыт.", reply_markup=back_markup("admin_disputes"))
+    if d and await is_notify_enabled(d['user_id']):
+        await outbox.send_message(d['user_id'], f"⚖️ Ваш спор #{dispute_id} закрыт.\nПричина: {reason}")
+    await state.clear()
+
+@callbacks.route("admin_broadcast")
+async def cb_admin_broadcast(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    await state.set_state(AdminBroadcast.text)
+    await callback.message.answer("📢 Введите текст рассылки (получат все, у кого включены уведомления):", reply_markup=cancel_markup("Отмена"))
+    await callback.answer()
+
+@dp.message(AdminBroadcast.text)
+async def process_admin_broadcast_text(message: Message, state: FSMContext):
+    if not message.text or message.text.strip().lower() in ("отмена", "cancel", "❌"):
+        await message.answer("❌ Рассылка отменена.", reply_markup=back_markup("menu_admin"))
+        await state.clear()
+        return
+    await state.update_data(text=message.text)
+    await message.answer(f"📢 Предпросмотр рассылки:\n\n{message.text}", reply_markup=simple_markup([
+        [InlineKeyboardButton(text="✅ Отправить", callback_data="bcast_go")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="action_cancel")]
+    ]))
+
+@callbacks.route("bcast_go")
+async def cb_broadcast_go(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+    text = (await state.get_data()).get("text")
+    await state.clear()
+    if not text:
+        await callback.answer("Текст рассылки не найден.")
+        return
+    await broadcaster.start(callback.message.chat.id, text)
+    await callback.answer("Рассылка запущена")
+
+@callbacks.route("bcast_stop", int)
+async def cb_broadcast_stop(callback: CallbackQuery, bid: int):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+    await broadcaster.stop(bid)
+    await callback.answer("Рассылка останавливается")
+
+@callbacks.route("admin_maintenance")
+async def cb_admin_maintenance(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    async with db.write() as conn:
+        async with conn.execute("SELECT value FROM settings WHERE key='maintenance'") as cur:
+            current = (await cur.fetchone())['value']
+        new_status = 'off' if current == 'on' else 'on'
+        await conn.execute("UPDATE settings SET value=? WHERE key='maintenance'", (new_status,))
+    settings_cache.set('maintenance', new_status == 'on')
+    status_text = "включены" if new_status == 'on' else "выключены"
+    await nav.show(callback, f"🛠 Технические работы {status_text}.", reply_markup=back_markup("menu_admin"))
+    await callback.answer()
+
+@callbacks.route("admin_rebuild_ratings")
+async def cb_admin_rebuild_ratings(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    started = time.monotonic()
+    await rebuild_ratings()
+    async with db.read() as conn:
+        async with conn.execute("SELECT scope, COUNT(*) AS n FROM ratings GROUP BY scope") as cur:
+            sizes = {r['scope']: r['n'] for r in await cur.fetchall()}
+    await nav.show(callback, f"⭐ Рейтинги пересчитаны за {time.monotonic() - started:.2f} с: "
+                         f"товаров {sizes.get('product', 0)}, продавцов {sizes.get('seller', 0)}.",
+                         reply_markup=simple_markup([[InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]]))
+    await callback.answer()
+
+@callbacks.route("admin_slow")
+async def cb_admin_slow(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.message.answer("❌ Доступ запрещён.")
+        await callback.answer()
+        return
+    rows = await profiler.slowest()
+    text = f"🐢 Самые медленные обработчики за {PROFILE_WINDOW // 60} мин (по среднему времени):\n\n"
+    if not rows:
+        text += "Данных пока нет.\n"
+    for i, r in enumerate(rows, 1):
+        avg, db_ms, tg_ms, api_ms = (r[k] / r['cnt'] * 1000 for k in ('total', 'db', 'telegram', 'upstream'))
+        rest = max(0.0, avg - db_ms - tg_ms - api_ms)
+        text += (f"{i}. `{r['handler']}` — {avg:.0f} мс, макс. {r['worst'] * 1000:.0f} мс, вызовов {r['cnt']}\n"
+                 f"    БД {db_ms:.0f} · Telegram {tg_ms:.0f} · API {api_ms:.0f} · код {rest:.0f} мс\n")
+    text += (f"\nОбновления дольше {PROFILE_SLOW_THRESHOLD:g} с пишутся в `{SLOW_LOG_FILE}`. "
+             f"Другие процессы досылают данные раз в {PROFILE_FLUSH_INTERVAL} с.")
+    await nav.show(callback, text, parse_mode="Markdown", reply_markup=simple_markup([
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_slow")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_admin")]
+    ]))
+    await callback.answer()
+
+# ---------------- Support & Settings ----------------
+@callbacks.route("menu_support")
+async def cb_support(callback: CallbackQuery):
+    if await maintenance_block(callback): return
+    await nav.show(callback, f"📞 Для поддержки обратитесь к администратору: {ADMIN_USERNAME}", 
+                         reply_markup=main_menu_markup(callback.from_user.id))
+    await callback.answer()
+
+@callbacks.route("menu_settings")
+async def cb_settings(callback: CallbackQuery, state: FSMContext):
+    if await maintenance_block(callback): return
+    notify_status = "вкл" if await is_notify_enabled(callback.from_user.id) else "выкл"
+    text = f"⚙️ Настройки\n\n🔔 Уведомления: {notify_status}"
+    markup = simple_markup([
+        [InlineKeyboardButton(text="🔔 Переключить уведомления", callback_data="toggle_notify")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_back_main")]
+    ])
+    await nav.show(callback, text, reply_markup=markup)
+    await callback.answer()
+
+@callbacks.route("toggle_notify")
+async def cb_toggle_notify(callback: CallbackQuery):
+    if await maintenance_block(callback): return
+    async with db.write() as conn:
+        async with conn.execute("SELECT notify_enabled FROM users WHERE user_id=?", (callback.from_user.id,)) as cur:
+            user = await cur.fetchone()
+        new_status = 0 if user['notify_enabled'] else 1
+        await conn.execute("UPDATE users SET notify_enabled=? WHERE user_id=?", (new_status, callback.from_user.id))
+    notify_cache.set(callback.from_user.id, bool(new_status))
+    status_text = "включены" if new_status else "выключены"
+    await nav.show(callback, f"🔔 Уведомления {status_text}.", reply_markup=main_menu_markup(callback.from_user.id))
+    await callback.answer()
+
+@callbacks.route("menu_back_main")
+@callbacks.route("action_cancel")
+async def cb_back_main(callback: CallbackQuery, state: FSMContext):
+    if await maintenance_block(callback): return
+    await state.clear()
+    await nav.show(callback, f"👋 Главное меню {MARKET_NAME}:", 
+                         parse_mode="Markdown", reply_markup=main_menu_markup(callback.from_user.id))
+    await callback.answer()
+
+# ---------------- Metrics ----------------
+class Histogram:
+    """Гистограмма с фиксированными границами корзин, отдельная на каждый набор значений меток"""
+
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [count per bucket..., count above the last bucket, sum]
+
+    def observe(self, value, labels=()):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def samples(self):
+        for values, s in self.series.items():
+            labels = tuple(zip(self.labels, values))
+            cumulative = 0
+            for bound, n in zip(self.buckets, s):
+                cumulative += n
+                yield '_bucket', labels + (('le', f"{bound:g}"),), cumulative
+            cumulative += s[-2]
+            yield '_bucket', labels + (('le', '+Inf'),), cumulative
+            yield '_sum', labels, s[-1]
+            yield '_count', labels, cumulative
+
+def _flat_stats(stats, prefix=''):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flat_stats(value, f"{prefix}{key}_")
+        elif isinstance(value, (int, float)):
+            yield prefix + str(key), int(value) if isinstance(value, bool) else value
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_set(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_label_value(v)}"' for k, v in labels) + '}'
+
+class Metrics:
+    """Метрики процесса для /metrics в текстовом формате Prometheus.
+
+    На горячем пути пишутся только гистограммы (поиск корзины и два сложения на
+    событие); счётчики компонентов снимаются с их stats() при запросе страницы.
+    При PROCESSES > 1 обработчики раз в METRICS_PUSH_INTERVAL секунд отправляют
+    свой снимок супервизору, и /metrics отдаёт их с меткой worker.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources  # () -> {component: stats() or None}
+        self.histograms = []
+        self.remote = {}  # worker index -> snapshot()
+        self.loop_lag = 0.0
+
+    def histogram(self, name, help, *labels):
+        h = Histogram(name, help, labels)
+        self.histograms.append(h)
+        return h
+
+    def snapshot(self):
+        """[(имя, тип, описание, [(суффикс, метки, значение)])]"""
+        families = [(h.name, 'histogram', h.help, list(h.samples())) for h in self.histograms]
+        samples = []
+        for component, stats in self.sources().items():
+            if stats is None:
+                continue
+            for key, value in _flat_stats(stats):
+                samples.append(('', (('component', component), ('name', key)), value))
+        families.append(('bot_component', 'untyped', "Values reported by stats() of bot components", samples))
+        return families
+
+    def render(self):
+        merged = {}
+        own = (('worker', 'supervisor'),) if supervisor is not None else ()
+        sources = [(own, self.snapshot())]
+        sources += [((('worker', str(index)),), snapshot) for index, snapshot in sorted(self.remote.items())]
+        for extra, snapshot in sources:
+            for name, kind, help, samples in snapshot:
+                family = merged.setdefault(name, (kind, help, []))
+                family[2].extend((suffix, extra + labels, value) for suffix, labels, value in samples)
+        lines = []
+        for name, (kind, help, samples) in merged.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{_label_set(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    async def watch_loop(self):
+        """Задержка цикла событий: насколько позже срока просыпается sleep"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+            loop_lag_seconds.observe(self.loop_lag)
+
+    async def push(self):
+        """Обработчик: периодически отправляет свой снимок супервизору"""
+        try:
+            reader, writer = await asyncio.open_unix_connection(IPC_SOCKET)
+        except OSError as e:
+            logging.warning("Metrics push disabled: %s", e)
+            return
+        ipc_send(writer, ('metrics', WORKER_INDEX))
+        try:
+            while True:
+                ipc_send(writer, self.snapshot())
+                await writer.drain()
+                await asyncio.sleep(METRICS_PUSH_INTERVAL)
+        except ConnectionError as e:
+            logging.warning("Metrics push stopped: %s", e)
+        finally:
+            writer.close()
+
+def metric_sources():
+    return {
+        'db': db.stats(),
+        'updates': updates.stats(),
+        'router': callbacks.stats(),
+        'outbox': outbox.stats(),
+        'purchases': purchases.stats(),
+        'reconciler': reconciler.stats(),
+        'rates': rates.stats(),
+        'cryptopay': crypto_pay.stats(),
+        'coingecko': coingecko.stats(),
+        'leader': leader.stats() if WORKER_INDEX is not None else None,
+        'supervisor': supervisor.stats() if supervisor is not None else None,
+        'nav': nav.stats(),
+        'markups': markups.stats(),
+        'catalog': catalog.stats(),
+        'product_cards': product_cards.stats(),
+        'inline_cache': inline_cache.stats(),
+        'settings_cache': settings_cache.stats(),
+        'notify_cache': notify_cache.stats(),
+        'profiler': profiler.stats(),
+        'event_loop': {'lag': metrics.loop_lag},
+    }
+
+metrics = Metrics(metric_sources)
+callback_seconds = metrics.histogram('bot_callback_seconds', "Callback query handling time by callback_data prefix", 'prefix')
+message_seconds = metrics.histogram('bot_message_seconds', "Message handling time by FSM state", 'state')
+inline_seconds = metrics.histogram('bot_inline_query_seconds', "Inline query handling time")
+db_seconds = metrics.histogram('bot_db_block_seconds', "DB block time from checkout request to release (writes: to COMMIT)", 'kind')
+telegram_seconds = metrics.histogram('bot_telegram_seconds', "Bot API request time by method", 'method')
+upstream_seconds = metrics.histogram('bot_upstream_seconds', "External API attempt time", 'upstream')
+loop_lag_seconds = metrics.histogram('bot_event_loop_lag_seconds', "Event loop oversleep")
+
+def timed(histogram, labels):
+    """Внешний middleware aiogram: время обработки события в histogram"""
+    async def middleware(handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            histogram.observe(time.perf_counter() - started, labels(event, data))
+    return middleware
+
+def callback_labels(callback, data):
+    prefix = (callback.data or '').partition('|')[0]
+    # Stale or forged buttons share one series, so label cardinality stays bounded by the routes
+    return (prefix if prefix in callbacks.routes else 'unknown',)
+
+async def timed_request(make_request, bot, method):
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    finally:
+        elapsed = time.perf_counter() - started
+        telegram_seconds.observe(elapsed, (method.__api_method__,))
+        add_span('telegram', elapsed)
+
+dp.callback_query.outer_middleware(timed(callback_seconds, callback_labels))
+dp.message.outer_middleware(timed(message_seconds, lambda message, data: (data.get('raw_state') or 'none',)))
+dp.inline_query.outer_middleware(timed(inline_seconds, lambda query, data: ()))
+bot.session.middleware(timed_request)
+
+async def metrics_endpoint(request):
+    # The exposition shows traffic, queue depths and handler names: scrapers must authenticate
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return web.Response(status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return web.Response(body=metrics.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+# ---------------- Profiling ----------------
+class UpdateProfile:
+    """Время одного обновления по видам ожидания; заполняется через current_profile"""
+
+    __slots__ = ('handler', 'started', 'db', 'telegram', 'upstream', 'stack')
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.db = 0.0
+        self.telegram = 0.0
+        self.upstream = 0.0
+        self.stack = None
+
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+def add_span(kind, elapsed):
+    profile = current_profile.get()
+    if profile is not None:
+        setattr(profile, kind, getattr(profile, kind) + elapsed)
+
+def await_stack(task):
+    """Цепочка await задачи от внешней корутины до места, где она сейчас ждёт"""
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        frames.append((frame, frame.f_lineno))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return ''.join(traceback.StackSummary.extract(frames).format())
+
+def open_slow_log():
+    slow_log = logging.getLogger('slow_updates')
+    slow_log.propagate = False
+    path = SLOW_LOG_FILE if WORKER_INDEX is None else f"{SLOW_LOG_FILE}.w{WORKER_INDEX}"
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=SLOW_LOG_MAX_BYTES, backupCount=SLOW_LOG_BACKUPS,
+                                                   encoding='utf-8', delay=True)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_log.addHandler(handler)
+    return slow_log
+
+slow_log = open_slow_log()
+
+class Profiler:
+    """Внешний middleware обновлений: время каждого обновления по обработчикам.
+
+    Время делится на БД, Bot API, внешние HTTP API и остаток (свой код и ожидание
+    цикла событий). Обновление дольше PROFILE_SLOW_THRESHOLD попадает в журнал
+    медленных со стеком await, который watch() снимает вскоре после превышения
+    порога, пока обновление ещё выполняется; доля PROFILE_SAMPLE_RATE
+    обновлений идёт под cProfile, и их профиль пишется туда же, если обновление
+    оказалось медленным. Профиль охватывает весь процесс, пока шло обновление.
+    Поминутные суммы по обработчикам раз в PROFILE_FLUSH_INTERVAL секунд
+    добавляются в handler_timings, общую для всех процессов.
+    """
+
+    def __init__(self):
+        self.pending = {}  # (minute, handler) -> [count, total, worst, db, telegram, upstream]
+        self.running = {}  # UpdateProfile -> task handling it
+        self.sampling = False  # one cProfile at a time: it hooks the whole thread
+        self.counters = {'updates': 0, 'slow': 0, 'profiled': 0}
+
+    async def __call__(self, handler, update, data):
+        profile = UpdateProfile(None)
+        token = current_profile.set(profile)
+        self.running[profile] = asyncio.current_task()
+        sampler = None
+        if not self.sampling and random.random() < PROFILE_SAMPLE_RATE:
+            self.sampling = True
+            sampler = cProfile.Profile()
+            sampler.enable()
+        try:
+            return await handler(update, data)
+        finally:
+            elapsed = time.perf_counter() - profile.started
+            if sampler is not None:
+                sampler.disable()
+                self.sampling = False
+            del self.running[profile]
+            current_profile.reset(token)
+            if profile.handler is None:
+                profile.handler = f"{update.event_type}:unhandled"
+            self.record(profile, elapsed)
+            if elapsed >= PROFILE_SLOW_THRESHOLD:
+                self.report(update, profile, elapsed, sampler)
+
+    async def watch(self):
+        """Снимает стек await с обновлений, перешедших порог, пока они ещё выполняются"""
+        while True:
+            await asyncio.sleep(PROFILE_SLOW_THRESHOLD / 4)
+            now = time.perf_counter()
+            for profile, task in list(self.running.items()):
+                if profile.stack is None and now - profile.started >= PROFILE_SLOW_THRESHOLD:
+                    profile.stack = await_stack(task)
+
+    def record(self, profile, elapsed):
+        self.counters['updates'] += 1
+        key = (int(time.time() // 60), profile.handler)
+        row = self.pending.get(key)
+        if row is None:
+            row = self.pending[key] = [0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        row[0] += 1
+        row[1] += elapsed
+        row[2] = max(row[2], elapsed)
+        row[3] += profile.db
+        row[4] += profile.telegram
+        row[5] += profile.upstream
+
+    def report(self, update, profile, elapsed, sampler):
+        self.counters['slow'] += 1
+        rest = max(0.0, elapsed - profile.db - profile.telegram - profile.upstream)
+        lines = [f"update {update.update_id} {profile.handler} {elapsed:.3f}s: db {profile.db:.3f}s, "
+                 f"telegram {profile.telegram:.3f}s, upstream {profile.upstream:.3f}s, cpu/other {rest:.3f}s"]
+        if profile.stack:
+            lines.append(f"awaiting after {PROFILE_SLOW_THRESHOLD:g}s:\n{profile.stack}")
+        if sampler is not None:
+            self.counters['profiled'] += 1
+            out = io.StringIO()
+            pstats.Stats(sampler, stream=out).sort_stats('cumulative').print_stats(PROFILE_STATS_LINES)
+            lines.append(out.getvalue())
+        slow_log.warning('\n'.join(lines))
+        logging.warning("Slow update %s: %s took %.2fs", update.update_id, profile.handler, elapsed)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        rows = [(minute, handler, *values) for (minute, handler), values in pending.items()]
+        async with db.write() as conn:
+            await conn.executemany("""INSERT INTO handler_timings(minute,handler,cnt,total,worst,db,telegram,upstream)
+                                   VALUES (?,?,?,?,?,?,?,?)
+                                   ON CONFLICT(minute,handler) DO UPDATE SET cnt=cnt+excluded.cnt, total=total+excluded.total,
+                                   worst=MAX(worst,excluded.worst), db=db+excluded.db, telegram=telegram+excluded.telegram,
+                                   upstream=upstream+excluded.upstream""", rows)
+            await conn.execute("DELETE FROM handler_timings WHERE minute < ?",
+                               (int((time.time() - PROFILE_RETENTION) // 60),))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PROFILE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error("Handler timings flush error: %s", e)
+
+    async def slowest(self, limit=PROFILE_TOP, window=PROFILE_WINDOW):
+        """Обработчики с наибольшим средним временем за последние window секунд, по всем процессам"""
+        await self.flush()
+        async with db.read() as conn:
+            async with conn.execute(HOT_QUERIES['slowest_handlers'][0], (int((time.time() - window) // 60), limit)) as cur:
+                return await cur.fetchall()
+
+    def stats(self):
+        return {**self.counters, 'running': len(self.running), 'pending': len(self.pending)}
+
+profiler = Profiler()
+
+async def name_handler(handler, event, data):
+    """Внутренний middleware: какой обработчик получил событие (callback называет CallbackRouter)"""
+    profile = current_profile.get()
+    if profile is not None:
+        profile.handler = data['handler'].callback.__name__
+    return await handler(event, data)
+
+dp.update.outer_middleware(profiler)
+dp.message.middleware(name_handler)
+dp.inline_query.middleware(name_handler)
+
+# ---------------- Main ----------------
+async def main():
+    if supervisor is not None:
+        await supervisor.run()
+        return
+    if WORKER_INDEX is None:
+        await init_db()
+    else:
+        await db.open()  # schema and migrations are the supervisor's job
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if UPDATE_MODE != 'webhook' and WORKER_INDEX is None:
+        await dp.start_polling(bot)
+        return
+    stop = asyncio.Event()
+    await dp.emit_startup(bot=bot)
+    link = asyncio.create_task(run_worker_link(stop)) if WORKER_INDEX is not None else None
+    try:
+        await wait_for_signal(stop)
+    finally:
+        if link is not None:
+            link.cancel()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())